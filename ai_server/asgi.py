@@ -0,0 +1,297 @@
+import asyncio
+import json
+import os
+
+import uvicorn
+from asgiref.wsgi import WsgiToAsgi
+
+import generation
+import tracing
+from compression import COMPRESS_MIN_BYTES, CompressedStream, compress, compressible, encoded_etag, negotiate
+from preload import preloader
+from ratelimit import RateLimited
+from schema import WorldValidationError
+from server import (BATCH_CONCURRENCY, app as flask_app, batch_descriptions, batch_line, rate_limited_body,
+                    request_deadline, result_headers, world_body)
+from streaming import event_format, section_event
+
+# Everything except the generation endpoint is still served by the Flask app
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+def header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def send_response(send, status, body, content_type="text/html; charset=utf-8", headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+            *[(name.lower().encode(), value.encode()) for name, value in headers],
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, data, headers=()):
+    await send_response(send, status, json.dumps(data).encode(), "application/json", headers)
+
+
+async def parse_description(scope, receive, send):
+    try:
+        description = json.loads(await read_body(receive)).get('description')
+    except (ValueError, AttributeError):
+        description = None
+
+    if not isinstance(description, str) or not description:
+        return await send_json(send, 400, {"error": "Description is required."})
+
+    deadline = request_deadline(header(scope, b"x-request-timeout"))
+    try:
+        result = await until_disconnect(
+            receive, generation.generate_async(description, header(scope, b"idempotency-key"), deadline))
+    except WorldValidationError as e:
+        print(f"Error validating terrain data: {e}")
+        return await send_json(send, 500, {"error": "Failed to generate valid terrain data."})
+    except RateLimited as e:
+        print(f"Rate limited: {e}")
+        return await send_json(send, 429, rate_limited_body(e), [("Retry-After", e.retry_after_header())])
+    except Exception as e:
+        print(f"Error generating terrain data: {e}")
+        return await send_json(send, 500, {"error": "Failed to generate valid terrain data."})
+    if result is None:
+        return
+
+    body, headers = world_body(result.text, result_headers(result), header(scope, b"accept"))
+    if isinstance(body, str):
+        body = body.encode()
+    await send_response(send, 200, body, headers.pop("Content-Type"), headers.items())
+
+
+async def parse_description_stream(scope, receive, send):
+    try:
+        description = json.loads(await read_body(receive)).get('description')
+    except (ValueError, AttributeError):
+        description = None
+
+    if not isinstance(description, str) or not description:
+        return await send_json(send, 400, {"error": "Description is required."})
+
+    content_type, format_event = event_format(header(scope, b"accept"))
+    deadline = request_deadline(header(scope, b"x-request-timeout"))
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", content_type.encode()), (b"cache-control", b"no-cache")],
+    })
+
+    async def send_event(event):
+        await send({"type": "http.response.body", "body": format_event(event).encode(), "more_body": True})
+
+    async def stream():
+        try:
+            async for section in generation.stream_sections_async(description, deadline):
+                await send_event(section_event(*section))
+        except RateLimited as e:
+            print(f"Rate limited: {e}")
+            await send_event({"section": "error", **rate_limited_body(e)})
+        except Exception as e:
+            print(f"Error streaming terrain data: {e}")
+            await send_event({"section": "error", "error": "Failed to generate valid terrain data."})
+        else:
+            await send_event({"section": "done"})
+        return True
+
+    if await until_disconnect(receive, stream()):
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def parse_descriptions(scope, receive, send):
+    try:
+        body = json.loads(await read_body(receive))
+    except ValueError:
+        body = None
+
+    descriptions, error = batch_descriptions(body)
+
+    if error:
+        return await send_json(send, 400, {"error": error})
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"application/x-ndjson"), (b"cache-control", b"no-cache")],
+    })
+
+    async def send_line(line):
+        await send({"type": "http.response.body", "body": line.encode(), "more_body": True})
+
+    async def run(index, description):
+        async with batch_slots:
+            try:
+                return batch_line(index, description, await generation.generate_async(description))
+            except Exception as e:
+                return batch_line(index, description, error=e)
+
+    async def stream():
+        tasks = []
+        for index, description in enumerate(descriptions):
+            if isinstance(description, str) and description:
+                tasks.append(asyncio.ensure_future(run(index, description)))
+            else:
+                await send_line(batch_line(index, description))
+        try:
+            for line in asyncio.as_completed(tasks):
+                await send_line(await line)
+        finally:
+            # Only left early when the client has gone, in which case nobody wants the rest
+            for task in tasks:
+                task.cancel()
+        return True
+
+    if await until_disconnect(receive, stream()):
+        await send({"type": "http.response.body", "body": b""})
+
+
+# Shared by every batch, like the thread pool behind the Flask endpoint
+batch_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+
+# Run coro unless the client hangs up first, in which case it is cancelled and None is returned.
+# Cancelling releases this request's share of a coalesced upstream call.
+async def until_disconnect(receive, coro):
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(disconnected())
+    await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    watcher.cancel()
+
+    if not task.done():
+        task.cancel()
+        return None
+    return task.result()
+
+
+# Same tracing as the Flask endpoints: a Server-Timing header on the response, and the trace
+# finished (and exported if sampled) once the body has been sent
+async def traced(handler, scope, receive, send):
+    trace, token = tracing.start(scope["path"])
+    attributes = {"status": 500}
+
+    async def traced_send(message):
+        if message["type"] == "http.response.start":
+            headers = message.get("headers", [])
+            attributes["status"] = message["status"]
+            attributes["source"] = next((value.decode() for name, value in headers if name == b"x-cache"), None)
+            message = {**message, "headers": [*headers, (b"server-timing", trace.server_timing().encode())]}
+        await send(message)
+
+    try:
+        await handler(scope, receive, traced_send)
+    finally:
+        tracing.detach(token)
+        tracing.finish(trace, **attributes)
+
+
+# Same compression as the Flask endpoints. A response with a Content-Length is held until its body
+# arrives and compressed whole; a streamed one is compressed a message at a time.
+class CompressingSend:
+    def __init__(self, scope, send):
+        self.send = send
+        self.encoding = negotiate(header(scope, b"accept-encoding"))
+        self.held = None
+        self.stream = None
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            headers = message.get("headers", [])
+            content_type = next((value.decode() for name, value in headers if name == b"content-type"), None)
+            if any(name == b"content-encoding" for name, _ in headers) or not compressible(content_type):
+                return await self.send(message)
+            headers = [*headers, (b"vary", b"accept-encoding")]
+            if any(name == b"content-length" for name, _ in headers):
+                self.held = {**message, "headers": headers}
+                return
+            if self.encoding is not None:
+                self.stream = CompressedStream(self.encoding)
+                headers = self.encoded(headers)
+            return await self.send({**message, "headers": headers})
+
+        if message["type"] == "http.response.body":
+            if self.held is not None:
+                start, self.held = self.held, None
+                body = message.get("body", b"")
+                if self.encoding is not None and len(body) >= COMPRESS_MIN_BYTES:
+                    etag = next((value.decode() for name, value in start["headers"] if name == b"etag"), None)
+                    body = compress(body, self.encoding, etag)
+                    headers = [(name, value) for name, value in self.encoded(start["headers"]) if name != b"content-length"]
+                    start = {**start, "headers": [*headers, (b"content-length", str(len(body)).encode())]}
+                    message = {**message, "body": body}
+                await self.send(start)
+            elif self.stream is not None:
+                body = message.get("body", b"")
+                data = self.stream.write(body) if body else b""
+                if not message.get("more_body", False):
+                    data += self.stream.close()
+                message = {**message, "body": data}
+        await self.send(message)
+
+    def encoded(self, headers):
+        encoded = [(b"content-encoding", self.encoding.encode())]
+        for name, value in headers:
+            if name == b"etag":
+                value = encoded_etag(value.decode(), self.encoding).encode()
+            encoded.append((name, value))
+        return encoded
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            generation.start_warm_up()
+            preloader.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# Async entry point: /parse_description awaits the upstream model directly, so a
+# single process can hold hundreds of generations in flight instead of one per thread
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(scope, receive, send)
+
+    if scope["type"] == "http" and scope["method"] == "POST":
+        if scope["path"] == "/parse_description":
+            return await traced(parse_description, scope, receive, CompressingSend(scope, send))
+        if scope["path"] == "/parse_description/stream":
+            return await traced(parse_description_stream, scope, receive, CompressingSend(scope, send))
+        if scope["path"] == "/parse_descriptions":
+            return await traced(parse_descriptions, scope, receive, CompressingSend(scope, send))
+
+    await wsgi_app(scope, receive, send)
+
+
+if __name__ == '__main__':
+    uvicorn.run(app, port=int(os.environ.get("PORT", 5000)))
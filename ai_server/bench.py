@@ -0,0 +1,967 @@
+import argparse
+import asyncio
+import copy
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import generation
+import schema
+from cache import response_cache
+from fake import SAMPLE_RESPONSE, FixedResponse
+from hedging import Hedger
+from pool import Member, UpstreamPool
+from presets import PRESETS, fast_path, match
+from ratelimit import RateLimited, RateLimiter
+from similarity import SimilarityCache
+
+
+# Stand-in for the Gemini model that answers after a fixed delay
+class FixedLatencyModel:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        time.sleep(self.latency)
+        return FixedResponse(SAMPLE_RESPONSE)
+
+    async def generate_content_async(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return FixedResponse(SAMPLE_RESPONSE)
+
+
+# Mostly fast, but a fraction of calls hit a long tail
+class TailLatencyModel(FixedLatencyModel):
+    def __init__(self, latency, slow_latency, slow_fraction, seed=0):
+        super().__init__(latency)
+        self.slow_latency = slow_latency
+        self.slow_fraction = slow_fraction
+        self.rng = random.Random(seed)
+
+    async def generate_content_async(self, prompt):
+        self.calls += 1
+        slow = self.rng.random() < self.slow_fraction
+        await asyncio.sleep(self.slow_latency if slow else self.latency * self.rng.uniform(0.8, 1.2))
+        return FixedResponse(SAMPLE_RESPONSE)
+
+
+class QuotaError(Exception):
+    code = 429
+
+
+# Turns away calls beyond per_second in any one second window, like a Gemini per-minute quota scaled down
+class QuotaModel(FixedLatencyModel):
+    def __init__(self, latency, per_second):
+        super().__init__(latency)
+        self.per_second = per_second
+        self.recent = deque()
+        self.rejected = 0
+
+    async def generate_content_async(self, prompt):
+        now = time.monotonic()
+        while self.recent and self.recent[0] <= now - 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.per_second:
+            self.rejected += 1
+            raise QuotaError("Resource has been exhausted (e.g. check quota).")
+        self.recent.append(now)
+        return await super().generate_content_async(prompt)
+
+
+class FailingModel(FixedLatencyModel):
+    async def generate_content_async(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        raise ConnectionError("upstream unavailable")
+
+
+# Stands in for the Gemini keys: a pool of one member answered by model
+def use_model(model, limiter=None):
+    generation.upstream_pool = UpstreamPool([Member("bench", model=model, limiter=limiter)])
+    return model
+
+
+def bench_flask(requests, threads):
+    from server import app
+
+    client = app.test_client()
+
+    def post(i):
+        return client.post('/parse_description', json={"description": f"snowy mountains with {i} ferris wheels"}).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = list(pool.map(post, range(requests)))
+    return time.perf_counter() - start, statuses
+
+
+async def asgi_post(app, body):
+    return (await asgi_request(app, "/parse_description", body))[0]["status"]
+
+
+async def asgi_request(app, path, body):
+    sent = []
+
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    # Like a real server, receive() blocks after the body until the client disconnects
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path, "headers": [], "query_string": b""}
+    await app(scope, receive, send)
+    return sent
+
+
+def bench_asgi(requests):
+    from asgi import app
+
+    bodies = [json.dumps({"description": f"snowy mountains with {i} ferris wheels"}).encode() for i in range(requests)]
+
+    start = time.perf_counter()
+    statuses = asyncio.run(gather_posts(app, bodies))
+    return time.perf_counter() - start, statuses
+
+
+def bench_cache_hits(lookups):
+    response_cache.clear()
+    generation.generate("Snowy mountains with a Ferris wheel!")
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        generation.generate("  snowy MOUNTAINS with a ferris wheel")
+    elapsed = time.perf_counter() - start
+    print(f"{'cache hit':<24} {elapsed / lookups * 1e6:.1f} us per lookup, {response_cache.stats()}")
+
+
+BIOME_WORDS = (
+    "desert snowy mountain forest island lake river ocean grass dead sand rock hill valley canyon volcano "
+    "swamp beach jungle tundra plain meadow cliff fog night sunset tall small flat rolling dense sparse "
+    "foggy sunny stormy green frozen dry wet rocky ancient"
+).split()
+
+
+def bench_similarity(entries, lookups=2000):
+    rng = random.Random(0)
+    rare_words = [f"word{i}" for i in range(3000)]
+
+    def description():
+        return " ".join(rng.sample(BIOME_WORDS, rng.randint(2, 4)) + rng.sample(rare_words, rng.randint(0, 3)))
+
+    similarity_cache = SimilarityCache(threshold=0.7, max_entries=entries)
+    for i in range(entries):
+        similarity_cache.put(description(), SAMPLE_RESPONSE)
+
+    queries = [description() for i in range(lookups)]
+    start = time.perf_counter()
+    for query in queries:
+        similarity_cache.get(query)
+    elapsed = time.perf_counter() - start
+    print(f"{'similarity lookup':<24} {elapsed / lookups * 1e6:.1f} us per lookup at {entries} entries, {similarity_cache.stats()}")
+
+
+# 100 concurrent identical requests must reach the model exactly once on both servers
+def bench_coalescing(requests=100):
+    from server import app as flask_app
+    from asgi import app as asgi_app
+
+    client = flask_app.test_client()
+    model = generation.upstream_pool.members[0].model
+
+    def post(i):
+        return client.post('/parse_description', json={"description": "Snowy mountains with a ferris wheel"}).status_code
+
+    def post_all():
+        with ThreadPoolExecutor(max_workers=requests) as pool:
+            return list(pool.map(post, range(requests)))
+
+    for name, run in [
+        ("flask", post_all),
+        ("asgi", lambda: asyncio.run(gather_posts(asgi_app, [b'{"description": "snowy  mountains with a ferris wheel!"}'] * requests))),
+    ]:
+        response_cache.clear()
+        model.calls = 0
+        statuses = run()
+        ok = sum(1 for status in statuses if status == 200)
+        verdict = "ok" if model.calls == 1 else "FAIL"
+        print(f"{'coalescing ' + name:<24} {requests} identical requests -> {model.calls} upstream calls ({ok} ok) {verdict}")
+
+
+async def gather_posts(app, bodies):
+    return await asyncio.gather(*[asgi_post(app, body) for body in bodies])
+
+
+# Descriptions that aren't non-empty strings are turned away with a 400 by every endpoint taking one
+def bench_bad_descriptions():
+    from server import app as flask_app
+    from asgi import app as asgi_app
+
+    client = flask_app.test_client()
+    bodies = [{"description": 5}, {"description": ["snowy mountains"]}, {"description": {"text": "desert"}},
+              {"description": True}, {"description": ""}, {}, ["snowy mountains"], "snowy mountains", None]
+    statuses = Counter()
+    for path in ("/parse_description", "/parse_description/stream", "/jobs"):
+        for body in bodies:
+            statuses[client.post(path, json=body).status_code] += 1
+    for path in ("/parse_description", "/parse_description/stream"):
+        for body in bodies:
+            sent = asyncio.run(asgi_request(asgi_app, path, json.dumps(body).encode()))
+            statuses[sent[0]["status"]] += 1
+    verdict = "ok" if set(statuses) == {400} else "FAIL"
+    print(f"{'bad descriptions':<24} {sum(statuses.values())} requests, statuses {dict(statuses)} {verdict}")
+
+
+# An upstream that keeps failing still gets a JSON error, not a bare 500
+def bench_upstream_errors():
+    from asgi import app as asgi_app
+
+    pool = generation.upstream_pool
+    model = use_model(FailingModel(0.001))
+    sent = asyncio.run(asgi_request(asgi_app, "/parse_description", b'{"description": "a volcano next to a castle"}'))
+    generation.upstream_pool = pool
+    status, body = sent[0]["status"], sent[-1]["body"]
+    try:
+        error = json.loads(body).get("error")
+    except ValueError:
+        error = None
+    verdict = "ok" if status == 500 and error else "FAIL"
+    print(f"{'upstream errors':<24} asgi answered {status} {body[:60]!r} after {model.calls} calls {verdict}")
+
+
+def bench_fast_path(lookups=10000):
+    descriptions = ["snowy mountains at sunset", "a dry desert, no water", "island with a lake", "a volcano next to a castle"]
+    start = time.perf_counter()
+    for i in range(lookups):
+        fast_path.get(descriptions[i % len(descriptions)])
+    elapsed = time.perf_counter() - start
+    print(f"{'fast path':<24} {elapsed / lookups * 1e6:.1f} us per lookup, {fast_path.stats()}")
+
+    # Half a biome ("snow", "mountains") or a water word on ice isn't a snowy mountain range
+    expected = {"snowy mountains": "snowy_mountains", "alpine peaks at night": "snowy_mountains",
+                "mountains": None, "snow": None, "frozen lake": None, "icy mountains": None}
+    wrong = []
+    for description, preset in expected.items():
+        found = match(description)
+        answered = found.preset if found is not None and found.confidence >= fast_path.threshold else None
+        if answered != preset:
+            wrong.append(f"{description!r} -> {answered}")
+    snowy = PRESETS["snowy_mountains"]["world"]["terrainsData"][0]["treeGeneratorData"]
+    if snowy["density"]:
+        wrong.append(f"snowy_mountains tree density {snowy['density']}")
+    verdict = "ok" if not wrong else "FAIL " + "; ".join(wrong)
+    print(f"{'fast path matches':<24} {len(expected)} descriptions matched as expected {verdict}")
+
+
+def bench_validation(responses=2000):
+    text = generation.clean_response(SAMPLE_RESPONSE)
+    start = time.perf_counter()
+    for i in range(responses):
+        schema.dump(schema.validate(text))
+    elapsed = time.perf_counter() - start
+    print(f"{'validation':<24} {elapsed / responses * 1e6:.1f} us per response ({len(text)} bytes)")
+
+    # The prompt's water block asks for the fields the response schema and WaterGeneratorData declare
+    block = re.search(r'"waterGeneratorData": \{(.*?)\}\s*\}', generation.build_full_format(), re.S).group(1)
+    asked = set(re.findall(r'"(\w+)":', block)) - {"x", "y"}
+    declared = set(schema.response_schema(schema.WaterGeneratorData)["properties"])
+    verdict = "ok" if asked == declared else f"FAIL prompt {sorted(asked - declared)} schema {sorted(declared - asked)}"
+    print(f"{'prompt water fields':<24} {len(asked)} fields in the prompt, {len(declared)} in the schema {verdict}")
+
+
+# Open-loop arrivals against a long-tailed upstream, with and without hedging
+def bench_hedging(requests=400, interval=0.005):
+    saved_pool, saved_hedger = generation.upstream_pool, generation.hedger
+
+    async def one(i):
+        start = time.perf_counter()
+        await generation.generate_async(f"hedged world {i}")
+        return time.perf_counter() - start
+
+    async def run():
+        tasks = []
+        for i in range(requests):
+            tasks.append(asyncio.ensure_future(one(i)))
+            await asyncio.sleep(interval)
+        return sorted(await asyncio.gather(*tasks))
+
+    for max_fraction in (0.0, 0.1):
+        response_cache.clear()
+        model = use_model(TailLatencyModel(0.1, 1.0, 0.04))
+        generation.hedger = Hedger(percentile=95, max_fraction=max_fraction)
+        latencies = asyncio.run(run())
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+        extra = model.calls / requests - 1
+        print(f"{'hedging ' + str(max_fraction):<24} p50 {p50 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms, "
+              f"{extra:.1%} extra upstream calls, {generation.hedger.stats()['hedgeWins']} hedge wins")
+
+    generation.upstream_pool, generation.hedger = saved_pool, saved_hedger
+
+
+# One batch against both servers; the floor is set by BATCH_CONCURRENCY upstream calls at a time
+def bench_batch(items, latency):
+    from server import BATCH_CONCURRENCY, app as flask_app
+    from asgi import app as asgi_app
+
+    descriptions = [f"batch world {i} with a ferris wheel" for i in range(items)]
+    body = json.dumps({"descriptions": descriptions}).encode()
+    floor = -(-items // BATCH_CONCURRENCY) * latency
+
+    async def post_asgi():
+        sent = await asgi_request(asgi_app, "/parse_descriptions", body)
+        return b"".join(message.get("body", b"") for message in sent[1:])
+
+    for name, run in [
+        ("flask", lambda: flask_app.test_client().post('/parse_descriptions', data=body, content_type='application/json').data),
+        ("asgi", lambda: asyncio.run(post_asgi())),
+    ]:
+        response_cache.clear()
+        start = time.perf_counter()
+        lines = [json.loads(line) for line in run().splitlines()]
+        elapsed = time.perf_counter() - start
+        ok = sum(1 for line in lines if line["status"] == 200)
+        print(f"{'batch ' + name:<24} {items} items in {elapsed:.2f}s = {items / elapsed:8.1f} items/s "
+              f"({ok} ok, floor {floor:.2f}s at concurrency {BATCH_CONCURRENCY})")
+
+
+# Time from launching server.py, as ServerHandler.cs does on Start(), until /healthz answers
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_server(command, port, env=None):
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, "PORT": str(port), **(env or {})},
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for_health(port, process):
+    while True:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=1).close()
+            return
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"{' '.join(process.args)} exited with code {process.returncode}")
+            time.sleep(0.01)
+
+
+def bench_startup(budget, runs=5):
+    port = free_port()
+
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        process = start_server([sys.executable, "server.py"], port)
+        try:
+            wait_for_health(port, process)
+            times.append(time.perf_counter() - start)
+        finally:
+            process.kill()
+            process.wait()
+
+    median = sorted(times)[len(times) // 2]
+    verdict = "ok" if median <= budget else "FAIL"
+    print(f"{'time to listening':<24} median {median * 1000:.0f} ms of {runs} starts, budget {budget * 1000:.0f} ms {verdict}")
+    return median <= budget
+
+
+# Everything an upstream request records: a trace with its Server-Timing header, five stages, two
+# in-flight gauges, an outcome, a size and token counts. Must stay well under 50 us so neither
+# metrics nor tracing is ever worth turning off.
+def bench_metrics(requests=20000):
+    import tracing
+    from metrics import generations_total, in_flight, record_tokens, registry, response_bytes
+
+    start = time.perf_counter()
+    for i in range(requests):
+        trace, token = tracing.start("/parse_description")
+        with in_flight.track("generation"):
+            for stage in ("prompt", "upstream", "cleanup", "validate", "serialize"):
+                with tracing.stage(stage):
+                    pass
+            with in_flight.track("upstream"):
+                record_tokens("prompt", "response")
+        generations_total.inc("upstream")
+        response_bytes.observe(4096)
+        trace.server_timing()
+        tracing.detach(token)
+        tracing.finish(trace, status=200)
+    elapsed = (time.perf_counter() - start) / requests
+
+    start = time.perf_counter()
+    text = registry.render()
+    render = time.perf_counter() - start
+    verdict = "ok" if elapsed < 50e-6 else "FAIL"
+    print(f"{'metrics and tracing':<24} {elapsed * 1e6:.1f} us per request {verdict}, /metrics renders "
+          f"{len(text)} bytes in {render * 1000:.2f} ms")
+
+
+# Arrivals at twice the upstream quota, each with a 2 second deadline. Without the limiter the
+# excess hits the API and fails there; with it, calls are paced to the quota and the rest are
+# turned away before spending any of it. The burst is scaled down like the quota window.
+def bench_rate_limit(quota=20, rate=40, seconds=5):
+    saved_pool = generation.upstream_pool
+
+    async def one(i):
+        try:
+            await generation.generate_async(f"rate limited world {i}", deadline=time.monotonic() + 2)
+            return "ok"
+        except RateLimited as e:
+            return e.reason
+
+    async def run():
+        tasks = []
+        for i in range(rate * seconds):
+            tasks.append(asyncio.ensure_future(one(i)))
+            await asyncio.sleep(1 / rate)
+        return await asyncio.gather(*tasks)
+
+    for name, limiter in [("off", None), ("on", RateLimiter(quota * 60 * 0.9, 0, burst_seconds=0.1))]:
+        response_cache.clear()
+        model = use_model(QuotaModel(0.05, quota), limiter)
+        start = time.perf_counter()
+        outcomes = Counter(asyncio.run(run()))
+        elapsed = time.perf_counter() - start
+        print(f"{'rate limit ' + name:<24} {outcomes['ok'] / elapsed:.1f} ok/s against {quota}/s quota, "
+              f"{model.rejected} upstream quota errors, "
+              f"{outcomes['deadline'] + outcomes['queue_full']} turned away early")
+
+    generation.upstream_pool = saved_pool
+
+
+# Arrivals at five times one key's quota against pools of 1, 2 and 4 keys, each with its own
+# limiter: what gets through should grow with the keys. Then a pool with one dead key, which
+# failover has to hide from every request and ejection has to stop calling.
+def bench_pool(quota=10, seconds=4):
+    saved_pool = generation.upstream_pool
+
+    async def one(i, prefix):
+        try:
+            await generation.generate_async(f"{prefix} world {i}", deadline=time.monotonic() + 2)
+            return "ok"
+        except RateLimited as e:
+            return e.reason
+        except Exception:
+            return "error"
+
+    async def run(prefix, rate, count):
+        tasks = []
+        for i in range(count):
+            tasks.append(asyncio.ensure_future(one(i, prefix)))
+            await asyncio.sleep(1 / rate)
+        return await asyncio.gather(*tasks)
+
+    rate = quota * 5
+    for keys in (1, 2, 4):
+        response_cache.clear()
+        models = [QuotaModel(0.05, quota) for _ in range(keys)]
+        generation.upstream_pool = UpstreamPool([
+            Member(f"key{i}", model=model, limiter=RateLimiter(quota * 60 * 0.9, 0, burst_seconds=0.1))
+            for i, model in enumerate(models)])
+        start = time.perf_counter()
+        outcomes = Counter(asyncio.run(run(f"pool {keys}", rate, rate * seconds)))
+        elapsed = time.perf_counter() - start
+        calls = "/".join(str(model.calls) for model in models)
+        print(f"{f'pool {keys} keys':<24} {outcomes['ok'] / elapsed:.1f} ok/s against {keys * quota}/s quota, "
+              f"{sum(model.rejected for model in models)} upstream quota errors, calls per key {calls}")
+
+    response_cache.clear()
+    models = [FailingModel(0.05), FixedLatencyModel(0.05), FixedLatencyModel(0.05)]
+    generation.upstream_pool = UpstreamPool([Member(f"key{i}", model=model) for i, model in enumerate(models)])
+    requests = 200
+    outcomes = Counter(asyncio.run(run("dead key", 100, requests)))
+    dead = generation.upstream_pool.stats()["members"]["key0"]
+    verdict = "ok" if outcomes["ok"] == requests and models[0].calls < 10 else "FAIL"
+    print(f"{'pool dead key':<24} {outcomes['ok']}/{requests} ok, {models[0].calls} calls to the dead key, "
+          f"ejected for {dead['ejectedForSeconds']:.0f}s {verdict}")
+
+    generation.upstream_pool = saved_pool
+
+
+# Ratio and CPU time of each available encoding on a typical world, and what serving the same
+# world again costs once its compressed bytes are cached
+def bench_compression(responses=2000):
+    from compression import ENCODINGS, compress, compressed_cache
+
+    body = SAMPLE_RESPONSE.encode()
+    for encoding in ENCODINGS:
+        compressed_cache.clear()
+        start = time.perf_counter()
+        for i in range(responses):
+            compressed = compress(body, encoding)
+        elapsed = (time.perf_counter() - start) / responses
+        compress(body, encoding, '"bench"')
+        start = time.perf_counter()
+        for i in range(responses):
+            compress(body, encoding, '"bench"')
+        cached = (time.perf_counter() - start) / responses
+        print(f"{'compression ' + encoding:<24} {len(body)} -> {len(compressed)} bytes "
+              f"({len(compressed) / len(body):.0%}) in {elapsed * 1e6:.0f} us, {cached * 1e6:.1f} us cached")
+
+
+def as_float32(value):
+    if isinstance(value, float):
+        return struct.unpack("<f", struct.pack("<f", value))[0]
+    if isinstance(value, dict):
+        return {key: as_float32(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [as_float32(item) for item in value]
+    return value
+
+
+# The binary WorldInfo must decode to the JSON one (at float32 precision, like Unity), be smaller,
+# and stay cheap with a heightmap, which it carries as a raw block instead of a list of lists
+def bench_codec(worlds=2000, heightmap_size=256):
+    import codec
+
+    text = generation.parse_response(SAMPLE_RESPONSE)
+    data = json.loads(text)
+    rng = random.Random(0)
+    with_heightmap = {**data, "heightMap": [[rng.random() for x in range(heightmap_size)] for y in range(heightmap_size)]}
+
+    for name, world in [("codec", data), (f"codec {heightmap_size}x{heightmap_size}", with_heightmap)]:
+        text = json.dumps(world)
+        binary = codec.encode(world)
+        decoded = codec.decode(binary)
+        if "heightMap" in decoded:
+            decoded["heightMap"] = decoded["heightMap"].tolist()
+        verdict = "ok" if decoded == as_float32(world) else "FAIL"
+        runs = max(1, worlds // (1 + len(binary) // 10000))
+
+        timings = []
+        for fn, arg in [(json.loads, text), (codec.decode, binary), (json.dumps, world), (codec.encode, world)]:
+            start = time.perf_counter()
+            for i in range(runs):
+                fn(arg)
+            timings.append((time.perf_counter() - start) / runs * 1e6)
+        print(f"{name:<24} round trip {verdict}, {len(text)} -> {len(binary)} bytes, decode {timings[0]:.0f} -> "
+              f"{timings[1]:.0f} us, encode {timings[2]:.0f} -> {timings[3]:.0f} us (json -> binary)")
+
+
+# A repeat load of a shared world should cost the client a 304 and nothing more
+def bench_world_ids(requests=2000):
+    import codec
+    from server import app as flask_app
+
+    client = flask_app.test_client()
+    location = client.post("/parse_description", json={"description": "Snowy mountains with a Ferris wheel!"}).headers["Location"]
+    etag = client.get(location).headers["ETag"]
+
+    results = []
+    for headers in [{}, {"If-None-Match": etag}]:
+        start = time.perf_counter()
+        responses = [client.get(location, headers=headers) for i in range(requests)]
+        elapsed = (time.perf_counter() - start) / requests
+        statuses = Counter(response.status_code for response in responses)
+        results.append(f"{dict(statuses)} {len(responses[0].data)} bytes in {elapsed * 1e6:.0f} us")
+    print(f"{'world by id':<24} " + ", repeat load ".join(results))
+
+    # A 304 repeats the ETag of the representation the client would get, compressed or binary
+    mismatched = []
+    for accept in (None, "application/json", codec.CONTENT_TYPE):
+        for encoding in (None, "gzip", "deflate"):
+            headers = {name: value for name, value in (("Accept", accept), ("Accept-Encoding", encoding)) if value}
+            served = client.get(location, headers=headers).headers["ETag"]
+            revalidated = client.get(location, headers={**headers, "If-None-Match": served})
+            if revalidated.status_code != 304 or revalidated.headers["ETag"] != served:
+                mismatched.append(f"{accept}/{encoding}: {served} -> {revalidated.status_code} {revalidated.headers['ETag']}")
+    verdict = "ok" if not mismatched else "FAIL " + "; ".join(mismatched)
+    print(f"{'world by id etags':<24} 200 and 304 ETags agree for 9 Accept and Accept-Encoding pairs {verdict}")
+
+    # "*" only matches a world that exists
+    statuses = [client.get(path, headers={"If-None-Match": "*"}).status_code for path in (location, "/worlds/nonexistent")]
+    verdict = "ok" if statuses == [304, 404] else "FAIL"
+    print(f"{'world by id star':<24} If-None-Match * answered {statuses[0]} for a world, {statuses[1]} for none {verdict}")
+
+
+# Writes only queue on the request path; reads on a freshly opened store, as after a restart,
+# must be fast enough for it to back the response cache
+def bench_store(entries=5000, lookups=5000):
+    import tempfile
+    from store import WorldStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "worlds.db")
+        store = WorldStore(path, flush_seconds=3600, max_batch=entries + 1)
+        keys = [generation.cache_key(f"stored world {i}") for i in range(entries)]
+
+        start = time.perf_counter()
+        for key in keys:
+            store.put(key, SAMPLE_RESPONSE, SAMPLE_RESPONSE, 2.0, 3000, 1500)
+        put = (time.perf_counter() - start) / entries
+        start = time.perf_counter()
+        store.flush()
+        flush = time.perf_counter() - start
+
+        restarted = WorldStore(path)
+        sample = random.Random(0).choices(keys, k=lookups)
+        start = time.perf_counter()
+        for key in sample:
+            restarted.get(key)
+        get = (time.perf_counter() - start) / lookups
+        print(f"{'store':<24} put {put * 1e6:.1f} us, {entries} written in {flush * 1000:.0f} ms, "
+              f"get after restart {get * 1e6:.1f} us ({restarted.hits}/{lookups} hits)")
+
+
+# The leader of a shared upstream call flushes its world before releasing its lease, while the
+# writer thread is still committing the batch holding it, held up by another process's write.
+# Once flush() returns the world must be there for a waiter to read as soon as the lease is gone,
+# rather than calling the model again; release() itself can't be relied on to wait for the writer.
+def bench_store_handoff():
+    import sqlite3
+    import threading
+    from store import WorldStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "worlds.db")
+        store = WorldStore(path, flush_seconds=3600)
+        key = generation.cache_key("handed off world")
+        token = store.lease(key, 60)
+        blocker = sqlite3.connect(path, check_same_thread=False)
+        blocker.execute("BEGIN IMMEDIATE")
+        store.put(key, SAMPLE_RESPONSE)
+        writer = threading.Thread(target=store.flush)
+        writer.start()
+        time.sleep(0.1)
+        threading.Timer(0.3, blocker.rollback).start()
+        store.flush()
+        world, _ = WorldStore(path).poll(key)
+        store.release(key, token)
+        writer.join()
+        _, leased = store.poll(key)
+        verdict = "ok" if world is not None and not leased else "FAIL"
+        print(f"{'store handoff':<24} world {'found' if world is not None else 'missing'} by a waiter as the "
+              f"leader released its lease {verdict}")
+
+
+# Each client sends its share of the requests one after another on one keep-alive connection
+def post_keep_alive(port, requests, clients):
+    body = json.dumps({"description": "snowy mountains"})
+    headers = {"Content-Type": "application/json"}
+
+    def client(count):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        statuses = []
+        for _ in range(count):
+            connection.request("POST", "/parse_description", body, headers)
+            response = connection.getresponse()
+            response.read()
+            statuses.append(response.status)
+        connection.close()
+        return statuses
+
+    counts = [requests // clients + (1 if i < requests % clients else 0) for i in range(clients)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        statuses = [status for part in pool.map(client, counts) for status in part]
+    return time.perf_counter() - start, statuses
+
+
+# The dev server against gunicorn.conf.py's pre-forked workers, over real sockets. The description
+# hits the preset fast path, so this measures serving (HTTP, routing, compression, metrics) rather
+# than the model, and needs no API key.
+def bench_serving(requests, clients, workers):
+    servers = [("dev server", [sys.executable, "server.py"])]
+    try:
+        import gunicorn
+        servers.append((f"gunicorn ({workers} workers)", [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "asgi:app"]))
+    except ImportError:
+        print("gunicorn not installed, only timing the dev server")
+
+    for name, command in servers:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as directory:
+            process = start_server(command, port, {"WARMUP": "0", "WEB_WORKERS": str(workers),
+                                                   "STORE_PATH": os.path.join(directory, "worlds.db"),
+                                                   "METRICS_DIR": os.path.join(directory, "metrics")})
+            try:
+                wait_for_health(port, process)
+                # Until every worker has booted and served once
+                post_keep_alive(port, clients * workers, clients)
+                report(name, requests, *post_keep_alive(port, requests, clients))
+            finally:
+                process.terminate()
+                process.wait()
+
+
+# A restart after a day of Zipf-distributed traffic recorded in the store: how much of the first
+# requests afterwards the in-memory cache answers, starting cold and after preloading the top worlds
+def bench_preload(worlds=2000, recorded=20000, replayed=1000, top=200):
+    from preload import Preloader
+    from store import WorldStore
+
+    saved_store = generation.world_store
+    rng = random.Random(0)
+    descriptions = [f"recorded world {i}" for i in range(worlds)]
+    weights = [1 / (rank + 1) for rank in range(worlds)]
+    text = generation.parse_response(SAMPLE_RESPONSE)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "worlds.db")
+        store = WorldStore(path)
+        for description in descriptions:
+            store.put(generation.cache_key(description), text)
+        for description in rng.choices(descriptions, weights, k=recorded):
+            store.touch(generation.cache_key(description))
+        store.flush()
+
+        replay = rng.choices(descriptions, weights, k=replayed)
+        for name in ("cold", "preloaded"):
+            response_cache.clear()
+            generation.world_store = WorldStore(path)
+            start = time.perf_counter()
+            if name == "preloaded":
+                Preloader(generation.world_store, top).run()
+            elapsed = time.perf_counter() - start
+            sources = Counter(generation.generate(description).source for description in replay)
+            print(f"{'warm-up ' + name:<24} {sources['cache'] / replayed:.0%} of the first {replayed} requests from memory, "
+                  f"{sources['store']} from the store, top {top} of {worlds} loaded in {elapsed * 1000:.0f} ms")
+
+    generation.world_store = saved_store
+
+
+# Cleanup, validation and serialization of real model output recorded in a cassette, streamed and
+# not, and the whole upstream path replayed from it at zero latency. The same cassette gives the
+# same work every run, so the times compare between versions, and a response that stops
+# validating shows up in the count of invalid ones.
+def bench_replay(path, rounds=5):
+    from cassette import Player
+    from streaming import SectionParser
+
+    player = Player(path, scale=0)
+    recorded = [interaction for interaction in player.interactions if "error" not in interaction and interaction["chunks"]]
+    if not recorded:
+        print(f"{'replay':<24} no answers in {path}")
+        return
+
+    def timed(fn, interactions):
+        times = []
+        failed = 0
+        for _ in range(rounds):
+            for interaction in interactions:
+                start = time.perf_counter()
+                try:
+                    fn(interaction)
+                except Exception:
+                    failed += 1
+                times.append(time.perf_counter() - start)
+        times.sort()
+        return times[len(times) // 2], times[int(len(times) * 0.99)], failed // rounds
+
+    def parse(interaction):
+        generation.parse_response("".join(text for _, text in interaction["chunks"]))
+
+    def stream(interaction):
+        parser = SectionParser()
+        for _, text in interaction["chunks"]:
+            for _ in generation.validated_sections(parser, text):
+                pass
+
+    def upstream(interaction):
+        response_cache.clear()
+        description = interaction["description"]
+        generation.call_upstream(generation.cache_key(description), description)
+
+    saved_pool = generation.upstream_pool
+    use_model(player)
+    described = [interaction for interaction in recorded if interaction["description"] is not None]
+    for name, fn, interactions in (("parse", parse, recorded), ("stream", stream, recorded), ("upstream", upstream, described)):
+        median, p99, failed = timed(fn, interactions)
+        print(f"{'replay ' + name:<24} {len(interactions)} recorded responses, median {median * 1e6:.0f} us, "
+              f"p99 {p99 * 1e6:.0f} us, {failed} invalid")
+    generation.upstream_pool = saved_pool
+
+
+# What each PROMPT_MODE sends and is billed for, on a fake model that spends input_seconds per
+# thousand input tokens it didn't have cached, a stand-in for prefill. "cached" runs twice: as
+# Gemini treats this prompt, which is under its minimum for caching, and as if it were allowed.
+def bench_prompt_modes(requests=200, latency=0.2, input_seconds=0.05):
+    from fake import FakeModel
+
+    class TalliedModel(FakeModel):
+        prompt_tokens = 0
+        cached_tokens = 0
+
+        def plan(self, prompt):
+            chunks, wait, error, usage = super().plan(prompt)
+            self.prompt_tokens += usage.prompt_token_count
+            self.cached_tokens += usage.cached_content_token_count
+            return chunks, wait, error, usage
+
+    async def one(description):
+        start = time.perf_counter()
+        await generation.generate_async(description)
+        return time.perf_counter() - start
+
+    async def run(descriptions):
+        return await asyncio.gather(*(one(description) for description in descriptions))
+
+    saved_pool, saved_mode, saved_hedger = generation.upstream_pool, generation.PROMPT_MODE, generation.hedger
+    # Hedged calls would be billed too, and blur the latencies
+    generation.hedger = Hedger(percentile=95, max_fraction=0)
+    for mode, min_cache_tokens in (("inline", 0), ("system", 0), ("cached", 32768), ("cached", 0)):
+        response_cache.clear()
+        generation.PROMPT_MODE = mode
+        model = use_model(TalliedModel(
+            latency=latency, chunk_seconds=0, seed=0, instructions=None if mode == "inline" else generation.INSTRUCTIONS,
+            cache_ttl=3600 if mode == "cached" else None, min_cache_tokens=min_cache_tokens, input_seconds=input_seconds))
+        descriptions = [f"prompt mode {mode} {min_cache_tokens} world {i}" for i in range(requests)]
+        start = time.perf_counter()
+        sent = sum(len(generation.build_prompt(description).encode()) for description in descriptions)
+        build = (time.perf_counter() - start) / requests
+        latencies = sorted(asyncio.run(run(descriptions)))
+        name = f"prompt {mode}" + (" (refused)" if min_cache_tokens else "")
+        print(f"{name:<24} {sent / requests:.0f} bytes sent per request, built in {build * 1e6:.1f} us, "
+              f"{model.prompt_tokens / requests:.0f} input tokens of which {model.cached_tokens / requests:.0f} cached, "
+              f"p50 {latencies[len(latencies) // 2] * 1000:.0f} ms")
+    generation.upstream_pool, generation.PROMPT_MODE, generation.hedger = saved_pool, saved_mode, saved_hedger
+
+
+# Preset-plus-overrides output must expand into exactly what full output validates to: every
+# synthesized world written as presets plus overrides comes back equal, and overrides as a model
+# would write them expand into worlds that validate without dropping a field and have every key
+# a full world has
+def bench_expansion(worlds=2000):
+    from fake import synthesize, synthesize_overrides
+    from presets import compact, expand
+
+    def shape(value):
+        if isinstance(value, dict):
+            return {key: shape(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [shape(item) for item in value[:1]]
+        return None
+
+    full_shape = shape(json.loads(schema.dump(schema.validate_data(synthesize(0)))))
+    mismatched = 0
+    elapsed = 0.0
+    for i in range(worlds):
+        world = synthesize(i)
+        full = json.loads(schema.dump(schema.validate_data(copy.deepcopy(world))))
+        compacted = compact(world)
+        start = time.perf_counter()
+        expanded = json.loads(schema.dump(schema.WorldInfo.model_validate(expand(compacted))))
+        elapsed += time.perf_counter() - start
+        mismatched += expanded != full
+        overrides = json.loads(schema.dump(schema.WorldInfo.model_validate(expand(synthesize_overrides(i)))))
+        mismatched += shape(overrides)["terrainsData"][0] != full_shape["terrainsData"][0]
+        mismatched += shape(overrides)["atmosphereGeneratorData"] != full_shape["atmosphereGeneratorData"]
+    verdict = "ok" if not mismatched else "FAIL"
+    print(f"{'preset expansion':<24} {worlds} worlds round tripped, {mismatched} mismatched, "
+          f"{elapsed / worlds * 1e6:.0f} us to expand and validate each {verdict}")
+
+
+# Output tokens and latency of each OUTPUT_MODE, on a fake model streaming about 200 tokens/s after
+# first_chunk seconds, roughly gemini-1.5-flash. The model writes SAMPLE_WORLD either way.
+def bench_output_modes(requests=100, first_chunk=0.5, chunk_seconds=0.25, worlds=500):
+    from fake import SAMPLE_WORLD, FakeModel, synthesize, synthesize_overrides
+    from presets import compact
+
+    async def one(description):
+        start = time.perf_counter()
+        await generation.generate_async(description)
+        return time.perf_counter() - start
+
+    async def run(descriptions):
+        return await asyncio.gather(*(one(description) for description in descriptions))
+
+    saved_pool, saved_mode, saved_hedger = generation.upstream_pool, generation.OUTPUT_MODE, generation.hedger
+    generation.hedger = Hedger(percentile=95, max_fraction=0)
+    for mode in ("full", "preset"):
+        response_cache.clear()
+        generation.OUTPUT_MODE = mode
+        model = use_model(FakeModel(latency=first_chunk, chunk_seconds=chunk_seconds, seed=0, compact=mode == "preset"))
+        # Descriptions the preset fast path can't answer
+        latencies = sorted(asyncio.run(run([f"output mode {mode} world {i}" for i in range(requests)])))
+        output = json.dumps(compact(SAMPLE_WORLD) if mode == "preset" else SAMPLE_WORLD, indent=2)
+        print(f"{'output ' + mode:<24} {len(output)} chars, about {len(output) // 4} output tokens, "
+              f"p50 {latencies[len(latencies) // 2] * 1000:.0f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.0f} ms")
+    generation.upstream_pool, generation.OUTPUT_MODE, generation.hedger = saved_pool, saved_mode, saved_hedger
+
+    full = sum(len(json.dumps(synthesize(i), indent=2)) for i in range(worlds))
+    overrides = sum(len(json.dumps(synthesize_overrides(i), indent=2)) for i in range(worlds))
+    print(f"{'output synthesized':<24} {full // worlds} chars in full, {overrides // worlds} as presets and a few overrides")
+
+
+def report(name, requests, elapsed, statuses):
+    ok = sum(1 for status in statuses if status == 200)
+    print(f"{name:<24} {requests} requests in {elapsed:.2f}s = {requests / elapsed:8.1f} req/s ({ok} ok)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Requests/sec of the sync and async servers at a fixed upstream latency")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=2.0, help="fake upstream latency in seconds")
+    parser.add_argument("--threads", type=int, default=16, help="worker threads for the sync server")
+    parser.add_argument("--similarity-entries", type=int, default=0, help="also time similarity lookups at this cache size")
+    parser.add_argument("--startup-budget", type=float, default=1.0, help="seconds server.py may take to answer /healthz")
+    parser.add_argument("--startup-only", action="store_true", help="only check the startup budget")
+    parser.add_argument("--serving-only", action="store_true", help="only compare the dev server with gunicorn")
+    parser.add_argument("--clients", type=int, default=32, help="keep-alive connections for the serving comparison")
+    parser.add_argument("--web-workers", type=int, default=os.cpu_count() or 1, help="gunicorn workers")
+    parser.add_argument("--cassette", help="also time handling the model output recorded in this cassette")
+    args = parser.parse_args()
+
+    # Exits non-zero when startup is over budget, so this can gate a build
+    startup_ok = bench_startup(args.startup_budget)
+    if args.startup_only:
+        sys.exit(0 if startup_ok else 1)
+    bench_serving(args.requests * 4, args.clients, args.web_workers)
+    if args.serving_only:
+        sys.exit(0 if startup_ok else 1)
+
+    # The benchmarks reuse descriptions and expect to reach the fake model after clearing the cache
+    generation.world_store = None
+    use_model(FixedLatencyModel(args.latency))
+    print(f"upstream latency {args.latency}s")
+
+    report(f"flask ({args.threads} threads)", args.requests, *bench_flask(args.requests, args.threads))
+    response_cache.clear()
+    report("asgi", args.requests, *bench_asgi(args.requests))
+    response_cache.clear()
+    bench_coalescing()
+    bench_batch(args.requests, args.latency)
+    bench_cache_hits(10000)
+    bench_bad_descriptions()
+    bench_upstream_errors()
+    bench_fast_path()
+    bench_validation()
+    bench_hedging()
+    bench_rate_limit()
+    bench_pool()
+    bench_metrics()
+    bench_compression()
+    bench_codec()
+    bench_world_ids()
+    bench_store()
+    bench_store_handoff()
+    bench_preload()
+    bench_prompt_modes()
+    bench_expansion()
+    bench_output_modes()
+    if args.similarity_entries:
+        bench_similarity(args.similarity_entries)
+    if args.cassette:
+        bench_replay(args.cassette)
+
+    sys.exit(0 if startup_ok else 1)
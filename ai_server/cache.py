@@ -0,0 +1,112 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Words that don't change the generated world. Negations ("no", "not", "dont", "without")
+# are deliberately kept since the prompt zeroes out modules for them.
+STOPWORDS = {
+    "a", "an", "the", "some", "of", "with", "please", "make", "me", "generate",
+    "create", "i", "want", "would", "like", "there", "is", "are", "that", "this",
+}
+
+PUNCTUATION = re.compile(r"[^\w\s]")
+APOSTROPHE = re.compile(r"['’]")
+
+
+def canonicalize(description):
+    # "Don't" and "dont" should land on the same key
+    text = APOSTROPHE.sub("", description.lower())
+    text = PUNCTUATION.sub(" ", text)
+    return " ".join(word for word in text.split() if word not in STOPWORDS)
+
+
+# Content-addressed id of a WorldInfo JSON, the same whichever way the world was answered
+def world_id(text):
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+# LRU cache of generated responses bounded by total size in bytes, with a TTL per entry
+class ResponseCache:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(value) if isinstance(value, bytes) else len(value.encode())
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "maxBytes": self.max_bytes,
+                "ttlSeconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get("CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.environ.get("CACHE_TTL_SECONDS", 24 * 60 * 60)),
+)
+
+# Worlds by world_id() for /worlds/<id>. They never change, so entries only leave when evicted.
+world_cache = ResponseCache(
+    max_bytes=int(os.environ.get("WORLD_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+    ttl=float("inf"),
+)
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+from fake import TokenCount, Usage
+
+# A cassette is a file of upstream calls, one JSON object per line: the model, the prompt and the
+# description in it, whether it was streamed, the seconds it took, each chunk's text with the
+# seconds since the call started, the token usage, and the error and its status code if it failed.
+
+
+# The description a prompt was built from, so a cassette still plays after the prompt changes
+def describe(prompt):
+    from generation import build_prompt
+
+    prefix, suffix = build_prompt("{description}").split("{description}")
+    if prompt.startswith(prefix) and prompt.endswith(suffix):
+        return prompt[len(prefix):len(prompt) - len(suffix)]
+    return None
+
+
+def usage_of(response):
+    usage = getattr(response, "usage_metadata", None)
+    if not getattr(usage, "prompt_token_count", 0):
+        return None
+    return {
+        "prompt_token_count": usage.prompt_token_count,
+        "candidates_token_count": usage.candidates_token_count,
+        "cached_content_token_count": getattr(usage, "cached_content_token_count", 0),
+    }
+
+
+class Replayed:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = Usage(**usage) if usage else None
+
+
+class ReplayedError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# Not in the cassette; 404 so the pool doesn't retry it elsewhere or eject the member for it
+class CassetteMiss(Exception):
+    code = 404
+
+
+class Cassette:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, interaction):
+        line = json.dumps(interaction) + "\n"
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+# Passes calls through to model, writing each one to the cassette once it has finished
+class Recorder:
+    def __init__(self, model, cassette, model_name):
+        self.model = model
+        self.cassette = cassette
+        self.model_name = model_name
+
+    def save(self, prompt, stream, started, chunks, usage, error=None):
+        interaction = {
+            "model": self.model_name,
+            "description": describe(prompt),
+            "prompt": prompt,
+            "stream": stream,
+            "seconds": time.perf_counter() - started,
+            "chunks": chunks,
+            "usage": usage,
+        }
+        if error is not None:
+            interaction["error"] = str(error)
+            interaction["code"] = getattr(error, "code", None)
+        self.cassette.write(interaction)
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.model.generate_content(prompt, stream=stream, **kwargs)
+        except Exception as e:
+            self.save(prompt, stream, started, [], None, e)
+            raise
+        if stream:
+            return self.record_stream(prompt, response, started)
+        self.save(prompt, False, started, [[time.perf_counter() - started, response.text]], usage_of(response))
+        return response
+
+    def record_stream(self, prompt, response, started):
+        chunks = []
+        usage = None
+        try:
+            for chunk in response:
+                chunks.append([time.perf_counter() - started, chunk.text])
+                usage = usage_of(chunk) or usage
+                yield chunk
+        except Exception as e:
+            self.save(prompt, True, started, chunks, usage, e)
+            raise
+        self.save(prompt, True, started, chunks, usage)
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.model.generate_content_async(prompt, stream=stream, **kwargs)
+        except Exception as e:
+            self.save(prompt, stream, started, [], None, e)
+            raise
+        if stream:
+            return self.record_stream_async(prompt, response, started)
+        self.save(prompt, False, started, [[time.perf_counter() - started, response.text]], usage_of(response))
+        return response
+
+    async def record_stream_async(self, prompt, response, started):
+        chunks = []
+        usage = None
+        try:
+            async for chunk in response:
+                chunks.append([time.perf_counter() - started, chunk.text])
+                usage = usage_of(chunk) or usage
+                yield chunk
+        except Exception as e:
+            self.save(prompt, True, started, chunks, usage, e)
+            raise
+        self.save(prompt, True, started, chunks, usage)
+
+    def count_tokens(self, contents):
+        return self.model.count_tokens(contents)
+
+
+# Answers calls from a cassette instead of the model: by the exact prompt if it was recorded, or
+# else by the description in it. Calls recorded more than once are played in turn. Answers and
+# each streamed chunk arrive after their recorded time multiplied by scale, so 0 answers straight
+# away. Recorded errors are raised again.
+class Player:
+    def __init__(self, path, scale=1.0):
+        self.path = path
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.by_prompt = {}
+        self.by_description = {}
+        self.interactions = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.add(json.loads(line))
+        self.played = 0
+        self.misses = 0
+
+    def add(self, interaction):
+        self.interactions.append(interaction)
+        self.by_prompt.setdefault(interaction["prompt"], deque()).append(interaction)
+        if interaction.get("description") is not None:
+            self.by_description.setdefault(interaction["description"], deque()).append(interaction)
+
+    def find(self, prompt):
+        interactions = self.by_prompt.get(prompt) or self.by_description.get(describe(prompt))
+        if not interactions:
+            self.misses += 1
+            raise CassetteMiss(f"no call in {self.path} for this prompt")
+        with self.lock:
+            interaction = interactions[0]
+            interactions.rotate(-1)
+            self.played += 1
+        return interaction
+
+    def failed(self, interaction):
+        if "error" in interaction:
+            return ReplayedError(interaction["error"], interaction.get("code"))
+        return None
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        interaction = self.find(prompt)
+        if stream:
+            return self.stream(interaction)
+        time.sleep(interaction["seconds"] * self.scale)
+        error = self.failed(interaction)
+        if error is not None:
+            raise error
+        return Replayed("".join(text for _, text in interaction["chunks"]), interaction["usage"])
+
+    def stream(self, interaction):
+        started = time.perf_counter()
+        chunks = interaction["chunks"]
+        for i, (at, text) in enumerate(chunks):
+            time.sleep(max(0.0, started + at * self.scale - time.perf_counter()))
+            yield Replayed(text, interaction["usage"] if i == len(chunks) - 1 else None)
+        error = self.failed(interaction)
+        if error is not None:
+            time.sleep(max(0.0, started + interaction["seconds"] * self.scale - time.perf_counter()))
+            raise error
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        interaction = self.find(prompt)
+        if stream:
+            return self.stream_async(interaction)
+        await asyncio.sleep(interaction["seconds"] * self.scale)
+        error = self.failed(interaction)
+        if error is not None:
+            raise error
+        return Replayed("".join(text for _, text in interaction["chunks"]), interaction["usage"])
+
+    async def stream_async(self, interaction):
+        started = time.perf_counter()
+        chunks = interaction["chunks"]
+        for i, (at, text) in enumerate(chunks):
+            await asyncio.sleep(max(0.0, started + at * self.scale - time.perf_counter()))
+            yield Replayed(text, interaction["usage"] if i == len(chunks) - 1 else None)
+        error = self.failed(interaction)
+        if error is not None:
+            await asyncio.sleep(max(0.0, started + interaction["seconds"] * self.scale - time.perf_counter()))
+            raise error
+
+    def count_tokens(self, contents):
+        return TokenCount(len(contents) // 4)
+
+    def stats(self):
+        return {"path": self.path, "interactions": len(self.interactions), "played": self.played, "misses": self.misses}
+
+
+# connect() for the upstream pool, recording the calls of the members connect() makes
+def recording(connect, path):
+    cassette = Cassette(path)
+    return lambda model_name, api_key: Recorder(connect(model_name, api_key), cassette, model_name)
+
+
+# connect() for the upstream pool, every member playing the same cassette
+def replaying(path, scale):
+    player = Player(path, scale)
+    return lambda model_name, api_key: player
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Coalesces concurrent calls with the same key into one: the first caller runs the
+# function, everyone who arrives while it is running waits for and shares its result
+# (or its exception). do() returns (result, shared).
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            shared = call is not None
+            if shared:
+                self.shared += 1
+            else:
+                call = self.calls[key] = Call()
+                self.executed += 1
+
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {"inFlight": len(self.calls), "executed": self.executed, "shared": self.shared}
+
+
+class Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+# asyncio version of SingleFlight. The shared call runs as its own task so one waiter
+# going away doesn't cancel it for the others; it is only cancelled once every waiter is gone.
+class AsyncSingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.executed = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    async def do(self, key, fn):
+        flight = self.flights.get(key)
+        shared = flight is not None
+        if shared:
+            self.shared += 1
+        else:
+            flight = self.flights[key] = Flight(asyncio.ensure_future(fn()))
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+            self.executed += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+                self.cancelled += 1
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self):
+        return {
+            "inFlight": len(self.flights),
+            "executed": self.executed,
+            "shared": self.shared,
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,241 @@
+import json
+import struct
+import sys
+import typing
+import zlib
+from array import array
+from typing import Annotated, List, Literal, Union
+
+from pydantic import BaseModel
+
+import schema
+
+# A compact binary WorldInfo for clients that send this in Accept. The layout follows the models
+# in schema.py field by field, with no names or tags, all little-endian:
+#
+#   header   "EZWI", u16 version, u16 reserved, u32 layout id
+#   int      i32
+#   float    f32, the precision Unity uses anyway
+#   bool     u8
+#   enum     u8 index into the Literal's options
+#   model    its fields in declaration order
+#   list     u32 count, then the items
+#   matrix   u32 rows, u32 columns, zero padding to a multiple of 4 bytes, then rows * columns f32
+#
+# The layout id is a CRC of the layout itself, so a decoder built for an older schema refuses
+# the data instead of misreading it. Matrices (heightMap) are raw aligned blocks, which decode()
+# returns as memoryviews into the buffer rather than copying.
+CONTENT_TYPE = "application/vnd.ezworld.worldinfo"
+MAGIC = b"EZWI"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+COUNT = struct.Struct("<I")
+MATRIX = struct.Struct("<II")
+
+
+class Writer:
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        return b"".join(self.parts)
+
+
+# Consecutive fixed size fields of a model, packed and unpacked with one struct call
+class Fields:
+    def __init__(self):
+        self.names = []
+        self.codes = ""
+        self.to_wire = []
+        self.from_wire = []
+
+    def add(self, name, code, to_wire=None, from_wire=None):
+        self.names.append(name)
+        self.codes += code
+        self.to_wire.append(to_wire)
+        self.from_wire.append(from_wire)
+
+    def compile(self):
+        self.struct = struct.Struct("<" + self.codes)
+        self.fields = list(zip(self.names, self.to_wire, self.from_wire))
+        return self
+
+    def encode(self, data, writer):
+        writer.write(self.struct.pack(*[data[name] if to_wire is None else to_wire(data[name])
+                                        for name, to_wire, _ in self.fields]))
+
+    def decode(self, buffer, offset, data):
+        for (name, _, from_wire), value in zip(self.fields, self.struct.unpack_from(buffer, offset)):
+            data[name] = value if from_wire is None else from_wire(value)
+        return offset + self.struct.size
+
+    def layout(self):
+        return ",".join(f"{name}:{code}" for name, code in zip(self.names, self.codes))
+
+
+class ModelCodec:
+    def __init__(self, model):
+        self.name = model.__name__
+        # Runs of Fields, and (name, codec) for lists, nested models and matrices
+        self.steps = []
+        fields = None
+        for name, field in model.model_fields.items():
+            scalar = scalar_field(field.annotation)
+            if scalar is not None:
+                if fields is None:
+                    fields = Fields()
+                    self.steps.append(fields)
+                fields.add(name, *scalar)
+            else:
+                fields = None
+                self.steps.append((name, field_codec(field.annotation)))
+        for step in self.steps:
+            if isinstance(step, Fields):
+                step.compile()
+
+    def encode(self, data, writer):
+        for step in self.steps:
+            if isinstance(step, Fields):
+                step.encode(data, writer)
+            else:
+                name, codec = step
+                codec.encode(data.get(name), writer)
+
+    def decode(self, buffer, offset):
+        data = {}
+        for step in self.steps:
+            if isinstance(step, Fields):
+                offset = step.decode(buffer, offset, data)
+            else:
+                name, codec = step
+                value, offset = codec.decode(buffer, offset)
+                if value is not None:
+                    data[name] = value
+        return data, offset
+
+    def layout(self):
+        return self.name + "{" + ",".join(
+            step.layout() if isinstance(step, Fields) else f"{step[0]}:{step[1].layout()}" for step in self.steps) + "}"
+
+
+class ListCodec:
+    def __init__(self, item):
+        self.item = item
+
+    def encode(self, items, writer):
+        writer.write(COUNT.pack(len(items)))
+        for item in items:
+            self.item.encode(item, writer)
+
+    def decode(self, buffer, offset):
+        count, = COUNT.unpack_from(buffer, offset)
+        offset += COUNT.size
+        items = []
+        for i in range(count):
+            item, offset = self.item.decode(buffer, offset)
+            items.append(item)
+        return items, offset
+
+    def layout(self):
+        return "[" + self.item.layout() + "]"
+
+
+class MatrixCodec:
+    def encode(self, rows, writer):
+        rows = rows or []
+        columns = len(rows[0]) if rows else 0
+        writer.write(MATRIX.pack(len(rows), columns))
+        writer.write(bytes(-writer.size % 4))
+        values = array("f", [value for row in rows for value in row])
+        if sys.byteorder == "big":
+            values.byteswap()
+        writer.write(values.tobytes())
+
+    def decode(self, buffer, offset):
+        rows, columns = MATRIX.unpack_from(buffer, offset)
+        offset += MATRIX.size
+        offset += -offset % 4
+        if not rows or not columns:
+            return None, offset
+        end = offset + rows * columns * 4
+        # memoryviews read native order, which is little-endian on every platform the game ships on
+        return memoryview(buffer).cast("B")[offset:end].cast("f", (rows, columns)), end
+
+    def layout(self):
+        return "f32[,]"
+
+
+def unwrap(annotation):
+    while typing.get_origin(annotation) is Annotated:
+        annotation = typing.get_args(annotation)[0]
+    # Optional[X] is X, with an empty value standing in for None
+    if typing.get_origin(annotation) is Union:
+        annotation = next(arg for arg in typing.get_args(annotation) if arg is not type(None))
+        return unwrap(annotation)
+    return annotation
+
+
+# (struct code, to_wire, from_wire) for fixed size fields, None for the rest
+def scalar_field(annotation):
+    annotation = unwrap(annotation)
+    if annotation is bool:
+        return "?", None, None
+    if annotation is int:
+        return "i", None, None
+    if annotation is float:
+        return "f", None, None
+    if typing.get_origin(annotation) is Literal:
+        options = typing.get_args(annotation)
+        indices = {option: i for i, option in enumerate(options)}
+        return "B", indices.__getitem__, options.__getitem__
+    return None
+
+
+def field_codec(annotation):
+    annotation = unwrap(annotation)
+    if typing.get_origin(annotation) in (list, List):
+        item = unwrap(typing.get_args(annotation)[0])
+        if typing.get_origin(item) in (list, List):
+            return MatrixCodec()
+        return ListCodec(field_codec(item))
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return ModelCodec(annotation)
+    raise TypeError(f"No binary layout for {annotation}")
+
+
+WORLD = ModelCodec(schema.WorldInfo)
+LAYOUT = WORLD.layout()
+LAYOUT_ID = zlib.crc32(LAYOUT.encode())
+
+
+# data is a WorldInfo as parsed from its JSON, e.g. json.loads(schema.dump(world))
+def encode(data):
+    writer = Writer()
+    writer.write(HEADER.pack(MAGIC, VERSION, 0, LAYOUT_ID))
+    WORLD.encode(data, writer)
+    return writer.getvalue()
+
+
+def encode_text(text):
+    return encode(json.loads(text))
+
+
+def decode(buffer):
+    magic, version, _, layout_id = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError("Not a binary WorldInfo")
+    if layout_id != LAYOUT_ID:
+        raise ValueError(f"WorldInfo layout {layout_id:08x} (version {version}) doesn't match this schema's {LAYOUT_ID:08x}")
+    data, _ = WORLD.decode(buffer, HEADER.size)
+    return data
+
+
+if __name__ == '__main__':
+    # The layout id the C# reader has to be updated to whenever schema.py changes
+    print(f"version {VERSION}, layout id 0x{LAYOUT_ID:08x}")
+    print(LAYOUT)
@@ -0,0 +1,200 @@
+import os
+import time
+import zlib
+
+from cache import ResponseCache
+from metrics import compression_cache, compression_ratio, compression_seconds
+
+# Optional: used when installed and asked for, otherwise gzip or deflate
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Smaller responses gain little and can even grow
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+
+COMPRESSIBLE = {
+    "application/json", "application/x-ndjson", "text/event-stream", "text/html", "text/plain", "text/css",
+    "application/javascript", "application/vnd.ezworld.worldinfo",
+}
+
+
+class Zlib:
+    def __init__(self, wbits, level=6):
+        self.wbits = wbits
+        self.level = level
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self):
+        return ZlibStream(zlib.compressobj(self.level, zlib.DEFLATED, self.wbits))
+
+
+# Each write is flushed so a streamed event reaches the client as soon as it is sent
+class ZlibStream:
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    def write(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        return self.compressor.flush()
+
+
+class Brotli:
+    def __init__(self, quality=5):
+        self.quality = quality
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.quality)
+
+    def stream(self):
+        return BrotliStream(brotli.Compressor(quality=self.quality))
+
+
+class BrotliStream:
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    def write(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def close(self):
+        return self.compressor.finish()
+
+
+class Zstd:
+    def __init__(self, level=3):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def stream(self):
+        return ZstdStream(self.compressor.compressobj())
+
+
+class ZstdStream:
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    def write(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def close(self):
+        return self.compressor.flush()
+
+
+# In order of preference when the client accepts several. HTTP's "deflate" is zlib wrapped.
+ENCODINGS = {}
+if zstandard is not None:
+    ENCODINGS["zstd"] = Zstd()
+if brotli is not None:
+    ENCODINGS["br"] = Brotli()
+ENCODINGS["gzip"] = Zlib(wbits=31)
+ENCODINGS["deflate"] = Zlib(wbits=15)
+
+
+# The preferred encoding the client accepts, or None to send the response as it is
+def negotiate(accept_encoding):
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def compressible(content_type):
+    return content_type is not None and content_type.split(";")[0].strip().lower() in COMPRESSIBLE
+
+
+# Compressed bytes of responses with a strong ETag, e.g. worlds by id, so a world served again
+# isn't compressed again (binary worlds from codec.py are kept here too). The ETag is the
+# world's hash, so entries never go stale.
+compressed_cache = ResponseCache(
+    max_bytes=int(os.environ.get("COMPRESSED_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+    ttl=float("inf"),
+)
+
+
+def compress(body, encoding, etag=None):
+    key = (etag, encoding)
+    compressed = compressed_cache.get(key) if etag else None
+    if compressed is None:
+        compression_cache.inc("miss" if etag else "uncached")
+        start = time.thread_time()
+        compressed = ENCODINGS[encoding].compress(body)
+        compression_seconds.observe(time.thread_time() - start, encoding)
+        if etag:
+            compressed_cache.put(key, compressed)
+    else:
+        compression_cache.inc("hit")
+    compression_ratio.observe(len(compressed) / len(body), encoding)
+    return compressed
+
+
+# Compresses a response sent in several chunks, e.g. server-sent events
+class CompressedStream:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.stream = ENCODINGS[encoding].stream()
+        self.original = 0
+        self.sent = 0
+        self.cpu = 0.0
+
+    def write(self, chunk):
+        start = time.thread_time()
+        data = self.stream.write(chunk)
+        self.cpu += time.thread_time() - start
+        self.original += len(chunk)
+        self.sent += len(data)
+        return data
+
+    def close(self):
+        data = self.stream.close()
+        self.sent += len(data)
+        if self.original:
+            compression_seconds.observe(self.cpu, self.encoding)
+            compression_ratio.observe(self.sent / self.original, self.encoding)
+        return data
+
+
+# Compresses an iterable of chunks (str or bytes), e.g. a streamed Flask body
+def compress_stream(chunks, encoding):
+    stream = CompressedStream(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield stream.write(chunk)
+        yield stream.close()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+# The ETag of a compressed response names its encoding too, as it is a different representation
+def encoded_etag(etag, encoding):
+    return etag[:-1] + "-" + encoding + '"'
@@ -0,0 +1,314 @@
+import asyncio
+import json
+import math
+import os
+import random
+import time
+
+import presets
+import schema
+from promptcache import ContextCache
+
+# What the model typically sends back for a two terrain description
+SAMPLE_WORLD = {
+    "terrainsData": [
+        {
+            "heightsGeneratorData": {
+                "width": 1024, "height": 1024, "depth": 180, "octaves": 8, "scale": 250.0, "lacunarity": 2.5,
+                "persistence": 0.15, "heightCurve": "easeIn", "heightCurveOffset": 8000.0, "falloffDirection": 2.0,
+                "falloffRange": 3.0, "useFalloffMap": True, "randomize": True, "autoUpdate": True,
+            },
+            "texturesGeneratorDataList": [
+                {"texture": "snow", "heightCurve": "easeIn", "tileSizeX": 20.0, "tileSizeY": 20.0},
+                {"texture": "rock", "heightCurve": "linear", "tileSizeX": 12.0, "tileSizeY": 15.0},
+            ],
+            "treeGeneratorData": {
+                "octaves": 3, "scale": 40.0, "lacunarity": 2.0, "persistence": 0.5, "offset": 4000.0, "minLevel": 10.0,
+                "maxLevel": 60.0, "maxSteepness": 40.0, "islandSize": 0.5, "density": 0.1, "randomize": True,
+                "treePrototypes": 3,
+            },
+            "grassGeneratorData": {
+                "octaves": 0, "scale": 0.0, "lacunarity": 0.0, "persistence": 0.0, "offset": 1000.0, "minLevel": -100.0,
+                "maxLevel": 100.0, "maxSteepness": 50.0, "islandSize": 0.5, "density": 0.0, "randomize": False,
+                "grassTextures": 0,
+            },
+            "waterGeneratorData": {
+                "waterType": "none", "waterLevel": 0.0, "riverWidthRange": {"x": 100.0, "y": 500.0},
+                "randomize": False, "autoUpdate": True,
+            },
+        },
+        {
+            "heightsGeneratorData": {
+                "width": 1024, "height": 1024, "depth": 70, "octaves": 3, "scale": 400.0, "lacunarity": 1.5,
+                "persistence": 0.05, "heightCurve": "linear", "heightCurveOffset": 6000.0, "falloffDirection": 1.0,
+                "falloffRange": 1.0, "useFalloffMap": True, "randomize": True, "autoUpdate": True,
+            },
+            "texturesGeneratorDataList": [
+                {"texture": "grass", "heightCurve": "constant", "tileSizeX": 10.0, "tileSizeY": 10.0},
+                {"texture": "dirt", "heightCurve": "easeOut", "tileSizeX": 8.0, "tileSizeY": 9.0},
+            ],
+            "treeGeneratorData": {
+                "octaves": 4, "scale": 60.0, "lacunarity": 2.0, "persistence": 0.5, "offset": 3000.0, "minLevel": 0.0,
+                "maxLevel": 100.0, "maxSteepness": 45.0, "islandSize": 1.0, "density": 0.3, "randomize": True,
+                "treePrototypes": 5,
+            },
+            "grassGeneratorData": {
+                "octaves": 3, "scale": 20.0, "lacunarity": 2.0, "persistence": 0.5, "offset": 5000.0, "minLevel": -150.0,
+                "maxLevel": 150.0, "maxSteepness": 70.0, "islandSize": 0.8, "density": 0.9, "randomize": True,
+                "grassTextures": 6,
+            },
+            "waterGeneratorData": {
+                "waterType": "lake", "waterLevel": 20.0, "riverWidthRange": {"x": 100.0, "y": 400.0},
+                "randomize": True, "autoUpdate": True,
+            },
+        },
+    ],
+    "objectList": [
+        {"name": "Brick House", "x": 300.0, "y": 420.0, "Rx": 0.0, "Ry": 90.0, "Rz": 0.0, "scale": 1.0},
+        {"name": "Small House", "x": 350.0, "y": 480.0, "Rx": 0.0, "Ry": 45.0, "Rz": 0.0, "scale": 1.0},
+        {"name": "Small House", "x": 390.0, "y": 410.0, "Rx": 0.0, "Ry": 180.0, "Rz": 0.0, "scale": 1.2},
+        {"name": "Ferris Wheel", "x": 600.0, "y": 600.0, "Rx": 0.0, "Ry": 0.0, "Rz": 0.0, "scale": 2.0},
+    ],
+    "atmosphereGeneratorData": {
+        "timeOfDay": 14.0, "sunSize": 0.05, "skyTint": {"r": 0.5, "g": 0.55, "b": 0.6}, "atmosphericThickness": 1.0,
+        "exposure": 1.3, "fogIntensity": 0.02, "fogColor": {"r": 0.7, "g": 0.7, "b": 0.75},
+    },
+}
+
+# As it comes back from a model asked for free text
+SAMPLE_RESPONSE = "```json\n" + json.dumps(SAMPLE_WORLD, indent=2) + "\n```"
+
+
+class FixedResponse:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class Usage:
+    def __init__(self, prompt_token_count, candidates_token_count, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+
+
+class TokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+# Carries a status code like the Google API errors, so the pool treats it the same way
+class FakeUpstreamError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} fake upstream error")
+        self.code = code
+
+
+# A random but plausible world, within the ranges the prompt asks for; the same for the same seed
+def synthesize(seed):
+    rng = random.Random(seed)
+
+    def terrain():
+        return {
+            "heightsGeneratorData": {
+                "width": 1024, "height": 1024, "depth": rng.randint(65, 200), "octaves": rng.randint(1, 15),
+                "scale": round(rng.uniform(70, 500), 1), "lacunarity": round(rng.uniform(1, 5), 2),
+                "persistence": round(rng.uniform(0, 0.2), 3), "heightCurve": rng.choice(schema.HEIGHT_CURVES),
+                "heightCurveOffset": round(rng.uniform(5000, 12000)), "falloffDirection": round(rng.uniform(1, 4), 2),
+                "falloffRange": round(rng.uniform(1, 4), 2), "useFalloffMap": rng.random() < 0.8,
+                "randomize": rng.random() < 0.5, "autoUpdate": True,
+            },
+            "texturesGeneratorDataList": [
+                {"texture": texture, "heightCurve": rng.choice(schema.HEIGHT_CURVES),
+                 "tileSizeX": round(rng.uniform(1, 50), 1), "tileSizeY": round(rng.uniform(1, 50), 1)}
+                for texture in rng.sample(schema.TEXTURES, rng.randint(1, 3))
+            ],
+            "treeGeneratorData": {
+                "octaves": rng.randint(0, 10), "scale": round(rng.uniform(0, 100), 1), "lacunarity": round(rng.uniform(1, 3), 2),
+                "persistence": round(rng.random(), 2), "offset": round(rng.uniform(0, 5000)),
+                "minLevel": round(rng.uniform(0, 30), 1), "maxLevel": round(rng.uniform(30, 100), 1),
+                "maxSteepness": round(rng.uniform(20, 90), 1), "islandSize": round(rng.uniform(-1, 1), 2),
+                "density": round(rng.random(), 2), "randomize": rng.random() < 0.5, "treePrototypes": rng.randint(0, 10),
+            },
+            "grassGeneratorData": {
+                "octaves": rng.randint(0, 4), "scale": round(rng.uniform(0, 50), 1), "lacunarity": round(rng.uniform(1, 3), 2),
+                "persistence": round(rng.random(), 2), "offset": round(rng.uniform(0, 5000)),
+                "minLevel": round(rng.uniform(-200, 0), 1), "maxLevel": round(rng.uniform(0, 200), 1),
+                "maxSteepness": round(rng.uniform(20, 90), 1), "islandSize": round(rng.uniform(-1, 1), 2),
+                "density": round(rng.random(), 2), "randomize": rng.random() < 0.5, "grassTextures": rng.randint(0, 10),
+            },
+            "waterGeneratorData": {
+                "waterType": rng.choice(schema.WATER_TYPES), "waterLevel": round(rng.uniform(0, 50), 1),
+                "riverWidthRange": {"x": round(rng.uniform(50, 700)), "y": round(rng.uniform(50, 700))},
+                "randomize": rng.random() < 0.5, "autoUpdate": True,
+            },
+        }
+
+    def color():
+        return {"r": round(rng.random(), 2), "g": round(rng.random(), 2), "b": round(rng.random(), 2)}
+
+    return {
+        "terrainsData": [terrain() for _ in range(rng.randint(1, 3))],
+        "objectList": [
+            {"name": rng.choice(sorted(schema.OBJECT_SET)), "x": round(rng.uniform(0, 1024)), "y": round(rng.uniform(0, 1024)),
+             "Rx": 0.0, "Ry": round(rng.uniform(0, 360)), "Rz": 0.0, "scale": round(rng.uniform(0.5, 2), 1)}
+            for _ in range(rng.randint(0, 6))
+        ],
+        "atmosphereGeneratorData": {
+            "timeOfDay": round(rng.uniform(0, 24), 1), "sunSize": round(rng.uniform(0.01, 0.1), 3), "skyTint": color(),
+            "atmosphericThickness": round(rng.uniform(0.5, 2), 2), "exposure": round(rng.uniform(0.5, 2), 2),
+            "fogIntensity": round(rng.uniform(0, 0.1), 3), "fogColor": color(),
+        },
+    }
+
+
+# What a model asked for preset-plus-overrides output might write for the same seed: a preset for
+# each of synthesize()'s terrains and its atmosphere, and a few of their values
+def synthesize_overrides(seed):
+    rng = random.Random(seed)
+    world = synthesize(seed)
+
+    def overrides(section):
+        picked = {}
+        for name in rng.sample(sorted(section), rng.randint(1, 2)):
+            value = section[name]
+            if isinstance(value, dict):
+                value = {key: value[key] for key in rng.sample(sorted(value), min(len(value), rng.randint(1, 3)))}
+            picked[name] = value
+        return {"preset": rng.choice(sorted(presets.PRESETS)), **picked}
+
+    world["terrainsData"] = [overrides(terrain) for terrain in world["terrainsData"]]
+    world["atmosphereGeneratorData"] = overrides(world["atmosphereGeneratorData"])
+    return world
+
+
+# Stands in for a Gemini model so the server can be load tested offline, without spending quota.
+# Calls take latency seconds, spread log-normally by sigma, except slow_fraction of them which take
+# slow_seconds, and error_rate of them fail with error_code (429 to run out of quota). Answers are
+# split into chunks of chunk_chars: streamed ones arrive chunk_seconds apart after that wait, and
+# the rest take as long as a stream would. The world is SAMPLE_WORLD for output "canned", made up
+# from the prompt for "synthesized", or else one of the worlds in the JSON file output names.
+# With compact, they are written as presets plus overrides (OUTPUT_MODE=preset).
+# Input tokens, reported in the usage like Gemini does, add input_seconds per thousand to the
+# wait unless they come from the cached context, which stands in for Gemini's context caching
+# with cache_ttl set, refusing instructions under min_cache_tokens like Gemini does.
+class FakeModel:
+    def __init__(self, latency=1.0, sigma=0.0, slow_fraction=0.0, slow_seconds=10.0, error_rate=0.0, error_code=503,
+                 chunk_seconds=0.02, chunk_chars=200, output="canned", seed=None, instructions=None, cache_ttl=None,
+                 min_cache_tokens=0, input_seconds=0.0, compact=False):
+        self.latency = latency
+        self.sigma = sigma
+        self.slow_fraction = slow_fraction
+        self.slow_seconds = slow_seconds
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.chunk_seconds = chunk_seconds
+        self.chunk_chars = chunk_chars
+        self.rng = random.Random(seed)
+        self.worlds = None
+        if output == "canned":
+            self.worlds = [SAMPLE_WORLD]
+        elif output != "synthesized":
+            with open(output, encoding="utf-8") as f:
+                worlds = json.load(f)
+            self.worlds = worlds if isinstance(worlds, list) else [worlds]
+        self.compact = compact
+        if compact and self.worlds is not None:
+            self.worlds = [presets.compact(world) for world in self.worlds]
+        self.instructions = instructions
+        self.min_cache_tokens = min_cache_tokens
+        self.input_seconds = input_seconds
+        self.context = ContextCache(self.create_context, instructions, cache_ttl) if instructions and cache_ttl else None
+        self.calls = 0
+        self.errors = 0
+
+    def create_context(self, display_name, ttl):
+        if len(self.instructions) // 4 < self.min_cache_tokens:
+            raise FakeUpstreamError(400)
+        return f"cachedContents/{display_name}", time.time() + ttl
+
+    # (chunks of the answer, seconds until the first, error to raise instead or None, usage)
+    def plan(self, prompt):
+        self.calls += 1
+        instruction_tokens = len(self.instructions) // 4 if self.instructions else 0
+        cached_tokens = instruction_tokens if self.context is not None and self.context.current() else 0
+        prompt_tokens = len(prompt) // 4 + instruction_tokens
+        if self.worlds is None:
+            world = synthesize_overrides(prompt) if self.compact else synthesize(prompt)
+        else:
+            world = self.worlds[self.rng.randrange(len(self.worlds))]
+        text = json.dumps(world, indent=2)
+        chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        if self.rng.random() < self.slow_fraction:
+            wait = self.slow_seconds
+        else:
+            wait = self.latency * math.exp(self.rng.normalvariate(0, self.sigma)) if self.sigma else self.latency
+        wait += self.input_seconds * (prompt_tokens - cached_tokens) / 1000
+        error = None
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            error = FakeUpstreamError(self.error_code)
+        return chunks, wait, error, Usage(prompt_tokens, len(text) // 4, cached_tokens)
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        chunks, wait, error, usage = self.plan(prompt)
+        if stream:
+            return self.stream(chunks, wait, error, usage)
+        time.sleep(wait + self.chunk_seconds * (len(chunks) - 1))
+        if error is not None:
+            raise error
+        return FixedResponse("".join(chunks), usage)
+
+    # The last chunk carries the usage, as Gemini's does
+    def stream(self, chunks, wait, error, usage):
+        time.sleep(wait)
+        if error is not None:
+            raise error
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self.chunk_seconds)
+            yield FixedResponse(chunk, usage if i == len(chunks) - 1 else None)
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        chunks, wait, error, usage = self.plan(prompt)
+        if stream:
+            return self.stream_async(chunks, wait, error, usage)
+        await asyncio.sleep(wait + self.chunk_seconds * (len(chunks) - 1))
+        if error is not None:
+            raise error
+        return FixedResponse("".join(chunks), usage)
+
+    async def stream_async(self, chunks, wait, error, usage):
+        await asyncio.sleep(wait)
+        if error is not None:
+            raise error
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(self.chunk_seconds)
+            yield FixedResponse(chunk, usage if i == len(chunks) - 1 else None)
+
+    def count_tokens(self, contents):
+        return TokenCount(len(contents) // 4)
+
+
+# Used by generation.py in place of Gemini when FAKE_UPSTREAM is set, configured by FAKE_UPSTREAM_*
+def connect(model_name, api_key, instructions=None, cache_ttl=None, compact=False):
+    seed = os.environ.get("FAKE_UPSTREAM_SEED")
+    return FakeModel(
+        latency=float(os.environ.get("FAKE_UPSTREAM_LATENCY", 1.0)),
+        sigma=float(os.environ.get("FAKE_UPSTREAM_SIGMA", 0.3)),
+        slow_fraction=float(os.environ.get("FAKE_UPSTREAM_SLOW_FRACTION", 0)),
+        slow_seconds=float(os.environ.get("FAKE_UPSTREAM_SLOW_SECONDS", 10)),
+        error_rate=float(os.environ.get("FAKE_UPSTREAM_ERROR_RATE", 0)),
+        error_code=int(os.environ.get("FAKE_UPSTREAM_ERROR_CODE", 503)),
+        chunk_seconds=float(os.environ.get("FAKE_UPSTREAM_CHUNK_SECONDS", 0.02)),
+        chunk_chars=int(os.environ.get("FAKE_UPSTREAM_CHUNK_CHARS", 200)),
+        output=os.environ.get("FAKE_UPSTREAM_OUTPUT", "canned"),
+        seed=f"{seed}/{model_name}/{api_key}" if seed is not None else None,
+        instructions=instructions,
+        cache_ttl=cache_ttl,
+        # Gemini 1.5 won't cache fewer than 32,768 tokens
+        min_cache_tokens=int(os.environ.get("FAKE_UPSTREAM_MIN_CACHE_TOKENS", 32768)),
+        input_seconds=float(os.environ.get("FAKE_UPSTREAM_INPUT_SECONDS_PER_1K", 0)),
+        compact=compact,
+    )
@@ -0,0 +1,975 @@
+import os
+from dotenv import load_dotenv
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+import cassette
+import fake
+import schema
+from metrics import generations_total, in_flight, record_tokens, response_bytes
+from cache import canonicalize, response_cache, world_cache, world_id
+from coalesce import AsyncSingleFlight, SingleFlight
+from hedging import hedger
+from pool import Member, UpstreamPool, outcome
+from presets import PRESETS, expand, expand_section, fast_path, overrides_schema
+from promptcache import ContextCache
+from ratelimit import RateLimited, make_limiter
+from similarity import similarity_cache
+from store import SHARED_LEASE_SECONDS, SHARED_POLL_SECONDS, SHARED_STATE, world_store
+from streaming import SectionParser
+from tracing import span, stage
+
+# Load environment variables
+load_dotenv()
+
+
+def split(names):
+    return [name.strip() for name in names.split(",") if name.strip()]
+
+
+# Every API key is paired with every model, and each pair is a member of the upstream pool.
+# Without a key the client falls back to GOOGLE_API_KEY or application default credentials.
+API_KEYS = split(os.environ.get("API_KEYS") or os.environ.get("API_KEY") or "") or [None]
+MODEL_NAMES = split(os.environ.get("MODEL_NAMES") or os.environ.get("MODEL_NAME") or "gemini-1.5-flash")
+# Answer with fake.FakeModel instead of calling Gemini, for load testing offline (see loadtest.py)
+FAKE_UPSTREAM = os.environ.get("FAKE_UPSTREAM", "0").lower() in ("1", "true", "yes")
+# Write every upstream call to a cassette file, or answer them all from one (see cassette.py);
+# the replay latency is the recorded one multiplied by CASSETTE_LATENCY_SCALE
+CASSETTE_RECORD = os.environ.get("CASSETTE_RECORD") or None
+CASSETTE_REPLAY = os.environ.get("CASSETTE_REPLAY") or None
+CASSETTE_LATENCY_SCALE = float(os.environ.get("CASSETTE_LATENCY_SCALE", 1))
+# Part of the cache key, so worlds made by one set of models aren't served for another
+MODEL_NAME = ("fake:" if FAKE_UPSTREAM else "replay:" if CASSETTE_REPLAY else "") + ",".join(MODEL_NAMES)
+
+# How the instructions, i.e. all of the prompt but the description, reach the model: "inline" in
+# every request, "system" as the system instruction, or "cached" stored upstream once as a cached
+# context that requests refer to, kept for PROMPT_CACHE_TTL_SECONDS at a time (see promptcache.py)
+PROMPT_MODE = os.environ.get("PROMPT_MODE", "system")
+PROMPT_CACHE_TTL_SECONDS = int(os.environ.get("PROMPT_CACHE_TTL_SECONDS", 3600))
+
+# What the model writes: "full", every value of every generator, or "preset", a preset from the
+# library in presets.py for each terrain and the atmosphere plus only the values that differ,
+# which the server expands into the same full WorldInfo
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "full")
+
+# Ask for JSON matching the WorldInfo schema instead of free text, unless turned off for models without support
+STRUCTURED_OUTPUT = os.environ.get("STRUCTURED_OUTPUT", "1").lower() in ("1", "true", "yes")
+
+generation_config = None
+if STRUCTURED_OUTPUT:
+    generation_config = {
+        "response_mime_type": "application/json",
+        "response_schema": schema.response_schema() if OUTPUT_MODE == "full" else overrides_schema(),
+    }
+
+# Warm the client up in the background at startup; retried at this interval until it succeeds
+WARMUP = os.environ.get("WARMUP", "1").lower() in ("1", "true", "yes")
+WARMUP_RETRY_SECONDS = float(os.environ.get("WARMUP_RETRY_SECONDS", 5))
+
+# Set once the client exists and a call to the API has succeeded
+ready = threading.Event()
+warmup_error = None
+
+
+# A Gemini model on its own API key. genai.configure() sets one key for the whole process, so
+# each member gets clients of its own; the async one is made on first use, inside the event
+# loop that will use it. google.generativeai and its gRPC/protobuf stack take most of a second
+# to import, so they are only loaded when a member is first needed (or by the warm-up thread).
+# Given instructions, they go as the system instruction, or with cache_ttl in a cached context.
+class KeyedModel:
+    def __init__(self, model_name, api_key, instructions=None, cache_ttl=None):
+        import google.generativeai as genai
+        from google.generativeai.client import _ClientManager
+
+        self.genai = genai
+        self.model_name = model_name
+        self.instructions = instructions
+        self.clients = _ClientManager()
+        self.clients.configure(api_key=api_key)
+        self.client = self.clients.make_client("generative")
+        self.async_client = None
+        self.model = self.make_model(system_instruction=instructions)
+        self.context = ContextCache(self.create_context, instructions, cache_ttl) if instructions and cache_ttl else None
+        # (name of the cached context, model using it)
+        self.cached = (None, None)
+
+    def make_model(self, **kwargs):
+        model = self.genai.GenerativeModel(self.model_name, generation_config=generation_config, **kwargs)
+        model._client = self.client
+        model._async_client = self.async_client
+        return model
+
+    # Reuses a context another worker made for the same instructions if it has a while left
+    def create_context(self, display_name, ttl):
+        from google.generativeai import caching, protos
+
+        client = self.clients.make_client("cache")
+        for cached in client.list_cached_contents(protos.ListCachedContentsRequest()):
+            expires = cached.expire_time.timestamp()
+            if cached.display_name == display_name and cached.model == self.model.model_name and expires > time.time() + ttl / 2:
+                return cached.name, expires
+        request = caching.CachedContent._prepare_create_request(
+            self.model.model_name, display_name=display_name, system_instruction=self.instructions, ttl=ttl)
+        cached = client.create_cached_content(request)
+        return cached.name, cached.expire_time.timestamp()
+
+    # The model referring to the cached context if there is one, else the one with the system instruction
+    def current(self):
+        name = self.context.current() if self.context is not None else None
+        if name is None:
+            return self.model
+        if self.cached[0] != name:
+            model = self.make_model()
+            model._cached_content = name
+            self.cached = (name, model)
+        return self.cached[1]
+
+    # A context that has gone before its time is made again for the next call
+    def lost_context(self, model, error):
+        name = getattr(model, "_cached_content", None)
+        if name is not None and getattr(error, "code", None) == 404:
+            self.context.invalidate(name)
+
+    def generate_content(self, prompt, **kwargs):
+        model = self.current()
+        try:
+            return model.generate_content(prompt, **kwargs)
+        except Exception as e:
+            self.lost_context(model, e)
+            raise
+
+    async def generate_content_async(self, prompt, **kwargs):
+        if self.async_client is None:
+            self.async_client = self.clients.make_client("generative_async")
+        if self.context is not None and self.context.due():
+            model = await asyncio.to_thread(self.current)
+        else:
+            model = self.current()
+        model._async_client = self.async_client
+        try:
+            return await model.generate_content_async(prompt, **kwargs)
+        except Exception as e:
+            self.lost_context(model, e)
+            raise
+
+    def count_tokens(self, contents):
+        return self.model.count_tokens(contents)
+
+
+# Makes the client for a pool member from its model name and API key, giving it the prompt's
+# instructions unless they go inline
+def connect_model(model_name, api_key):
+    instructions = None if PROMPT_MODE == "inline" else INSTRUCTIONS
+    cache_ttl = PROMPT_CACHE_TTL_SECONDS if PROMPT_MODE == "cached" else None
+    if FAKE_UPSTREAM:
+        return fake.connect(model_name, api_key, instructions, cache_ttl, compact=OUTPUT_MODE != "full")
+    return KeyedModel(model_name, api_key, instructions, cache_ttl)
+
+
+connect_upstream = connect_model
+if CASSETTE_REPLAY:
+    connect_upstream = cassette.replaying(CASSETTE_REPLAY, CASSETTE_LATENCY_SCALE)
+elif CASSETTE_RECORD:
+    connect_upstream = cassette.recording(connect_upstream, CASSETTE_RECORD)
+
+upstream_pool = UpstreamPool(
+    [Member(model_name if len(API_KEYS) == 1 else f"{model_name}/key{i}", model_name, api_key, make_limiter(),
+            connect_upstream)
+     for i, api_key in enumerate(API_KEYS, 1) for model_name in MODEL_NAMES],
+    attempts=int(os.environ.get("UPSTREAM_ATTEMPTS", 2)),
+    weight=float(os.environ.get("UPSTREAM_EWMA_WEIGHT", 0.2)),
+    eject_failures=int(os.environ.get("UPSTREAM_EJECT_FAILURES", 3)),
+    eject_error_rate=float(os.environ.get("UPSTREAM_EJECT_ERROR_RATE", 0.5)),
+    eject_seconds=float(os.environ.get("UPSTREAM_EJECT_SECONDS", 10)),
+    eject_max_seconds=float(os.environ.get("UPSTREAM_EJECT_MAX_SECONDS", 300)),
+)
+
+
+# Connects every member and makes one cheap API call on each (a token count of the prompt) so
+# the first generation doesn't pay for either, retrying until at least one member answers
+def warm_up():
+    global warmup_error
+    while not ready.is_set():
+        errors = []
+        for member in upstream_pool.members:
+            try:
+                member.client().count_tokens(build_prompt(""))
+            except Exception as e:
+                errors.append(f"{member.name}: {e}")
+        warmup_error = "; ".join(errors) or None
+        if len(errors) < len(upstream_pool.members):
+            ready.set()
+            print("Upstream client ready" + (f", except {warmup_error}" if errors else ""))
+        else:
+            print(f"Warm-up call failed, retrying in {WARMUP_RETRY_SECONDS}s: {warmup_error}")
+            time.sleep(WARMUP_RETRY_SECONDS)
+
+
+warmup_thread = None
+
+
+def start_warm_up():
+    global warmup_thread
+    if WARMUP and warmup_thread is None:
+        warmup_thread = threading.Thread(target=warm_up, daemon=True)
+        warmup_thread.start()
+
+
+def readiness():
+    status = {"ready": ready.is_set(), "clientLoaded": upstream_pool.connected()}
+    if warmup_error is not None:
+        status["error"] = warmup_error
+    return status
+
+
+# All of the prompt but the description: the same for every request, so it's built once
+def build_instructions():
+    # Sorted so the prompt, and PROMPT_VERSION, are the same in every process
+    object_set = "{" + ", ".join(repr(name) for name in sorted(schema.OBJECT_SET)) + "}"
+
+    guidelines = f"""
+    You are a terrain generation AI for a game. Based on the user's description, 
+    return a JSON object with parameters required for generating terrain. 
+    Make sure that the values for each parameter fall within reasonable ranges to avoid any out-of-bounds issues. 
+    If the description for the terrain does not need tree or grass like dessert(height 162, octaves 8, ) or snow unles the user specicly said, do not add( make the values zero's).
+    Make sure if the user say dont add <object> make sure to set the value to zero, for exampl if the user say dont add tree or grass or water(etc) make it zero.
+    Please use the following guidelines for each module:
+    If the description contains multiple types of terrain (e.g., 'mountain' and 'grass field flat'), 
+    generate separate terrainData objects for each.
+
+    Each terrain should have its own HeightsGenerator, TexturesGenerator, GrassGenerator, TreeGenerator, and WaterGenerator data.
+    Please use the following structure for each terrain:
+
+    HeightsGenerator:
+    Width: Determines the width of the terrain in units.
+    Height: Determines the height (or length) of the terrain in units.
+    Depth: Controls the maximum height variation of the terrain (vertical scaling).
+    Octaves: Specifies the number of noise layers used in terrain generation (more octaves add detail).
+    Scale: Adjusts the scale of the noise map, affecting the size of terrain features.
+    Lacunarity: Controls the increase in frequency for each octave, adding finer details.
+    Persistance: Determines how the amplitude decreases with each octave, affecting how details diminish.
+    HeightCurve: An animation curve that adjusts the terrain heights based on evaluated noise values.
+    Offset: A value to randomize or shift the noise pattern used in terrain generation.
+    FalloffDirection: Defines the direction of the falloff, influencing terrain shape towards edges.
+    FalloffRange: Defines how far the falloff effect reaches, influencing terrain smoothness.
+    UseFalloffMap: Toggles the use of a falloff map to control terrain generation near edges.
+    Randomize: Enables randomization of the noise offset to generate different terrains each time.
+    AutoUpdate: Automatically updates the terrain when changes are made in the inspector.
+
+    - width and height should be around 1024 (minimum 512, maximum 1024).
+    - depth represents the terrain height and should be between 65 and 200.
+    - octaves represent the levels of detail and should be between 1 and 15.
+    - scale determines the level of detail and should range between 70 and 500.
+    - lacunarity affects how much detail is added at each octave, typically between 1 and 5.
+    - persistence controls how each octave contributes to the overall shape, typically between 0 and 0.2.
+    - heightCurve: Choose from ["linear", "constant", "easeIn", "easeOut", "sine", "bezier"].  Rate of change of heights curve.
+    - heightCurveOffset is the vertical offset of the height curve, usually between 5000 and 12000.
+    - falloffDirection affects the direction of terrain slopes, usually between 1 and 4.
+    - falloffRange affects the slope of the terrain, usually between 1 and 4.
+    - useFalloffMap should be true or false. mostly true
+    - randomize and autoUpdate should be true or false.
+
+    TexturesGenerator:
+    - texture should be a list of textures (comma-separated) that can include any of the following it should be only for the terrain:
+    - Water is not part of terrain TexturesGenerator
+    ["grass", "desert", "snow", "mud", "rock", "sand", "forestFloor", "mountainRock", "dirt", "deadGrass"].
+    - The user may ask for multiple textures, so the model should include more than one texture if necessary. 
+    For example, "desert, deadGrass" for a desert with patches of dead grass, or "snow, rock" for snowy mountains.
+    - Each texture should have its own properties: 
+        -  make sire
+        - `heightCurve`: Choose from ["linear", "constant", "easeIn", "easeOut", "sine", "bezier"]. These represent the curve type for how the texture is applied based on terrain height.
+        - `tileSizeX`: float, between 0 and 50 (determines how the texture is tiled on the X axis).
+        - `tileSizeY`: float, between 0 and 50 (determines how the texture is tiled on the Y axis).
+        Ensure each texture has unique values for these properties. 
+
+
+    GrassGenerator:
+    Octaves: Controls the number of noise layers used in the Perlin noise generation (more octaves add detail).
+    Scale: Defines the scale of the Perlin noise; a higher value stretches the noise pattern, making features larger.
+    Lacunarity: Determines how much the frequency of each octave increases; higher values result in more noise details.
+    Persistance: Controls how the amplitude decreases with each octave; higher values retain more detail in higher octaves.
+    Offset: A shift applied to the Perlin noise generation, used to randomize the noise pattern.
+    MinLevel: Minimum terrain height where grass or trees can be placed.
+    MaxLevel: Maximum terrain height where grass or trees can be placed.
+    MaxSteepness: The steepest slope on which grass or trees can be placed (higher values allow steeper placement).
+    IslandsSize: Defines the size of areas where grass or trees are not placed; used to control the density of islands.
+    Density: Controls how densely the grass or trees are placed within the allowed areas.
+
+    - octaves should be between 0 and 4.
+    - scale should be between 0 and 25.
+    - lacunarity should be between 0 and 3.
+    - persistence should be between 0 and 1.
+    - offset should be between 1000 and 10000.
+    - minLevel should be between -200 and -90.
+    - maxLevel should be between 90 and 200.
+    - maxSteepness should be between 50 and 90.
+    - islandSize should be between 0.5 and 1.
+    - density should be between 700 and 1000.
+    - randomize and autoUpdate should be true or false.
+    - Grass Texture should be an integer representing the number of Grass Texture, typically between 4 and 10.
+
+    TreeGenerator:
+    Octaves: Determines the number of noise layers used for tree distribution (more octaves add finer details to the noise).
+    Scale: Adjusts the scale of the noise map, affecting how spread out or compact the tree distribution will be.
+    Lacunarity: Controls the increase in frequency for each noise octave, affecting the overall detail of tree distribution.
+    Persistance: Defines how the amplitude of each noise octave diminishes, influencing the terrain's fine details for tree placement.
+    Offset: A value used to shift the noise map, introducing randomness to the tree distribution.
+    MinLevel: The minimum height at which trees can be placed.
+    MaxLevel: The maximum height at which trees can be placed.
+    MaxSteepness: The steepest slope on which trees can grow; trees won't appear on slopes steeper than this value.
+    IslandsSize: Controls the areas where trees are placed based on noise values; lower values restrict trees to specific areas, while higher values spread trees across the terrain.
+    Density: Determines how densely trees are placed on the terrain; higher values result in more trees.
+    Randomize: If enabled, randomizes the noise offset to produce different tree layouts each time the map is generated.
+    AutoUpdate: Automatically regenerates the trees whenever any parameter is changed in the inspector.
+    for forest uslay its around Density 1, IslandsSize 1, MaxLevel 100.
+
+    - octaves should be between 1 and 10.
+    - scale should be between 0 and 100.
+    - lacunarity should be between 0 and 3.
+    - persistence should be between 0 and 1.0.
+    - offset should be between 2000 and 10000.
+    - minLevel should be between 0 and 100.
+    - maxLevel should be between 0 and 100.
+    - maxSteepness should be between 0 and 90.
+    - islandSize should be between -1 and 1.
+    - density should be between 0 and .3.
+    - randomize and autoUpdate should be true or false.
+    - treePrototypes should be an integer representing the number of tree prefabs, typically between 1 and 10.
+
+    WaterGenerator:
+    - waterType should be "river", "lake", "ocean", or "none".
+    - waterLevel represents the level of water height for lakes or oceans, should be between 50 and 0.
+    - river width range x and y, x should be between 100 and 100, y should be between 100 and 1000 
+    - randomize and autoUpdate should be true or false.
+    
+    ObjectData:
+    Multiplle copies of objects are allowed to be generated at a time.
+    - name: The name of the object. Must be in {object_set}
+    - x: The x position of the center of the object, 0<x<1024
+    - y: The y position of the center of the object, 0<y<1024
+    - Rx: The rotation of the object around the x axis, 0<Rx<360
+    - Ry: The rotation of the object around the y axis, 0<Ry<360
+    - Rz: The rotation of the object around the z axis, 0<Rz<360
+    - scale: The scale of the model size, as a multiple of the model, 0 < scale < 4, typically 1
+
+    AtmosphereGenerator:
+    - timeOfDay is a floating point value representing the time of day. Its value should be between 0 and 24 inclusive with 0 and 24 representing 12:00am, 12 representing 12:00pm and so on. 
+    - sunSize is a floating point value representing the size of the sun. Its value should range from 0 to 1 inclusive and the standard sun size is .05.
+    - skyTint is a color defined by RGB values each ranging from 0 to 1. Default sky color should be r=.5, g=.5, b=.5. anything refering to the color of the sky should affect this color value.
+    - atmosphericThickness is a float ranging from 0-5 inclusive. The standard value is 1.
+    - exposure is a float ranging from 0-8 inclusive. The standard value is 1.3 and this controls the overall light intensity coming from the sun in the skybox
+    - fogIntensity is a float ranging from 0-.5 inclusive. Fog values should have one of 5 different values 
+        (0 for no fog, .02 for light fog, .05 for medium fog, .1 for heavy fog, and .3 for very heavy fog)
+    - fogColor is a color defined by RGB values each ranging from 0 to 1. Default fog color should be r=.5, g=.5, b=.5
+    
+"""
+    return guidelines + (build_full_format() if OUTPUT_MODE == "full" else build_preset_format())
+
+
+# Every value of every terrain, written out in full
+def build_full_format():
+    return f"""    Make sure you return the result in JSON format like this:   
+    {{
+        "terrainsData": [
+            {{
+                "heightsGeneratorData": {{
+                    "width": integer,
+                    "height": integer,
+                    "depth": integer,
+                    "octaves": integer,
+                    "scale": float,
+                    "lacunarity": float,
+                    "persistence": float,
+                    "heightCurve": string,
+                    "heightCurveOffset": float,
+                    "falloffDirection": float,
+                    "falloffRange": float,
+                    "useFalloffMap": boolean,
+                    "randomize": boolean,
+                    "autoUpdate": boolean
+                }},
+                "texturesGeneratorDataList": [
+                    {{
+                        "texture": string,
+                        "heightCurve": string,
+                        "tileSizeX": float,
+                        "tileSizeY": float
+                    }}
+                ],
+                "treeGeneratorData": {{
+                    "octaves": integer,
+                    "scale": float,
+                    "lacunarity": float,
+                    "persistence": float,
+                    "offset": float,
+                    "minLevel": float,
+                    "maxLevel": float,
+                    "maxSteepness": float,
+                    "islandSize": float,
+                    "density": float,
+                    "randomize": boolean,
+                    "treePrototypes": integer
+                }},
+                "grassGeneratorData": {{
+                    "octaves": integer,
+                    "scale": float,
+                    "lacunarity": float,
+                    "persistence": float,
+                    "offset": float,
+                    "minLevel": float,
+                    "maxLevel": float,
+                    "maxSteepness": float,
+                    "islandSize": float,
+                    "density": float,
+                    "randomize": boolean,
+                    "grassTextures": integer
+                }},
+                "waterGeneratorData": {{
+                    "waterType": string,
+                    "waterLevel": float,
+                    "riverWidthRange": {{"x": float, "y": float}},
+                    "randomize": boolean,
+                    "autoUpdate": boolean
+                }}
+            }},
+            ...
+        ]
+        "objectList": [
+        {{
+            "name": string,
+            "x": float,
+            "y": float,
+            "Rx": float,
+            "Ry": float,
+            "Rz": float,
+            "scale": float
+        }},
+        ...
+    ]
+    "atmosphereGeneratorData": {{
+            "timeOfDay": float,
+            "sunSize": float,
+            "skyTint":{{
+                "r": float,
+                "g": float,
+                "b": float
+            }},
+            "atmosphericThickness": float,
+            "exposure": float,
+            "fogIntensity": float,
+            "fogColor": {{
+                "r": float,
+                "g": float,
+                "b": float
+            }}
+        }}
+    }}
+
+
+"""
+
+
+# A preset from the library and the values that differ from it, which presets.expand() fills in
+def build_preset_format():
+    library = "\n".join(
+        f"    {name}: " + json.dumps({"terrain": preset["world"]["terrainsData"][0],
+                                      "atmosphere": preset["world"]["atmosphereGeneratorData"]})
+        for name, preset in PRESETS.items())
+
+    return f"""    Instead of writing out every value, start each terrain from the preset below that is closest to it,
+    and give only the values that should be different from the preset. Leave out any generator whose
+    values all match the preset. texturesGeneratorDataList, if given, replaces the preset's textures,
+    so list every texture the terrain should have. The atmosphere also starts from a preset.
+    Objects are always written out in full. The presets are:
+
+{library}
+
+    Make sure you return the result in JSON format like this:
+    {{
+        "terrainsData": [
+            {{
+                "preset": string,
+                "heightsGeneratorData": {{ only the values that differ }},
+                "texturesGeneratorDataList": [ every texture, only if they differ ],
+                "treeGeneratorData": {{ only the values that differ }},
+                "grassGeneratorData": {{ only the values that differ }},
+                "waterGeneratorData": {{ only the values that differ }}
+            }},
+            ...
+        ],
+        "objectList": [
+            {{
+                "name": string,
+                "x": float,
+                "y": float,
+                "Rx": float,
+                "Ry": float,
+                "Rz": float,
+                "scale": float
+            }},
+            ...
+        ],
+        "atmosphereGeneratorData": {{
+            "preset": string,
+            only the values that differ
+        }}
+    }}
+
+
+"""
+
+
+def build_request(description):
+    return f"""    Use the following description to generate appropriate values:
+    "{description}"
+    """
+
+
+INSTRUCTIONS = build_instructions()
+
+
+# What is sent for the description: the whole prompt when the instructions go inline, otherwise
+# only its own part, the model already having the instructions
+def build_prompt(description):
+    request = build_request(description)
+    return INSTRUCTIONS + request if PROMPT_MODE == "inline" else request
+
+
+# Changes whenever the prompt template, or the way it's sent, does, so cached responses from an
+# older prompt are never served
+if PROMPT_MODE == "inline":
+    PROMPT_VERSION = hashlib.sha1(build_prompt("{description}").encode()).hexdigest()[:12]
+else:
+    PROMPT_VERSION = hashlib.sha1(f"{INSTRUCTIONS}\0{build_request('{description}')}".encode()).hexdigest()[:12]
+
+
+# Clean the response by removing any triple backticks if present
+def clean_response(text):
+    return text.strip().strip('```json').strip('```')
+
+
+# Validate, default and clamp the model output against WorldInfo, returning the JSON sent to clients
+def parse_response(text):
+    with stage("cleanup"):
+        text = clean_response(text)
+    # Includes decoding the JSON, which pydantic does in the same pass unless presets need expanding first
+    with stage("validate"):
+        if OUTPUT_MODE == "full":
+            world = schema.validate(text)
+        else:
+            world = schema.validate_data(expand(schema.load_json(text)))
+    with stage("serialize"):
+        return schema.dump(world)
+
+
+def cache_key(description):
+    return (canonicalize(description), PROMPT_VERSION, MODEL_NAME)
+
+
+# Identical requests already waiting on the model share its answer instead of paying for another call.
+# A client supplied idempotency key takes the place of the description, so retries always join the original.
+upstream_flights = SingleFlight()
+async_upstream_flights = AsyncSingleFlight()
+
+
+def flight_key(key, idempotency_key):
+    if idempotency_key:
+        return ("idempotency", idempotency_key)
+    return key
+
+
+class GenerationResult:
+    def __init__(self, text, source, match=None, score=None, fast_path=None):
+        self.text = text
+        # "upstream", "coalesced", "cache", "store", "preset" or "similar"
+        self.source = source
+        # Canonical description of the near-duplicate that answered, and its similarity score
+        self.match = match
+        self.score = score
+        # Best preset candidate for the description, whether or not it was confident enough to answer
+        self.fast_path = fast_path
+        # Set by counted(), once the world can be fetched again at /worlds/<id>
+        self.world_id = None
+
+
+# Answers that don't need the model: exact cache, backed by the store on disk, then the preset
+# fast path, then near-duplicates. Returns (result or None, fast path match or None).
+def lookup(key, description):
+    cached = response_cache.get(key)
+    if cached is not None:
+        return GenerationResult(cached, "cache"), None
+    stored = world_store.get(key) if world_store is not None else None
+    return lookup_stored(key, description, stored)
+
+
+async def lookup_async(key, description):
+    cached = response_cache.get(key)
+    if cached is not None:
+        return GenerationResult(cached, "cache"), None
+    # Reads can wait on another process's write, so keep them off the event loop
+    stored = await asyncio.to_thread(world_store.get, key) if world_store is not None else None
+    return lookup_stored(key, description, stored)
+
+
+# The rest of lookup, given what the store holds for the key
+def lookup_stored(key, description, stored):
+    if stored is not None:
+        response_cache.put(key, stored)
+        return GenerationResult(stored, "store"), None
+
+    found, text = fast_path.get(description)
+    if text is not None:
+        return GenerationResult(text, "preset", fast_path=found), found
+
+    if similarity_cache is not None:
+        similar = similarity_cache.get(description)
+        if similar is not None:
+            match, score, text = similar
+            return GenerationResult(text, "similar", match, score, fast_path=found), found
+
+    return None, found
+
+
+# raw is the model's text before cleanup and validation, tokens the (prompt, output) token counts
+def store_response(key, description, text, raw=None, upstream_seconds=None, tokens=(None, None)):
+    response_cache.put(key, text)
+    if similarity_cache is not None:
+        similarity_cache.put(description, text)
+    if world_store is not None:
+        world_store.put(key, text, raw, upstream_seconds, *tokens)
+
+
+# How long a call may queue for quota and still answer before the client's deadline,
+# allowing for a typical upstream call
+def queue_timeout(deadline):
+    if deadline is None:
+        return None
+    return deadline - time.monotonic() - (hedger.upstream.percentile(50) or 0)
+
+
+# Picks the pool member for one upstream call and waits for its rate limit quota.
+# Returns (member, estimated token cost).
+def admit_upstream(prompt, deadline):
+    member = upstream_pool.choose(prompt)
+    cost = member.cost(prompt)
+    if member.limiter is not None:
+        with stage("queue"):
+            member.limiter.acquire(cost, queue_timeout(deadline))
+    return member, cost
+
+
+async def admit_upstream_async(prompt, deadline):
+    member = upstream_pool.choose(prompt)
+    cost = member.cost(prompt)
+    if member.limiter is not None:
+        with stage("queue"):
+            await member.limiter.acquire_async(cost, queue_timeout(deadline))
+    return member, cost
+
+
+# Hedged attempts go to another member with quota to spare, or to the same one if it has some
+def hedge(prompt, member, attempt):
+    def admit():
+        reserved = upstream_pool.reserve(prompt, [member]) or upstream_pool.reserve(prompt)
+        if reserved is None:
+            return None
+        return lambda: attempt(*reserved)
+    return admit
+
+
+# Gemini answers 429 (ResourceExhausted) once a quota is used up
+def quota_exceeded(e):
+    if outcome(e) != "quota":
+        return None
+    return RateLimited("upstream", upstream_pool.retry_after())
+
+
+def finish_upstream(member, prompt, cost, text, usage):
+    ready.set()
+    prompt_count, output_count = record_tokens(prompt, text, usage)
+    if member.limiter is not None:
+        member.limiter.settle(cost, prompt_count + output_count, output_count)
+    return prompt_count, output_count
+
+
+def call_upstream(key, description, deadline=None):
+    with stage("prompt"):
+        prompt = build_prompt(description)
+    member, cost = admit_upstream(prompt, deadline)
+
+    # Call the Gemini API to generate the content, hedged against slow responses
+    def attempt(member, cost):
+        return upstream_pool.call(prompt, member, cost, lambda upstream: upstream.generate_content(prompt))
+
+    started = time.perf_counter()
+    try:
+        with in_flight.track("upstream"), stage("upstream"):
+            response, member, cost = hedger.call(lambda: attempt(member, cost), hedge(prompt, member, attempt))
+    except Exception as e:
+        error = quota_exceeded(e)
+        if error is None:
+            raise
+        raise error from e
+    upstream_seconds = time.perf_counter() - started
+    tokens = finish_upstream(member, prompt, cost, response.text, getattr(response, "usage_metadata", None))
+
+    text = parse_response(response.text)
+    store_response(key, description, text, response.text, upstream_seconds, tokens)
+    return text
+
+
+async def call_upstream_async(key, description, deadline=None):
+    with stage("prompt"):
+        prompt = build_prompt(description)
+    member, cost = await admit_upstream_async(prompt, deadline)
+
+    # Await the Gemini API so the event loop can serve other requests meanwhile
+    def attempt(member, cost):
+        return upstream_pool.call_async(prompt, member, cost, lambda upstream: upstream.generate_content_async(prompt))
+
+    started = time.perf_counter()
+    try:
+        with in_flight.track("upstream"), stage("upstream"):
+            response, member, cost = await hedger.call_async(lambda: attempt(member, cost), hedge(prompt, member, attempt))
+    except Exception as e:
+        error = quota_exceeded(e)
+        if error is None:
+            raise
+        raise error from e
+    upstream_seconds = time.perf_counter() - started
+    tokens = finish_upstream(member, prompt, cost, response.text, getattr(response, "usage_metadata", None))
+
+    # Cleanup and validation are CPU work, keep them off the event loop
+    text = await asyncio.to_thread(parse_response, response.text)
+    store_response(key, description, text, response.text, upstream_seconds, tokens)
+    return text
+
+
+# With several worker processes (SHARED_STATE) identical requests are coalesced across them too:
+# one process takes a lease on the key and calls the model, the others wait for its world to
+# appear in the store, and take over if it gives up. Returns (text, whether another process made it).
+def call_upstream_shared(key, description, deadline=None):
+    if not SHARED_STATE or world_store is None:
+        return call_upstream(key, description, deadline), False
+    while True:
+        token = world_store.lease(key, SHARED_LEASE_SECONDS)
+        if token is not None:
+            try:
+                text = call_upstream(key, description, deadline)
+                # The other processes are polling for it, so don't wait for the next batch
+                world_store.flush()
+                return text, False
+            finally:
+                world_store.release(key, token)
+        with stage("shared"):
+            while True:
+                text, leased = world_store.poll(key)
+                if text is not None or not leased:
+                    break
+                time.sleep(SHARED_POLL_SECONDS)
+        if text is not None:
+            response_cache.put(key, text)
+            return text, True
+
+
+async def call_upstream_shared_async(key, description, deadline=None):
+    if not SHARED_STATE or world_store is None:
+        return await call_upstream_async(key, description, deadline), False
+    while True:
+        # Writes can wait on another process's transaction, so keep them off the event loop
+        token = await asyncio.to_thread(world_store.lease, key, SHARED_LEASE_SECONDS)
+        if token is not None:
+            try:
+                text = await call_upstream_async(key, description, deadline)
+                await asyncio.to_thread(world_store.flush)
+                return text, False
+            finally:
+                await asyncio.to_thread(world_store.release, key, token)
+        with stage("shared"):
+            while True:
+                text, leased = await asyncio.to_thread(world_store.poll, key)
+                if text is not None or not leased:
+                    break
+                await asyncio.sleep(SHARED_POLL_SECONDS)
+        if text is not None:
+            response_cache.put(key, text)
+            return text, True
+
+
+def counted(result):
+    generations_total.inc(result.source)
+    response_bytes.observe(len(result.text))
+    remember_world(result)
+    return result
+
+
+# Every world served can be fetched again by its id, whichever way it was answered
+def remember_world(result):
+    result.world_id = world_id(result.text)
+    if world_cache.get(result.world_id) is None:
+        world_cache.put(result.world_id, result.text)
+        if world_store is not None:
+            world_store.put_by_id(result.world_id, result.text)
+
+
+# How often and how lately each stored world is asked for, which preload.py ranks worlds by
+def record_use(key, result):
+    if world_store is not None and result.source not in ("preset", "similar"):
+        world_store.touch(key)
+
+
+def find_world(world_id):
+    text = world_cache.get(world_id)
+    if text is None and world_store is not None:
+        text = world_store.get_by_id(world_id)
+        if text is not None:
+            world_cache.put(world_id, text)
+    return text
+
+
+# deadline is the time.monotonic() by which the client needs an answer, if it has said
+def generate(description, idempotency_key=None, deadline=None):
+    with in_flight.track("generation"):
+        try:
+            key = cache_key(description)
+            with span("lookup"):
+                result, found = lookup(key, description)
+            if result is None:
+                (text, remote), shared = upstream_flights.do(
+                    flight_key(key, idempotency_key), lambda: call_upstream_shared(key, description, deadline))
+                result = GenerationResult(text, "coalesced" if shared or remote else "upstream", fast_path=found)
+        except Exception:
+            generations_total.inc("error")
+            raise
+    record_use(key, result)
+    return counted(result)
+
+
+async def generate_async(description, idempotency_key=None, deadline=None):
+    with in_flight.track("generation"):
+        try:
+            key = cache_key(description)
+            with span("lookup"):
+                result, found = await lookup_async(key, description)
+            if result is None:
+                (text, remote), shared = await async_upstream_flights.do(
+                    flight_key(key, idempotency_key), lambda: call_upstream_shared_async(key, description, deadline))
+                result = GenerationResult(text, "coalesced" if shared or remote else "upstream", fast_path=found)
+        except Exception:
+            generations_total.inc("error")
+            raise
+    record_use(key, result)
+    return counted(result)
+
+
+# Validated copies of the sections the parser completed in this chunk
+def validated_sections(parser, chunk):
+    for section, index, value in parser.feed(chunk):
+        if OUTPUT_MODE != "full":
+            value = expand_section(section, value)
+        value = schema.validate_section(section, value)
+        if value is not None:
+            yield section, index, value
+
+
+# Yields (section, index, value) for each top-level WorldInfo section as soon as the model has finished writing it
+def stream_sections(description, deadline=None):
+    key = cache_key(description)
+    parser = SectionParser()
+
+    cached, _ = lookup(key, description)
+    if cached is not None:
+        record_use(key, cached)
+        counted(cached)
+        yield from parser.feed(cached.text)
+        return
+
+    with in_flight.track("generation"):
+        try:
+            with stage("prompt"):
+                prompt = build_prompt(description)
+            member, cost = admit_upstream(prompt, deadline)
+            chunks = []
+            chunk = None
+            started = member.begin()
+            try:
+                with in_flight.track("upstream"), stage("upstream"):
+                    for chunk in member.client().generate_content(prompt, stream=True):
+                        chunks.append(chunk.text)
+                        yield from validated_sections(parser, chunk.text)
+            except Exception as e:
+                member.end(upstream_pool, started, e)
+                raise
+            except BaseException:
+                member.cancel()
+                raise
+            member.end(upstream_pool, started)
+            text = finish_stream(key, description, member, prompt, cost, chunks, chunk, started)
+        except Exception as e:
+            generations_total.inc("error")
+            error = quota_exceeded(e)
+            if error is None:
+                raise
+            raise error from e
+    result = GenerationResult(text, "upstream")
+    record_use(key, result)
+    counted(result)
+
+
+async def stream_sections_async(description, deadline=None):
+    key = cache_key(description)
+    parser = SectionParser()
+
+    cached, _ = await lookup_async(key, description)
+    if cached is not None:
+        record_use(key, cached)
+        counted(cached)
+        for section in parser.feed(cached.text):
+            yield section
+        return
+
+    with in_flight.track("generation"):
+        try:
+            with stage("prompt"):
+                prompt = build_prompt(description)
+            member, cost = await admit_upstream_async(prompt, deadline)
+            chunks = []
+            chunk = None
+            upstream = await member.client_async()
+            started = member.begin()
+            try:
+                with in_flight.track("upstream"), stage("upstream"):
+                    async for chunk in await upstream.generate_content_async(prompt, stream=True):
+                        chunks.append(chunk.text)
+                        for section in validated_sections(parser, chunk.text):
+                            yield section
+            except Exception as e:
+                member.end(upstream_pool, started, e)
+                raise
+            except BaseException:
+                member.cancel()
+                raise
+            member.end(upstream_pool, started)
+            text = finish_stream(key, description, member, prompt, cost, chunks, chunk, started)
+        except Exception as e:
+            generations_total.inc("error")
+            error = quota_exceeded(e)
+            if error is None:
+                raise
+            raise error from e
+    result = GenerationResult(text, "upstream")
+    record_use(key, result)
+    counted(result)
+
+
+# The last chunk of a stream carries the usage for the whole response
+def finish_stream(key, description, member, prompt, cost, chunks, last_chunk, started):
+    upstream_seconds = time.perf_counter() - started
+    raw = "".join(chunks)
+    tokens = finish_upstream(member, prompt, cost, raw, getattr(last_chunk, "usage_metadata", None))
+    text = parse_response(raw)
+    store_response(key, description, text, raw, upstream_seconds, tokens)
+    return text
@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+
+# Production serving: gunicorn pre-forks WEB_WORKERS uvicorn workers running asgi.py.
+#
+#   gunicorn -c gunicorn.conf.py asgi:app
+#
+# Every worker imports the app itself (no preload), so `kill -HUP <master pid>` starts workers
+# on the new code and lets the old ones finish their requests before exiting. Workers are also
+# recycled after WORKER_MAX_REQUESTS requests, staggered by the jitter so they don't all restart
+# at once. The workers share the world store (STORE_PATH) for cached worlds, upstream call
+# coalescing and jobs, and METRICS_DIR for /metrics.
+
+bind = os.environ.get("BIND", f"127.0.0.1:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get("WEB_WORKERS", os.cpu_count() or 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = int(os.environ.get("KEEPALIVE_SECONDS", 5))
+max_requests = int(os.environ.get("WORKER_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+# Long enough for a generation to finish when a worker is reloaded or recycled
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT_SECONDS", 120))
+timeout = int(os.environ.get("WORKER_TIMEOUT_SECONDS", 120))
+preload_app = False
+
+os.environ["SHARED_STATE"] = "1"
+metrics_dir = os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"ezworld-metrics-{os.getpid()}"))
+
+
+# Counters of the previous deploy's workers shouldn't be added to this one's
+def on_starting(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def on_exit(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
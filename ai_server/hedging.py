@@ -0,0 +1,182 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+
+# Rolling window of recent latencies, sorted lazily when a percentile is asked for
+class LatencyTracker:
+    def __init__(self, window=500):
+        self.samples = deque(maxlen=window)
+        self.sorted = []
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.dirty = True
+
+    def count(self):
+        return len(self.samples)
+
+    def percentile(self, q):
+        with self.lock:
+            if self.dirty:
+                self.sorted = sorted(self.samples)
+                self.dirty = False
+            if not self.sorted:
+                return None
+            return self.sorted[min(len(self.sorted) - 1, int(q / 100 * len(self.sorted)))]
+
+    def summary(self):
+        return {f"p{q}": self.percentile(q) for q in (50, 90, 95, 99)}
+
+
+# Hedged upstream calls: once a call has taken longer than the given percentile of recent
+# upstream latency, an identical second call is started and whichever answers first wins.
+# Hedges are capped at max_fraction of all calls so a slow upstream can't double our quota use.
+class Hedger:
+    def __init__(self, percentile, max_fraction, min_samples=20):
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        # Latency of each upstream attempt, and latency as seen by the caller
+        self.upstream = LatencyTracker()
+        self.observed = LatencyTracker()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.denied = 0
+
+    # How long to wait before hedging, or None while there isn't enough history
+    def delay(self):
+        with self.lock:
+            self.calls += 1
+        if self.max_fraction <= 0 or self.upstream.count() < self.min_samples:
+            return None
+        return self.upstream.percentile(self.percentile)
+
+    # admit, if given, gets the final say, e.g. whether there's rate limit quota for another call.
+    # It may return the call to hedge with, e.g. the same request to another upstream.
+    def allow_hedge(self, admit=None):
+        with self.lock:
+            if self.hedged + 1 > self.max_fraction * self.calls:
+                self.denied += 1
+                return None
+        hedge = True if admit is None else admit()
+        if not hedge:
+            with self.lock:
+                self.denied += 1
+            return None
+        with self.lock:
+            self.hedged += 1
+        return hedge
+
+    def won(self, attempt, attempts):
+        if attempt is not attempts[0]:
+            with self.lock:
+                self.hedge_wins += 1
+
+    def timed(self, fn):
+        start = time.perf_counter()
+        result = fn()
+        self.upstream.record(time.perf_counter() - start)
+        return result
+
+    def start(self, fn):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.timed(fn))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def call(self, fn, admit=None):
+        start = time.perf_counter()
+        delay = self.delay()
+        if delay is None:
+            result = self.timed(fn)
+        else:
+            attempts = [self.start(fn)]
+            done, _ = wait(attempts, timeout=delay)
+            hedge = None if done else self.allow_hedge(admit)
+            if hedge:
+                attempts.append(self.start(hedge if callable(hedge) else fn))
+            result = self.first_result(attempts)
+        self.observed.record(time.perf_counter() - start)
+        return result
+
+    # A thread can't be interrupted, so the losing call runs to completion and its result is dropped
+    def first_result(self, attempts):
+        pending = set(attempts)
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None or not pending:
+                    self.won(attempt, attempts)
+                    return attempt.result()
+
+    async def timed_async(self, fn):
+        start = time.perf_counter()
+        result = await fn()
+        self.upstream.record(time.perf_counter() - start)
+        return result
+
+    async def call_async(self, fn, admit=None):
+        start = time.perf_counter()
+        delay = self.delay()
+        if delay is None:
+            result = await self.timed_async(fn)
+        else:
+            attempts = [asyncio.ensure_future(self.timed_async(fn))]
+            try:
+                done, _ = await asyncio.wait(attempts, timeout=delay)
+                hedge = None if done else self.allow_hedge(admit)
+                if hedge:
+                    attempts.append(asyncio.ensure_future(self.timed_async(hedge if callable(hedge) else fn)))
+                result = await self.first_result_async(attempts)
+            finally:
+                # Cancel the loser, or both if our caller went away
+                for attempt in attempts:
+                    attempt.cancel()
+        self.observed.record(time.perf_counter() - start)
+        return result
+
+    async def first_result_async(self, attempts):
+        pending = set(attempts)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None or not pending:
+                    self.won(attempt, attempts)
+                    return attempt.result()
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                "percentile": self.percentile,
+                "maxFraction": self.max_fraction,
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedgeRate": self.hedged / self.calls if self.calls else 0.0,
+                "hedgeWins": self.hedge_wins,
+                "hedgesDenied": self.denied,
+            }
+        stats["hedgeDelay"] = self.upstream.percentile(self.percentile)
+        stats["upstreamLatency"] = self.upstream.summary()
+        stats["observedLatency"] = self.observed.summary()
+        return stats
+
+
+hedger = Hedger(
+    percentile=float(os.environ.get("HEDGE_PERCENTILE", 95)),
+    max_fraction=float(os.environ.get("HEDGE_MAX_FRACTION", 0.1)),
+)
@@ -0,0 +1,215 @@
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import generation
+from hedging import hedger
+from ratelimit import RateLimited
+from store import SHARED_POLL_SECONDS, SHARED_STATE, world_store
+
+
+class Job:
+    def __init__(self, description, idempotency_key=None):
+        self.id = secrets.token_urlsafe(12)
+        self.description = description
+        self.idempotency_key = idempotency_key
+        # "queued", "running", "done" or "failed"
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        # Run by another worker process, and read back from the store
+        self.remote = False
+
+    # Estimated from how long upstream calls usually take, since the model doesn't report progress
+    def progress(self):
+        if self.done.is_set():
+            return 1.0
+        if self.started is None:
+            return 0.0
+        typical = hedger.upstream.percentile(50)
+        if not typical:
+            return None
+        return round(min(0.95, (time.time() - self.started) / typical), 2)
+
+    def summary(self):
+        summary = {
+            "id": self.id,
+            "description": self.description,
+            "status": self.status,
+            "progress": self.progress(),
+            "createdAt": self.created,
+        }
+        if self.started is not None:
+            summary["queuedSeconds"] = round(self.started - self.created, 3)
+        if self.finished is not None:
+            summary["seconds"] = round(self.finished - self.started, 3)
+        if self.status == "done":
+            summary["source"] = self.result.source
+            summary["result"] = f"/jobs/{self.id}/result"
+        return summary
+
+
+# A job as another worker process last wrote it to the store
+def stored_job(row):
+    job = Job(row["description"], row["idempotency_key"])
+    job.id = row["id"]
+    job.status = row["status"]
+    job.created = row["created"]
+    job.started = row["started"]
+    job.finished = row["finished"]
+    job.remote = True
+    if job.status == "done":
+        job.result = generation.GenerationResult(generation.find_world(row["world_id"]), row["source"])
+        job.result.world_id = row["world_id"]
+    elif job.status == "failed":
+        job.error = RateLimited(row["error"], row["retry_after"]) if row["retry_after"] is not None else Exception(row["error"])
+    if job.status in ("done", "failed"):
+        job.done.set()
+    return job
+
+
+# Jobs run on their own worker pool, independent of the request that submitted them, and are
+# kept for ttl seconds after finishing so the client can come back for the result. With several
+# worker processes (SHARED_STATE) they are also written to the store, so any worker can answer
+# for a job and a repeated Idempotency-Key finds the original wherever it was submitted.
+class JobStore:
+    def __init__(self, workers, ttl, max_pending, shared=None):
+        self.ttl = ttl
+        self.shared = shared
+        self.shared_expired = 0.0
+        self.max_pending = max_pending
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.jobs = {}
+        self.keys = {}
+        # Finished jobs in the order they finished, which is also the order they expire in
+        self.finished = deque()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+
+    # Returns (job, created). A repeated Idempotency-Key gets the original job back.
+    def submit(self, description, idempotency_key=None):
+        with self.lock:
+            self._expire()
+            if idempotency_key and idempotency_key in self.keys:
+                return self.keys[idempotency_key], False
+            if self.pending >= self.max_pending:
+                raise RateLimited("jobs_full", self.pending / self.workers * (hedger.upstream.percentile(50) or 1))
+            job = Job(description, idempotency_key)
+            if self.shared is not None and not self.shared.insert_job(
+                    (job.id, idempotency_key, description, job.status, job.created)):
+                return stored_job(self.shared.load_job(idempotency_key=idempotency_key)), False
+            self.jobs[job.id] = job
+            if idempotency_key:
+                self.keys[idempotency_key] = job
+            self.pending += 1
+            self.submitted += 1
+
+        self.pool.submit(self.run, job)
+        return job, True
+
+    def run(self, job):
+        job.started = time.time()
+        job.status = "running"
+        self.save(job)
+        try:
+            job.result = generation.generate(job.description)
+            job.status = "done"
+        except Exception as e:
+            print(f"Error running job {job.id}: {e}")
+            job.error = e
+            job.status = "failed"
+        job.finished = time.time()
+        self.save(job)
+
+        with self.lock:
+            self.pending -= 1
+            if job.status == "done":
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.finished.append((time.monotonic() + self.ttl, job))
+        job.done.set()
+
+    def save(self, job):
+        if self.shared is None:
+            return
+        try:
+            if job.status == "done":
+                # The world has to be readable by id before another worker is told the job is done
+                self.shared.flush()
+                self.shared.update_job(job.id, job.status, job.started, job.finished, job.result.world_id, job.result.source)
+            elif job.status == "failed":
+                retry_after = job.error.retry_after if isinstance(job.error, RateLimited) else None
+                error = job.error.reason if isinstance(job.error, RateLimited) else str(job.error)
+                self.shared.update_job(job.id, job.status, job.started, job.finished, error=error, retry_after=retry_after)
+            else:
+                self.shared.update_job(job.id, job.status, job.started)
+        except Exception as e:
+            print(f"Error saving job {job.id}: {e}")
+
+    def get(self, job_id):
+        with self.lock:
+            self._expire()
+            job = self.jobs.get(job_id)
+        if job is None and self.shared is not None:
+            row = self.shared.load_job(job_id)
+            if row is not None:
+                job = stored_job(row)
+        return job
+
+    # Waits up to timeout seconds for the job to finish, returning it as it is then
+    def wait(self, job, timeout):
+        if not job.remote:
+            job.done.wait(timeout)
+            return job
+        deadline = time.monotonic() + timeout
+        while not job.done.is_set() and time.monotonic() < deadline:
+            time.sleep(SHARED_POLL_SECONDS)
+            job = self.get(job.id) or job
+        return job
+
+    def _expire(self):
+        if self.shared is not None and time.time() - self.shared_expired > self.ttl / 10:
+            self.shared_expired = time.time()
+            self.shared.expire_jobs(self.shared_expired - self.ttl)
+        now = time.monotonic()
+        while self.finished and self.finished[0][0] < now:
+            _, job = self.finished.popleft()
+            del self.jobs[job.id]
+            if job.idempotency_key:
+                self.keys.pop(job.idempotency_key, None)
+            self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "maxPending": self.max_pending,
+                "stored": len(self.jobs),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "expired": self.expired,
+                "ttlSeconds": self.ttl,
+            }
+
+
+jobs = JobStore(
+    workers=int(os.environ.get("JOB_WORKERS", 32)),
+    ttl=float(os.environ.get("JOB_TTL_SECONDS", 10 * 60)),
+    max_pending=int(os.environ.get("JOB_MAX_PENDING", 1000)),
+    shared=world_store if SHARED_STATE else None,
+)
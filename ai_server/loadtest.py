@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+SERVERS = {
+    "flask": [sys.executable, "server.py"],
+    "asgi": [sys.executable, "asgi.py"],
+    "gunicorn": [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "asgi:app"],
+}
+
+BIOMES = ("snowy mountains", "a desert", "rolling hills", "a tropical island", "a swamp", "a canyon", "a volcano")
+THINGS = ("ferris wheels", "brick houses", "small houses", "lakes", "rivers", "pine trees")
+
+
+def description(i):
+    return f"{BIOMES[i % len(BIOMES)]} with {i} {THINGS[i // len(BIOMES) % len(THINGS)]}"
+
+
+# Descriptions for the requests: every one new when distinct is 0, so each reaches the model, or
+# drawn from distinct ones with Zipf-like popularity, so the caches answer most of them
+def descriptions(distinct, rng):
+    if not distinct:
+        # Starting somewhere random, so a server that is already running hasn't seen them before
+        yield from map(description, itertools.count(rng.randrange(1 << 30)))
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    while True:
+        yield description(rng.choices(range(distinct), weights)[0])
+
+
+# The descriptions answered in a cassette, over and over in the order they were recorded
+def recorded_descriptions(path):
+    with open(path, encoding="utf-8") as f:
+        interactions = [json.loads(line) for line in f if line.strip()]
+    recorded = [interaction["description"] for interaction in interactions
+                if interaction.get("description") is not None and "error" not in interaction]
+    if not recorded:
+        raise SystemExit(f"No answered descriptions in {path}")
+    return itertools.cycle(recorded)
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except OSError:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"{' '.join(process.args)} exited with code {process.returncode}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+            time.sleep(0.05)
+
+
+# (ppid, CPU seconds including reaped children, resident bytes) from /proc/<pid>/stat
+def read_stat(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = sum(int(field) for field in fields[11:15])
+    return int(fields[1]), ticks / os.sysconf("SC_CLK_TCK"), int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+
+
+# CPU seconds and resident bytes of the server and every process under it, e.g. gunicorn's workers
+def server_usage(pid):
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                stats[int(entry)] = read_stat(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    tree = [pid]
+    for parent in tree:
+        tree.extend(child for child, stat in stats.items() if stat[0] == parent)
+    return sum(stats[p][1] for p in tree if p in stats), sum(stats[p][2] for p in tree if p in stats)
+
+
+async def post(host, port, path, body, timeout):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+        status = await asyncio.wait_for(reader.readline(), timeout)
+        # Streamed responses count as done at their last byte
+        body = await asyncio.wait_for(reader.read(), timeout)
+        # A stream that fails after it started still has status 200, and ends with an error event
+        if b'{"section": "error"' in body:
+            return "stream error"
+        return int(status.split()[1])
+    finally:
+        writer.close()
+
+
+# Latency is timed from when the request was due rather than when it went out, so a client
+# that falls behind doesn't hide the server's queueing (coordinated omission)
+async def request(host, port, path, body, due, timeout):
+    try:
+        outcome = await post(host, port, path, body, timeout)
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+    except OSError:
+        outcome = "connection"
+    return outcome, due, time.perf_counter()
+
+
+class Sampler:
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+
+    async def run(self):
+        while True:
+            self.peak = max(self.peak, server_usage(self.pid)[1])
+            await asyncio.sleep(self.interval)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Open loop: requests arrive as a Poisson process at rate per second for duration seconds,
+# whether or not earlier ones have been answered, the way independent players would send them
+async def step(host, port, path, rate, duration, texts, timeout, rng, pid):
+    sampler = Sampler(pid) if pid else None
+    sampling = asyncio.create_task(sampler.run()) if sampler else None
+    cpu_start = server_usage(pid)[0] if pid else None
+    client_start = time.process_time()
+
+    start = time.perf_counter()
+    tasks = []
+    due = rng.expovariate(rate)
+    while due < duration:
+        delay = start + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        body = json.dumps({"description": next(texts)}).encode()
+        tasks.append(asyncio.create_task(request(host, port, path, body, start + due, timeout)))
+        due += rng.expovariate(rate)
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    outcomes = {}
+    for outcome, _, _ in results:
+        outcomes[str(outcome)] = outcomes.get(str(outcome), 0) + 1
+    answered = [(due, done) for outcome, due, done in results if outcome == 200]
+    latencies = [done - due for due, done in answered]
+    ok = len(answered)
+    # Between the first and last answers, so neither the wait for the first nor the drain after
+    # the last arrival dilutes it; when overloaded, that's the rate the server keeps up
+    answering = max(done for _, done in answered) - min(done for _, done in answered) if ok > 1 else 0
+    result = {
+        "rate": rate,
+        "sent": len(results),
+        "ok": ok,
+        "errorRate": 1 - ok / len(results) if results else 0.0,
+        "outcomes": outcomes,
+        "throughput": (ok - 1) / answering if answering else 0.0,
+        "seconds": elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "clientCpu": (time.process_time() - client_start) / elapsed,
+    }
+    if sampler:
+        sampling.cancel()
+        cpu, rss = server_usage(pid)
+        result["serverCpu"] = (cpu - cpu_start) / elapsed
+        result["serverRssBytes"] = rss
+        result["serverPeakRssBytes"] = max(sampler.peak, rss)
+    return result
+
+
+def seconds(value):
+    return "     -" if value is None else f"{value:6.3f}"
+
+
+def show(result):
+    line = (f"{result['rate']:7.1f}/s  sent {result['sent']:6d}  ok {result['ok']:6d}  errors {result['errorRate']:6.1%}  "
+            f"throughput {result['throughput']:7.1f}/s  p50 {seconds(result['p50'])}s  p95 {seconds(result['p95'])}s  "
+            f"p99 {seconds(result['p99'])}s")
+    if "serverCpu" in result:
+        line += (f"  server cpu {result['serverCpu']:5.0%} rss {result['serverRssBytes'] / 2 ** 20:5.0f} MB "
+                 f"(peak {result['serverPeakRssBytes'] / 2 ** 20:.0f})")
+    line += f"  client cpu {result['clientCpu']:4.0%}"
+    errors = {outcome: count for outcome, count in result["outcomes"].items() if outcome != "200"}
+    if errors:
+        line += f"  {errors}"
+    print(line)
+
+
+def upstream_env(args):
+    if args.cassette:
+        return {"CASSETTE_REPLAY": os.path.abspath(args.cassette), "CASSETTE_LATENCY_SCALE": str(args.latency_scale)}
+    return {
+        "FAKE_UPSTREAM": "1",
+        "FAKE_UPSTREAM_LATENCY": str(args.latency),
+        "FAKE_UPSTREAM_SIGMA": str(args.sigma),
+        "FAKE_UPSTREAM_SLOW_FRACTION": str(args.slow_fraction),
+        "FAKE_UPSTREAM_SLOW_SECONDS": str(args.slow_seconds),
+        "FAKE_UPSTREAM_ERROR_RATE": str(args.error_rate),
+        "FAKE_UPSTREAM_ERROR_CODE": str(args.error_code),
+        "FAKE_UPSTREAM_CHUNK_SECONDS": str(args.chunk_seconds),
+        "FAKE_UPSTREAM_CHUNK_CHARS": str(args.chunk_chars),
+        "FAKE_UPSTREAM_OUTPUT": args.output,
+        "FAKE_UPSTREAM_SEED": str(args.seed),
+    }
+
+
+def run(args, host, port, pid):
+    rng = random.Random(args.seed)
+    texts = recorded_descriptions(args.cassette) if args.cassette else descriptions(args.distinct, rng)
+    results = []
+    for rate in args.rates:
+        result = asyncio.run(step(host, port, args.path, rate, args.duration, texts, args.timeout, rng, pid))
+        show(result)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Load test the server offline: starts it on a fake Gemini backend and sends requests "
+                    "at fixed arrival rates, reporting latency percentiles, throughput, errors and server CPU/memory")
+    parser.add_argument("--server", choices=sorted(SERVERS), default="asgi")
+    parser.add_argument("--web-workers", type=int, default=os.cpu_count() or 1, help="gunicorn workers")
+    parser.add_argument("--url", help="test a server that is already running here instead of starting one")
+    parser.add_argument("--pid", type=int, help="process id of the --url server, for its CPU and memory")
+    parser.add_argument("--path", default="/parse_description", help="/parse_description or /parse_description/stream")
+    parser.add_argument("--rates", type=lambda value: [float(rate) for rate in value.split(",")], default=[5, 10, 20, 40],
+                        help="comma separated arrival rates in requests/s, run one after another")
+    parser.add_argument("--duration", type=float, default=15, help="seconds at each rate")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="descriptions to draw from, Zipf-like; 0 for a new one every request")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before a request counts as failed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file, to compare runs")
+    parser.add_argument("--cassette", help="answer from this recorded cassette instead of the fake, sending the "
+                                           "descriptions recorded in it")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="multiplies the cassette's recorded latency, 0 to answer straight away")
+    backend = parser.add_argument_group("fake backend")
+    backend.add_argument("--latency", type=float, default=1.0, help="median seconds to the first chunk")
+    backend.add_argument("--sigma", type=float, default=0.3, help="log-normal spread of the latency, 0 for fixed")
+    backend.add_argument("--slow-fraction", type=float, default=0.0, help="share of calls that take --slow-seconds")
+    backend.add_argument("--slow-seconds", type=float, default=10.0)
+    backend.add_argument("--error-rate", type=float, default=0.0, help="share of calls that fail")
+    backend.add_argument("--error-code", type=int, default=503, help="status the failures carry, 429 for out of quota")
+    backend.add_argument("--chunk-seconds", type=float, default=0.02, help="seconds between streamed chunks")
+    backend.add_argument("--chunk-chars", type=int, default=200, help="characters per streamed chunk")
+    backend.add_argument("--output", default="canned",
+                      help='"canned" for a sample world, "synthesized" for random ones, or a JSON file of worlds')
+    args = parser.parse_args()
+
+    if args.cassette:
+        sent = f"descriptions recorded in {args.cassette}"
+    else:
+        sent = f"{args.distinct or 'all new'} descriptions"
+    print(f"{args.path}, {sent}, {args.duration:.0f}s per rate")
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        results = run(args, url.hostname, url.port or 80, args.pid)
+    else:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as directory, open(os.path.join(directory, "server.log"), "w+") as log:
+            env = {**os.environ, **upstream_env(args), "PORT": str(port), "WEB_WORKERS": str(args.web_workers),
+                   "STORE_PATH": os.path.join(directory, "worlds.db"), "METRICS_DIR": os.path.join(directory, "metrics")}
+            process = subprocess.Popen(SERVERS[args.server], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                       stdout=subprocess.DEVNULL, stderr=log)
+            try:
+                wait_for(f"http://127.0.0.1:{port}/readyz", process, 30)
+                if args.cassette:
+                    print(f"{args.server} replaying {args.cassette} at {args.latency_scale}x the recorded latency")
+                else:
+                    print(f"{args.server} on a fake upstream answering in {args.latency}s (sigma {args.sigma}), "
+                          f"{args.error_rate:.0%} errors")
+                results = run(args, "127.0.0.1", port, process.pid)
+            except RuntimeError:
+                log.seek(0)
+                print(log.read()[-4000:], file=sys.stderr)
+                raise
+            finally:
+                process.terminate()
+                process.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "steps": results}, f, indent=2)
@@ -0,0 +1,270 @@
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+RATIO_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1)
+CPU_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+
+# With several worker processes, each one writes its metrics here and /metrics adds them up
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 1))
+
+
+# Metrics keep their values in a dict keyed by label values. Updates take a lock, which costs
+# well under a microsecond uncontended, so a request's worth of instrumentation stays in the low µs.
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        self.add(labels, amount)
+
+    def add(self, labels, amount):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, merged, values):
+        for labels, value in values:
+            merged[tuple(labels)] = merged.get(tuple(labels), 0) + value
+
+    def samples(self, merged):
+        for labels, value in merged.items():
+            yield self.name, self.labels, labels, value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels):
+        self.add(labels, -1)
+
+    # Counts everything inside the with block, e.g. `with in_flight.track("upstream"):`
+    def track(self, *labels):
+        return Tracked(self, labels)
+
+
+class Tracked:
+    def __init__(self, gauge, labels):
+        self.gauge = gauge
+        self.labels = labels
+
+    def __enter__(self):
+        self.gauge.add(self.labels, 1)
+
+    def __exit__(self, *exc):
+        self.gauge.add(self.labels, -1)
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: a count per bucket (plus +Inf), then sum
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        self.add(labels, value)
+
+    def add(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    # Observes the time spent inside the with block, e.g. `with stage_seconds.time("validate"):`
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), list(series)] for labels, series in self.values.items()]
+
+    def merge(self, merged, values):
+        for labels, series in values:
+            total = merged.setdefault(tuple(labels), [0] * len(series))
+            for i, value in enumerate(series):
+                total[i] += value
+
+    def samples(self, merged):
+        for labels, series in merged.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield self.name + "_bucket", self.labels + ("le",), labels + (str(bound),), cumulative
+            yield self.name + "_sum", self.labels, labels, series[-1]
+            yield self.name + "_count", self.labels, labels, cumulative
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.add(self.labels, time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.flusher = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    # Values of this process, plus those the other workers last wrote to METRICS_DIR.
+    # Gauges of workers that stopped writing are dropped; their counters are kept.
+    def collect(self):
+        snapshots = [self.snapshot()]
+        if METRICS_DIR:
+            stale = time.time() - 3 * METRICS_FLUSH_SECONDS
+            for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+                if path == self.path():
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshot = json.load(f)
+                    if os.path.getmtime(path) < stale:
+                        snapshot = {name: values for name, values in snapshot.items() if name not in self.gauges()}
+                    snapshots.append(snapshot)
+                except (OSError, ValueError):
+                    pass
+
+        merged = {metric.name: {} for metric in self.metrics}
+        for snapshot in snapshots:
+            for metric in self.metrics:
+                metric.merge(merged[metric.name], snapshot.get(metric.name, []))
+        return merged
+
+    def gauges(self):
+        return {metric.name for metric in self.metrics if metric.type == "gauge"}
+
+    # Prometheus text exposition format
+    def render(self):
+        merged = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, label_names, label_values, value in metric.samples(merged[metric.name]):
+                if label_names:
+                    labels = ",".join(f'{k}="{v}"' for k, v in zip(label_names, label_values))
+                    lines.append(f"{name}{{{labels}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def path(self):
+        return os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+
+    def flush(self):
+        path = self.path()
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def start_flushing(self):
+        if METRICS_DIR and self.flusher is None:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            self.flusher = threading.Thread(target=self.flush_forever, daemon=True)
+            self.flusher.start()
+
+    # A forked worker starts from zero and needs its own flusher
+    def after_fork(self):
+        for metric in self.metrics:
+            metric.lock = threading.Lock()
+            metric.values = {}
+        self.flusher = None
+        self.start_flushing()
+
+    def flush_forever(self):
+        while True:
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Error writing metrics: {e}")
+            time.sleep(METRICS_FLUSH_SECONDS)
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "ezworld_stage_seconds", "Time spent in each generation stage", ("stage",)))
+generations_total = registry.register(Counter(
+    "ezworld_generations_total", "Generation requests by how they were answered", ("outcome",)))
+in_flight = registry.register(Gauge(
+    "ezworld_in_flight", "Generations and upstream calls currently running", ("kind",)))
+response_bytes = registry.register(Histogram(
+    "ezworld_response_bytes", "Size of the WorldInfo JSON returned", buckets=SIZE_BUCKETS))
+prompt_tokens = registry.register(Histogram(
+    "ezworld_prompt_tokens", "Prompt tokens per upstream call, estimated when the API doesn't report them", buckets=TOKEN_BUCKETS))
+cached_tokens = registry.register(Histogram(
+    "ezworld_cached_prompt_tokens", "Prompt tokens per upstream call that came from a cached context", buckets=TOKEN_BUCKETS))
+output_tokens = registry.register(Histogram(
+    "ezworld_output_tokens", "Output tokens per upstream call, estimated when the API doesn't report them", buckets=TOKEN_BUCKETS))
+
+ratelimit_queued = registry.register(Gauge(
+    "ezworld_ratelimit_queued", "Upstream calls waiting for rate limit quota"))
+ratelimit_wait = registry.register(Histogram(
+    "ezworld_ratelimit_wait_seconds", "Time upstream calls waited for rate limit quota"))
+ratelimit_rejected = registry.register(Counter(
+    "ezworld_ratelimit_rejected_total", "Requests turned away by the rate limiter, and quota errors from the API", ("reason",)))
+
+upstream_calls = registry.register(Counter(
+    "ezworld_upstream_calls_total", "Upstream calls by pool member and outcome (ok, error, quota, rejected)", ("member", "outcome")))
+upstream_seconds = registry.register(Histogram(
+    "ezworld_upstream_member_seconds", "Latency of successful upstream calls by pool member", ("member",)))
+upstream_ejections = registry.register(Counter(
+    "ezworld_upstream_ejections_total", "Times a pool member was taken out of rotation, for errors or quota", ("member", "reason")))
+
+compression_ratio = registry.register(Histogram(
+    "ezworld_compression_ratio", "Compressed over original size of each compressed response", ("encoding",), RATIO_BUCKETS))
+compression_seconds = registry.register(Histogram(
+    "ezworld_compression_cpu_seconds", "CPU time spent compressing each response", ("encoding",), CPU_BUCKETS))
+compression_cache = registry.register(Counter(
+    "ezworld_compression_cache_total", "Compressed responses by whether the compressed bytes were cached", ("result",)))
+
+
+# Gemini reports usage on each response; otherwise assume about four characters per token
+def record_tokens(prompt, response_text, usage=None):
+    prompt_count = getattr(usage, "prompt_token_count", 0) or len(prompt) // 4
+    output_count = getattr(usage, "candidates_token_count", 0) or len(response_text) // 4
+    prompt_tokens.observe(prompt_count)
+    cached_tokens.observe(getattr(usage, "cached_content_token_count", 0) or 0)
+    output_tokens.observe(output_count)
+    return prompt_count, output_count
+
+
+registry.start_flushing()
+os.register_at_fork(after_in_child=registry.after_fork)
@@ -0,0 +1,248 @@
+import asyncio
+import threading
+import time
+
+from metrics import upstream_calls, upstream_ejections, upstream_seconds
+
+
+# How a failed call reflects on the member that made it: "quota" when its key is out of quota,
+# "rejected" when the request itself was refused (the next member would refuse it too), and
+# "error" for everything else: timeouts, server errors, a bad key, a broken connection
+def outcome(error):
+    code = getattr(error, "code", None)
+    if code == 429:
+        return "quota"
+    if isinstance(code, int) and 400 <= code < 500 and code not in (401, 403, 408):
+        return "rejected"
+    return "error"
+
+
+# One API key and model. The client is made on first use by connect(model_name, api_key),
+# unless a model is given, e.g. a stand-in for benchmarks.
+class Member:
+    def __init__(self, name, model_name=None, api_key=None, limiter=None, connect=None, model=None):
+        self.name = name
+        self.model_name = model_name
+        self.api_key = api_key
+        self.limiter = limiter
+        self.connect = connect
+        self.model = model
+        self.connect_lock = threading.Lock()
+        self.lock = threading.Lock()
+        # EWMAs of successful call latency, and of the fraction of calls failing
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        # Consecutive failures, and consecutive ejections, which double the time out each time
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.calls = 0
+        self.errors = 0
+
+    def client(self):
+        if self.model is None:
+            with self.connect_lock:
+                if self.model is None:
+                    self.model = self.connect(self.model_name, self.api_key)
+        return self.model
+
+    async def client_async(self):
+        if self.model is not None:
+            return self.model
+        return await asyncio.to_thread(self.client)
+
+    def available(self, now):
+        return self.ejected_until <= now
+
+    def cost(self, prompt):
+        return self.limiter.cost(prompt) if self.limiter is not None else 0
+
+    # Expected seconds until a new call would be answered: the wait for quota, then the usual
+    # latency stretched by the calls already in flight and by the calls that have to be retried
+    def score(self, cost, typical):
+        latency = self.latency if self.latency is not None else typical
+        wait = self.limiter.expected_wait(cost) if self.limiter is not None else 0.0
+        return wait + latency * (self.in_flight + 1) / (1 - min(self.error_rate, 0.9))
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+        return time.perf_counter()
+
+    # A call that was given up on, e.g. the losing hedge, says nothing about the member
+    def cancel(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def end(self, pool, start, error=None):
+        seconds = time.perf_counter() - start
+        result = "ok" if error is None else outcome(error)
+        upstream_calls.inc(self.name, result)
+        ejected = None
+        with self.lock:
+            self.in_flight -= 1
+            self.calls += 1
+            if result == "ok":
+                upstream_seconds.observe(seconds, self.name)
+                self.latency = seconds if self.latency is None else self.latency + pool.weight * (seconds - self.latency)
+                self.error_rate *= 1 - pool.weight
+                self.failures = 0
+                self.ejections = 0
+            elif result == "error":
+                self.errors += 1
+                self.error_rate += pool.weight * (1 - self.error_rate)
+                self.failures += 1
+                # Calls still in flight when the member was ejected don't eject it again
+                now = time.monotonic()
+                if self.available(now) and (self.failures >= pool.eject_failures or self.error_rate > pool.eject_error_rate):
+                    ejected = min(pool.eject_seconds * 2 ** self.ejections, pool.eject_max_seconds)
+                    self.ejections += 1
+                    self.failures = 0
+                    self.ejected_until = now + ejected
+        if result == "quota":
+            # Out of rotation until the quota is expected back
+            retry_after = self.limiter.exhausted() if self.limiter is not None else pool.quota_seconds
+            with self.lock:
+                self.ejected_until = max(self.ejected_until, time.monotonic() + retry_after)
+            upstream_ejections.inc(self.name, "quota")
+        elif ejected is not None:
+            upstream_ejections.inc(self.name, "errors")
+            print(f"Upstream {self.name} ejected for {ejected:.0f}s after errors, last: {error}")
+
+    def call(self, pool, fn):
+        start = self.begin()
+        try:
+            result = fn(self.client())
+        except Exception as e:
+            self.end(pool, start, e)
+            raise
+        except BaseException:
+            self.cancel()
+            raise
+        self.end(pool, start)
+        return result
+
+    async def call_async(self, pool, fn):
+        start = self.begin()
+        try:
+            result = await fn(await self.client_async())
+        except Exception as e:
+            self.end(pool, start, e)
+            raise
+        except BaseException:
+            self.cancel()
+            raise
+        self.end(pool, start)
+        return result
+
+    def stats(self, now):
+        with self.lock:
+            return {
+                "model": self.model_name,
+                "connected": self.model is not None,
+                "latencySeconds": self.latency,
+                "errorRate": round(self.error_rate, 4),
+                "inFlight": self.in_flight,
+                "calls": self.calls,
+                "errors": self.errors,
+                "available": self.available(now),
+                "ejectedForSeconds": round(max(0.0, self.ejected_until - now), 3),
+                "quota": self.limiter.stats() if self.limiter is not None else None,
+                "promptContext": self.model.context.stats() if getattr(self.model, "context", None) else None,
+            }
+
+
+# Upstream calls spread over several API keys and models. Each call goes to the member expected
+# to answer soonest, judging by its latency, error rate, calls in flight and quota left. Members
+# that keep failing are taken out of rotation for eject_seconds, doubling each time they fail
+# again straight after coming back, and those out of quota until it refills. A call that fails
+# on one member is retried on another, up to attempts members in all.
+class UpstreamPool:
+    def __init__(self, members, attempts=2, weight=0.2, eject_failures=3, eject_error_rate=0.5, eject_seconds=10,
+                 eject_max_seconds=300, quota_seconds=60):
+        self.members = members
+        self.attempts = attempts
+        self.weight = weight
+        self.eject_failures = eject_failures
+        self.eject_error_rate = eject_error_rate
+        self.eject_seconds = eject_seconds
+        self.eject_max_seconds = eject_max_seconds
+        self.quota_seconds = quota_seconds
+
+    # The best available member outside exclude. With none available and panic set, the one
+    # due back soonest, since trying it beats refusing the call outright.
+    def choose(self, prompt, exclude=(), panic=True):
+        now = time.monotonic()
+        candidates = [member for member in self.members if member not in exclude]
+        available = [member for member in candidates if member.available(now)]
+        if not available:
+            if panic and candidates:
+                return min(candidates, key=lambda member: member.ejected_until)
+            return None
+        known = [member.latency for member in available if member.latency is not None]
+        typical = sum(known) / len(known) if known else 1.0
+        return min(available, key=lambda member: member.score(member.cost(prompt), typical))
+
+    # A member outside exclude with quota to spare right now, and the quota taken: (member, cost) or None
+    def reserve(self, prompt, exclude=()):
+        member = self.choose(prompt, exclude, panic=False)
+        if member is None:
+            return None
+        cost = member.cost(prompt)
+        if member.limiter is not None and not member.limiter.try_acquire(cost):
+            return None
+        return member, cost
+
+    # Another member for a call that failed on those tried, or None if it isn't worth retrying
+    def failover(self, prompt, tried, error):
+        if len(tried) >= self.attempts or outcome(error) == "rejected":
+            return None
+        return self.reserve(prompt, tried)
+
+    # fn(model) on member, which has already been given cost of its quota, failing over to
+    # other members. Returns (result, the member that answered, the quota it was given).
+    def call(self, prompt, member, cost, fn):
+        tried = [member]
+        while True:
+            try:
+                return member.call(self, fn), member, cost
+            except Exception as e:
+                retry = self.failover(prompt, tried, e)
+                if retry is None:
+                    raise
+                member, cost = retry
+                tried.append(member)
+
+    async def call_async(self, prompt, member, cost, fn):
+        tried = [member]
+        while True:
+            try:
+                return await member.call_async(self, fn), member, cost
+            except Exception as e:
+                retry = self.failover(prompt, tried, e)
+                if retry is None:
+                    raise
+                member, cost = retry
+                tried.append(member)
+
+    # Seconds until some member is back in rotation, for the Retry-After of a quota error
+    def retry_after(self):
+        now = time.monotonic()
+        return min(max(0.0, member.ejected_until - now) for member in self.members)
+
+    def connected(self):
+        return any(member.model is not None for member in self.members)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "attempts": self.attempts,
+            "available": sum(1 for member in self.members if member.available(now)),
+            "members": {member.name: member.stats(now) for member in self.members},
+        }
+
+    def limiter_stats(self):
+        if all(member.limiter is None for member in self.members):
+            return {"enabled": False}
+        return {member.name: member.limiter.stats() for member in self.members if member.limiter is not None}
@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import generation
+from cache import canonicalize, response_cache
+from metrics import generations_total
+from similarity import similarity_cache
+from store import store_key, world_store
+
+# Answers that didn't need the model
+WITHOUT_MODEL = ("cache", "store", "preset", "similar")
+
+
+# (description, time) for each request in a log: JSON lines with "description" and optionally
+# "time" (Unix seconds), or plain lines of descriptions, taken as made when the file was last written
+def read_log(path):
+    modified = os.path.getmtime(path)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = line
+            if isinstance(record, dict):
+                if isinstance(record.get("description"), str):
+                    yield record["description"], float(record.get("time") or modified)
+            elif isinstance(record, str):
+                yield record, modified
+
+
+# Warms the caches after a restart with the worlds most likely to be asked for again: ranked by
+# how often they were asked for (as recorded by the store, and in the request log if there is
+# one), halved for every half_life seconds since they were last asked for. The top ones are
+# loaded into the response and similarity caches; up to regenerate of those the store doesn't
+# have are generated again once the model is ready. How much of the traffic in the first
+# report_seconds was answered without the model is printed, and kept in stats().
+class Preloader:
+    def __init__(self, store, top, log_path=None, half_life=24 * 3600, regenerate=0, report_seconds=300):
+        self.store = store
+        self.top = top
+        self.log_path = log_path
+        self.half_life = half_life
+        self.regenerate = regenerate
+        self.report_seconds = report_seconds
+        self.thread = None
+        # "idle", "loading", "regenerating", "done" or "failed"
+        self.status = "idle"
+        self.started = None
+        self.candidates = 0
+        self.loaded = 0
+        self.regenerated = 0
+        self.failed = 0
+        self.load_seconds = None
+        # Generations counted before warm-up started, and those warm-up made itself
+        self.baseline = Counter()
+        self.own = Counter()
+        self.first_minutes = None
+
+    def start(self):
+        if self.thread is not None or self.top <= 0 or (self.store is None and not self.log_path):
+            return
+        self.started = time.time()
+        self.baseline = self.generations()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        reporter = threading.Timer(self.report_seconds, self.report)
+        reporter.daemon = True
+        reporter.start()
+
+    # {canonical description: [hits, last asked for, hashed key or None]}
+    def demand(self):
+        demand = {}
+        if self.store is not None:
+            for hashed, description, hits, used in self.store.usage(generation.PROMPT_VERSION, generation.MODEL_NAME):
+                demand[description] = [hits, used, hashed]
+        if self.log_path:
+            for description, at in read_log(self.log_path):
+                entry = demand.setdefault(canonicalize(description), [0, at, None])
+                entry[0] += 1
+                entry[1] = max(entry[1], at)
+        return demand
+
+    def rank(self, demand):
+        now = time.time()
+
+        def score(item):
+            hits, used, _ = item[1]
+            return hits * 0.5 ** (max(0.0, now - used) / self.half_life)
+
+        return sorted(demand.items(), key=score, reverse=True)[:self.top]
+
+    def run(self):
+        self.status = "loading"
+        start = time.perf_counter()
+        try:
+            ranked = self.rank(self.demand())
+        except Exception as e:
+            self.status = "failed"
+            print(f"Cache warm-up failed: {e}")
+            return
+        self.candidates = len(ranked)
+
+        missing = []
+        for description, (_, _, hashed) in ranked:
+            key = (description, generation.PROMPT_VERSION, generation.MODEL_NAME)
+            world = None
+            if self.store is not None:
+                world = self.store.get_hashed(hashed or store_key(key))
+            if world is None:
+                missing.append(description)
+                continue
+            response_cache.put(key, world)
+            if similarity_cache is not None:
+                similarity_cache.put(description, world)
+            self.loaded += 1
+        self.load_seconds = time.perf_counter() - start
+        print(f"Cache warm-up: loaded {self.loaded} of the {self.candidates} most asked for worlds "
+              f"in {self.load_seconds * 1000:.0f} ms")
+
+        missing = missing[:self.regenerate]
+        if missing:
+            self.status = "regenerating"
+            generation.ready.wait()
+            for description in missing:
+                try:
+                    self.own[generation.generate(description).source] += 1
+                    self.regenerated += 1
+                except Exception as e:
+                    self.own["error"] += 1
+                    self.failed += 1
+                    print(f"Cache warm-up: error regenerating {description!r}: {e}")
+            print(f"Cache warm-up: regenerated {self.regenerated} of {len(missing)} worlds missing from the store")
+        self.status = "done"
+
+    def generations(self):
+        return Counter({labels[0]: value for labels, value in generations_total.snapshot()})
+
+    # How requests since startup were answered, leaving out warm-up's own generations
+    def traffic(self):
+        counts = self.generations()
+        counts.subtract(self.baseline)
+        counts.subtract(self.own)
+        counts = +counts
+        answered = sum(count for outcome, count in counts.items() if outcome != "error")
+        return {
+            "seconds": round(time.time() - self.started, 1),
+            "requests": answered,
+            "hitRate": sum(counts[outcome] for outcome in WITHOUT_MODEL) / answered if answered else None,
+            "cacheHitRate": counts["cache"] / answered if answered else None,
+            "bySource": dict(counts),
+        }
+
+    def report(self):
+        self.first_minutes = self.traffic()
+        hit_rate = self.first_minutes["hitRate"]
+        print(f"Cache warm-up: {self.first_minutes['requests']} requests in the first {self.report_seconds:.0f}s, "
+              f"{'no' if hit_rate is None else f'{hit_rate:.0%}'} answered without the model, "
+              f"by source {self.first_minutes['bySource']}")
+
+    def stats(self):
+        stats = {
+            "status": self.status,
+            "top": self.top,
+            "candidates": self.candidates,
+            "loaded": self.loaded,
+            "regenerated": self.regenerated,
+            "failed": self.failed,
+            "loadSeconds": self.load_seconds,
+        }
+        if self.started is not None:
+            stats["sinceStart"] = self.traffic()
+            stats["firstMinutes"] = self.first_minutes
+        return stats
+
+
+preloader = Preloader(
+    world_store,
+    top=int(os.environ.get("WARM_UP_TOP", 500)),
+    log_path=os.environ.get("WARM_UP_LOG") or None,
+    half_life=float(os.environ.get("WARM_UP_HALF_LIFE_HOURS", 24)) * 3600,
+    regenerate=int(os.environ.get("WARM_UP_REGENERATE", 0)),
+    report_seconds=float(os.environ.get("WARM_UP_REPORT_SECONDS", 300)),
+)
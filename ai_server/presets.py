@@ -0,0 +1,363 @@
+import copy
+import json
+import os
+import threading
+from functools import lru_cache
+
+import schema
+from similarity import tokenize
+
+# Preset library of complete worlds for the biomes most descriptions ask for, plus a keyword
+# matcher that answers a description from it when every word is accounted for.
+
+NO_TREES = {
+    "octaves": 0, "scale": 0, "lacunarity": 0, "persistence": 0, "offset": 2000, "minLevel": 0, "maxLevel": 0,
+    "maxSteepness": 0, "islandSize": 0, "density": 0, "randomize": False, "treePrototypes": 0,
+}
+NO_GRASS = {
+    "octaves": 0, "scale": 0, "lacunarity": 0, "persistence": 0, "offset": 1000, "minLevel": -100, "maxLevel": 100,
+    "maxSteepness": 50, "islandSize": 0.5, "density": 0, "randomize": False, "grassTextures": 0,
+}
+NO_WATER = {"waterType": "none", "waterLevel": 0, "riverWidthRange": {"x": 100, "y": 500}, "randomize": False}
+
+
+def texture(name, height_curve, tile_x, tile_y):
+    return {"texture": name, "heightCurve": height_curve, "tileSizeX": tile_x, "tileSizeY": tile_y}
+
+
+def terrain(heights, textures, trees, grass, water):
+    return {
+        "heightsGeneratorData": {"width": 1024, "height": 1024, "useFalloffMap": True, "randomize": True, **heights},
+        "texturesGeneratorDataList": textures,
+        "treeGeneratorData": trees,
+        "grassGeneratorData": grass,
+        "waterGeneratorData": water,
+    }
+
+
+def atmosphere(time_of_day, sky, fog=0.0, exposure=1.3, thickness=1.0):
+    return {
+        "timeOfDay": time_of_day, "sunSize": 0.05, "skyTint": dict(zip("rgb", sky)), "atmosphericThickness": thickness,
+        "exposure": exposure, "fogIntensity": fog, "fogColor": {"r": 0.5, "g": 0.5, "b": 0.5},
+    }
+
+
+PRESETS = {
+    "desert": {
+        "keywords": {"desert", "dune", "sandy", "arid", "sahara"},
+        "modifiers": {"sand", "dry", "hot", "barren", "dead", "dusty"},
+        "world": {
+            "terrainsData": [terrain(
+                {"depth": 162, "octaves": 8, "scale": 300, "lacunarity": 2, "persistence": 0.1, "heightCurve": "easeIn",
+                 "heightCurveOffset": 8000, "falloffDirection": 2, "falloffRange": 2},
+                [texture("desert", "linear", 20, 20), texture("sand", "easeIn", 15, 15)],
+                NO_TREES, NO_GRASS, NO_WATER,
+            )],
+            "objectList": [],
+            "atmosphereGeneratorData": atmosphere(13, (0.6, 0.55, 0.45), exposure=1.5, thickness=1.2),
+        },
+    },
+    "snowy_mountains": {
+        "keywords": {"snowy", "snow", "mountain", "peak", "alpine"},
+        # A bare "snow" or "mountains" leaves the rest of the world to the model
+        "requires": ({"snowy", "snow", "alpine"}, {"mountain", "peak", "alpine"}),
+        "modifiers": {"rocky", "cold", "tall", "high", "winter", "range"},
+        "world": {
+            "terrainsData": [terrain(
+                {"depth": 200, "octaves": 10, "scale": 250, "lacunarity": 2.5, "persistence": 0.18, "heightCurve": "easeIn",
+                 "heightCurveOffset": 10000, "falloffDirection": 3, "falloffRange": 3},
+                [texture("snow", "easeIn", 20, 20), texture("mountainRock", "linear", 12, 12), texture("rock", "constant", 8, 10)],
+                NO_TREES, NO_GRASS, NO_WATER,
+            )],
+            "objectList": [],
+            "atmosphereGeneratorData": atmosphere(11, (0.55, 0.6, 0.7), fog=0.02),
+        },
+    },
+    "forest": {
+        "keywords": {"forest", "wood", "woodland", "tree", "jungle", "pine"},
+        "modifiers": {"dense", "thick", "green", "lush", "hill", "hilly"},
+        "world": {
+            "terrainsData": [terrain(
+                {"depth": 90, "octaves": 5, "scale": 200, "lacunarity": 2, "persistence": 0.1, "heightCurve": "linear",
+                 "heightCurveOffset": 6000, "falloffDirection": 2, "falloffRange": 2},
+                [texture("forestFloor", "constant", 10, 10), texture("grass", "linear", 14, 14), texture("dirt", "easeOut", 8, 9)],
+                {"octaves": 4, "scale": 50, "lacunarity": 2, "persistence": 0.5, "offset": 3000, "minLevel": 0,
+                 "maxLevel": 100, "maxSteepness": 45, "islandSize": 1, "density": 1, "randomize": True,
+                 "treePrototypes": 6},
+                {"octaves": 3, "scale": 20, "lacunarity": 2, "persistence": 0.5, "offset": 5000, "minLevel": -150,
+                 "maxLevel": 150, "maxSteepness": 70, "islandSize": 0.8, "density": 0.8, "randomize": True,
+                 "grassTextures": 6},
+                NO_WATER,
+            )],
+            "objectList": [],
+            "atmosphereGeneratorData": atmosphere(10, (0.5, 0.55, 0.5), fog=0.02),
+        },
+    },
+    "island": {
+        "keywords": {"island", "archipelago", "atoll"},
+        "modifiers": {"tropical", "beach", "sandy", "small", "palm"},
+        "world": {
+            "terrainsData": [terrain(
+                {"depth": 80, "octaves": 6, "scale": 150, "lacunarity": 2, "persistence": 0.12, "heightCurve": "easeOut",
+                 "heightCurveOffset": 7000, "falloffDirection": 4, "falloffRange": 4},
+                [texture("sand", "easeOut", 12, 12), texture("grass", "linear", 15, 15)],
+                {"octaves": 3, "scale": 30, "lacunarity": 2, "persistence": 0.5, "offset": 5000, "minLevel": 10,
+                 "maxLevel": 60, "maxSteepness": 40, "islandSize": 0.5, "density": 0.3, "randomize": True,
+                 "treePrototypes": 4},
+                {"octaves": 2, "scale": 15, "lacunarity": 2, "persistence": 0.5, "offset": 4000, "minLevel": -100,
+                 "maxLevel": 120, "maxSteepness": 60, "islandSize": 0.7, "density": 0.6, "randomize": True,
+                 "grassTextures": 4},
+                {"waterType": "ocean", "waterLevel": 15, "riverWidthRange": {"x": 100, "y": 500}, "randomize": True},
+            )],
+            "objectList": [],
+            "atmosphereGeneratorData": atmosphere(12, (0.45, 0.6, 0.75), exposure=1.4),
+        },
+    },
+    "grassland": {
+        "keywords": {"grassland", "grass", "meadow", "plain", "field", "prairie", "savanna"},
+        "modifiers": {"flat", "green", "open", "rolling", "gentle", "grassy"},
+        "world": {
+            "terrainsData": [terrain(
+                {"depth": 65, "octaves": 3, "scale": 400, "lacunarity": 1.5, "persistence": 0.05, "heightCurve": "linear",
+                 "heightCurveOffset": 5000, "falloffDirection": 1, "falloffRange": 1},
+                [texture("grass", "constant", 10, 10), texture("dirt", "easeOut", 9, 8)],
+                {"octaves": 2, "scale": 60, "lacunarity": 2, "persistence": 0.5, "offset": 3000, "minLevel": 0,
+                 "maxLevel": 100, "maxSteepness": 45, "islandSize": 0.2, "density": 0.05, "randomize": True,
+                 "treePrototypes": 3},
+                {"octaves": 3, "scale": 20, "lacunarity": 2, "persistence": 0.5, "offset": 5000, "minLevel": -150,
+                 "maxLevel": 150, "maxSteepness": 70, "islandSize": 0.9, "density": 0.9, "randomize": True,
+                 "grassTextures": 8},
+                NO_WATER,
+            )],
+            "objectList": [],
+            "atmosphereGeneratorData": atmosphere(12, (0.5, 0.55, 0.65)),
+        },
+    },
+}
+
+BIOME_KEYWORDS = set().union(*(preset["keywords"] for preset in PRESETS.values()))
+
+# Words that don't say anything about the world
+NEUTRAL = {
+    "terrain", "world", "map", "land", "area", "place", "scene", "landscape", "biome", "big", "large", "huge",
+    "and", "in", "at", "on", "by", "for", "during", "under", "near", "around",
+}
+
+WATER = {
+    "lake": {"waterType": "lake", "waterLevel": 25},
+    "pond": {"waterType": "lake", "waterLevel": 15},
+    "river": {"waterType": "river", "waterLevel": 10, "riverWidthRange": {"x": 100, "y": 400}},
+    "ocean": {"waterType": "ocean", "waterLevel": 15},
+    "sea": {"waterType": "ocean", "waterLevel": 15},
+}
+
+ATMOSPHERE = {
+    "night": {"timeOfDay": 0, "exposure": 0.5},
+    "midnight": {"timeOfDay": 0, "exposure": 0.5},
+    "sunset": {"timeOfDay": 19, "skyTint": {"r": 0.7, "g": 0.45, "b": 0.35}},
+    "dusk": {"timeOfDay": 19, "skyTint": {"r": 0.7, "g": 0.45, "b": 0.35}},
+    "sunrise": {"timeOfDay": 7},
+    "dawn": {"timeOfDay": 6},
+    "morning": {"timeOfDay": 8},
+    "noon": {"timeOfDay": 12},
+    "sunny": {"timeOfDay": 12, "exposure": 1.6},
+    "foggy": {"fogIntensity": 0.05},
+    "fog": {"fogIntensity": 0.05},
+    "misty": {"fogIntensity": 0.02},
+}
+
+# "no trees" and the like zero out the module, as the prompt tells the model to
+NEGATIONS = {
+    "no_tree": ("treeGeneratorData", NO_TREES),
+    "no_forest": ("treeGeneratorData", NO_TREES),
+    "no_grass": ("grassGeneratorData", NO_GRASS),
+    "no_vegetation": ("treeGeneratorData", NO_TREES),
+    "no_water": ("waterGeneratorData", NO_WATER),
+    "no_lake": ("waterGeneratorData", NO_WATER),
+    "no_river": ("waterGeneratorData", NO_WATER),
+    "no_ocean": ("waterGeneratorData", NO_WATER),
+    "no_fog": ("atmosphereGeneratorData", {"fogIntensity": 0}),
+}
+
+
+class FastPathMatch:
+    def __init__(self, preset, confidence, modifiers):
+        self.preset = preset
+        self.confidence = confidence
+        self.modifiers = modifiers
+
+
+def match(description):
+    tokens = tokenize(description)
+    best, best_rank = None, None
+    for name, preset in PRESETS.items():
+        core = tokens & preset["keywords"]
+        if not core:
+            continue
+        explained = core | (tokens & preset["modifiers"]) | (tokens & NEUTRAL)
+        modifiers = tokens & (WATER.keys() | ATMOSPHERE.keys() | NEGATIONS.keys())
+        # "no grass" can't be explained by the grassland preset
+        if any(token[3:] in preset["keywords"] for token in modifiers):
+            continue
+        explained |= modifiers
+        content = tokens - NEUTRAL
+        confidence = len(explained - NEUTRAL) / len(content) if content else 0.0
+        # Another biome in the same description needs a terrain of its own, which only the model does
+        if (tokens & BIOME_KEYWORDS) - explained:
+            confidence = min(confidence, 0.5)
+        if any(not tokens & words for words in preset.get("requires", ())):
+            confidence = min(confidence, 0.5)
+        rank = (confidence, len(core))
+        if best is None or rank > best_rank:
+            best, best_rank = FastPathMatch(name, confidence, frozenset(modifiers)), rank
+    return best
+
+
+# Builds the validated world JSON for a preset with its modifiers applied, memoised per combination
+@lru_cache(maxsize=1024)
+def render(preset, modifiers):
+    world = copy.deepcopy(PRESETS[preset]["world"])
+    terrains = world["terrainsData"]
+    atmosphere_data = world["atmosphereGeneratorData"]
+
+    for token in sorted(modifiers):
+        if token in WATER:
+            for terrain_data in terrains:
+                terrain_data["waterGeneratorData"] = {**terrain_data["waterGeneratorData"], **WATER[token]}
+        elif token in ATMOSPHERE:
+            atmosphere_data.update(ATMOSPHERE[token])
+
+    # Negations last so "no water" wins over a water word elsewhere in the description
+    for token in sorted(modifiers):
+        if token in NEGATIONS:
+            module, values = NEGATIONS[token]
+            if module == "atmosphereGeneratorData":
+                atmosphere_data.update(values)
+            else:
+                for terrain_data in terrains:
+                    terrain_data[module] = {**terrain_data[module], **values}
+
+    return schema.dump(schema.validate_data(world))
+
+
+# Preset-plus-overrides output (OUTPUT_MODE=preset): each terrain, and the atmosphere, names a
+# preset and gives only the values that differ from it, which expand() fills in from the library
+# so clients get the same complete WorldInfo as before. A section without a preset is taken as it
+# is, so full output expands to itself.
+SECTION_BASES = {"terrainsData": ("terrainsData", schema.CustomTerrainData),
+                 "atmosphereGeneratorData": ("atmosphereGeneratorData", schema.AtmosphereGeneratorData)}
+
+
+# The preset's section as validation would leave it, the values overrides are compared against
+@lru_cache(maxsize=None)
+def base(section, preset):
+    key, model = SECTION_BASES[section]
+    value = PRESETS[preset]["world"][key]
+    return model.model_validate(value[0] if section == "terrainsData" else value).model_dump(exclude_none=True)
+
+
+# Nested objects are merged key by key, anything else (lists included) replaced
+def merge(value, overrides):
+    merged = dict(value)
+    for key, override in overrides.items():
+        if isinstance(override, dict) and isinstance(merged.get(key), dict):
+            override = merge(merged[key], override)
+        merged[key] = override
+    return merged
+
+
+def expand_section(section, value):
+    if section not in SECTION_BASES or not isinstance(value, dict) or "preset" not in value:
+        return value
+    overrides = dict(value)
+    preset = overrides.pop("preset")
+    water = overrides.get("waterGeneratorData")
+    # Older outputs' riverWidthRangeX/Y would otherwise lose to the preset's riverWidthRange
+    if isinstance(water, dict) and "riverWidthRangeX" in water:
+        water = dict(water)
+        water["riverWidthRange"] = {"x": water.pop("riverWidthRangeX"), "y": water.pop("riverWidthRangeY", 600)}
+        overrides["waterGeneratorData"] = water
+    # An unknown preset leaves the schema's defaults under the overrides, like any invalid field
+    return merge(base(section, preset), overrides) if preset in PRESETS else overrides
+
+
+def expand(world):
+    if not isinstance(world, dict):
+        return world
+    world = dict(world)
+    if isinstance(world.get("terrainsData"), list):
+        world["terrainsData"] = [expand_section("terrainsData", terrain) for terrain in world["terrainsData"]]
+    if "atmosphereGeneratorData" in world:
+        world["atmosphereGeneratorData"] = expand_section("atmosphereGeneratorData", world["atmosphereGeneratorData"])
+    return world
+
+
+# What a value adds to base: nested objects by key, anything else whole
+def difference(value, base_value):
+    if not isinstance(value, dict) or not isinstance(base_value, dict):
+        return value
+    return {key: difference(item, base_value.get(key)) for key, item in value.items() if item != base_value.get(key)}
+
+
+def overridden(section, value):
+    return min(({"preset": preset, **difference(value, base(section, preset))} for preset in PRESETS),
+               key=lambda overrides: len(json.dumps(overrides)))
+
+
+# The shortest preset-plus-overrides form of a world, against whichever preset each section is
+# closest to; expand() turns it back into the same validated world
+def compact(world):
+    world = schema.validate_data(copy.deepcopy(world)).model_dump(exclude_none=True)
+    world.pop("heightMap", None)
+    world["terrainsData"] = [overridden("terrainsData", terrain) for terrain in world["terrainsData"]]
+    world["atmosphereGeneratorData"] = overridden("atmosphereGeneratorData", world["atmosphereGeneratorData"])
+    return world
+
+
+# response_schema for preset-plus-overrides output: the WorldInfo schema with every field optional
+# and a preset required for each terrain and the atmosphere; objects are still given in full
+def overrides_schema():
+    preset = {"type": "string", "enum": sorted(PRESETS)}
+    world = schema.response_schema(partial=True)
+    for section in (world["properties"]["terrainsData"]["items"], world["properties"]["atmosphereGeneratorData"]):
+        section["properties"] = {"preset": preset, **section["properties"]}
+        section["required"] = ["preset"]
+    world["properties"]["objectList"] = schema.response_schema()["properties"]["objectList"]
+    return world
+
+
+class FastPath:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.by_preset = {}
+
+    # Returns (match, text) where text is None unless the match is confident enough to skip the model
+    def get(self, description):
+        found = match(description)
+        hit = found is not None and found.confidence >= self.threshold
+        with self.lock:
+            self.lookups += 1
+            if hit:
+                self.hits += 1
+                self.by_preset[found.preset] = self.by_preset.get(found.preset, 0) + 1
+        if not hit:
+            return found, None
+        return found, render(found.preset, found.modifiers)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "threshold": self.threshold,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hitRate": self.hits / self.lookups if self.lookups else 0.0,
+                "byPreset": dict(self.by_preset),
+            }
+
+
+# FAST_PATH_THRESHOLD is the share of the description's words a preset has to account for;
+# set it above 1 to always ask the model
+fast_path = FastPath(threshold=float(os.environ.get("FAST_PATH_THRESHOLD", 0.8)))
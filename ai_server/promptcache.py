@@ -0,0 +1,68 @@
+import hashlib
+import threading
+import time
+
+
+# Keeps the prompt's instructions stored upstream as a cached context, so each call sends only
+# the description and refers to the context by name. create(display_name, ttl) makes a context,
+# or finds one another worker already made, and returns (name, expiry as Unix time). The display
+# name carries a hash of the instructions, so a changed template never uses the old one's context.
+# A context is replaced margin seconds before it expires. When it can't be made, e.g. the
+# instructions are below the model's minimum size for caching, current() returns None so the
+# instructions go as a system instruction instead, and making one is tried again after retry_seconds.
+class ContextCache:
+    def __init__(self, create, instructions, ttl, margin=60, retry_seconds=300):
+        self.create = create
+        self.display_name = f"ezworld-{hashlib.sha1(instructions.encode()).hexdigest()[:12]}"
+        self.ttl = ttl
+        self.margin = margin
+        self.retry_seconds = retry_seconds
+        self.lock = threading.Lock()
+        self.name = None
+        self.expires = 0.0
+        self.failed_until = 0.0
+        self.created = 0
+        self.failures = 0
+        self.error = None
+
+    def fresh(self, now):
+        return self.name is not None and self.expires - self.margin > now
+
+    # Whether current() would have to make a context first, which the event loop shouldn't wait on
+    def due(self):
+        now = time.time()
+        return not self.fresh(now) and now >= self.failed_until
+
+    def current(self):
+        if not self.due():
+            return self.name if self.fresh(time.time()) else None
+        with self.lock:
+            now = time.time()
+            if self.fresh(now) or now < self.failed_until:
+                return self.name if self.fresh(now) else None
+            try:
+                self.name, self.expires = self.create(self.display_name, self.ttl)
+                self.created += 1
+                self.error = None
+            except Exception as e:
+                self.name = None
+                self.failures += 1
+                self.error = str(e)
+                self.failed_until = now + self.retry_seconds
+                print(f"Couldn't cache the prompt's instructions, sending them as a system instruction: {e}")
+        return self.name
+
+    # The context is gone before its time, e.g. deleted; the next call makes another
+    def invalidate(self, name):
+        with self.lock:
+            if self.name == name:
+                self.name = None
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "expiresInSeconds": round(max(0.0, self.expires - time.time()), 1) if self.name else None,
+            "created": self.created,
+            "failures": self.failures,
+            "error": self.error,
+        }
@@ -0,0 +1,184 @@
+import asyncio
+import math
+import os
+import threading
+import time
+
+from metrics import ratelimit_queued, ratelimit_rejected, ratelimit_wait
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Rate limited ({reason}), retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    # Whole seconds for the Retry-After header, never 0 so clients actually back off
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# Refills at per_minute / 60 per second up to burst_seconds worth. Reservations may take it
+# below zero; how far below is how long the last reservation has to wait.
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.available = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount):
+        return max(0.0, (amount - self.available) / self.rate)
+
+
+# Keeps upstream calls within the Gemini per-minute request and token quotas. Callers reserve
+# their share up front and sleep until it is theirs, so waiting callers are served in order and
+# the wait is known at admission: a call that couldn't start before its client gives up, or that
+# would overflow the queue, is rejected straight away with the time after which to retry.
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, burst_seconds=5, max_queue=100, expected_output=1500):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.max_queue = max_queue
+        # Output tokens aren't known until the response arrives, so a running average stands in
+        self.expected_output = expected_output
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def cost(self, prompt):
+        return len(prompt) // 4 + int(self.expected_output)
+
+    def amounts(self, tokens):
+        return [(bucket, amount) for bucket, amount in ((self.requests, 1), (self.tokens, tokens)) if bucket is not None]
+
+    # Returns how long the caller has to wait for its reservation, or raises RateLimited
+    def reserve(self, tokens, timeout=None, queue=True):
+        with self.lock:
+            now = time.monotonic()
+            amounts = self.amounts(tokens)
+            for bucket, amount in amounts:
+                bucket.refill(now)
+            wait = max((bucket.wait(amount) for bucket, amount in amounts), default=0.0)
+
+            if wait > 0:
+                reason = None
+                if not queue:
+                    reason = "busy"
+                elif self.queued >= self.max_queue:
+                    reason = "queue_full"
+                elif timeout is not None and wait > timeout:
+                    reason = "deadline"
+                if reason is not None:
+                    self.rejected += 1
+                    ratelimit_rejected.inc(reason)
+                    raise RateLimited(reason, wait)
+                self.queued += 1
+                ratelimit_queued.inc()
+
+            for bucket, amount in amounts:
+                bucket.available -= amount
+            self.admitted += 1
+        ratelimit_wait.observe(wait)
+        return wait
+
+    def dequeue(self):
+        with self.lock:
+            self.queued -= 1
+        ratelimit_queued.dec()
+
+    # Gives a reservation back when its caller went away before using it
+    def refund(self, tokens):
+        with self.lock:
+            for bucket, amount in self.amounts(tokens):
+                bucket.available += amount
+
+    def acquire(self, tokens, timeout=None):
+        wait = self.reserve(tokens, timeout)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self.dequeue()
+
+    async def acquire_async(self, tokens, timeout=None):
+        wait = self.reserve(tokens, timeout)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.refund(tokens)
+                raise
+            finally:
+                self.dequeue()
+
+    # How long a reservation made now would wait, without making it
+    def expected_wait(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            amounts = self.amounts(tokens)
+            for bucket, _ in amounts:
+                bucket.refill(now)
+            return max((bucket.wait(amount) for bucket, amount in amounts), default=0.0)
+
+    # For hedged attempts, which are only worth making if there's quota to spare right now
+    def try_acquire(self, tokens):
+        try:
+            self.reserve(tokens, queue=False)
+            return True
+        except RateLimited:
+            return False
+
+    # Charges the difference once the API has reported what a call actually used
+    def settle(self, estimated, used, output):
+        with self.lock:
+            if self.tokens is not None:
+                self.tokens.available -= used - estimated
+            self.expected_output += 0.1 * (output - self.expected_output)
+
+    # The API said we're over quota anyway (another process sharing the key, or a lower quota
+    # than configured): stop handing out reservations until the buckets have refilled, and
+    # return roughly how long that will take
+    def exhausted(self):
+        with self.lock:
+            amounts = self.amounts(int(self.expected_output))
+            for bucket, _ in amounts:
+                bucket.available = min(bucket.available, 0)
+            retry_after = max(bucket.wait(amount) for bucket, amount in amounts)
+        ratelimit_rejected.inc("upstream")
+        return retry_after
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requestsPerMinute": self.requests.rate * 60 if self.requests else None,
+                "tokensPerMinute": self.tokens.rate * 60 if self.tokens else None,
+                "queued": self.queued,
+                "maxQueue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "expectedOutputTokens": round(self.expected_output),
+            }
+
+
+# Off unless a quota is configured. Quotas are per API key and model, so each upstream pool member
+# gets a limiter of its own. A full bucket plus a minute of refill must fit in the quota, so set
+# them to about quota * 60 / (60 + burst seconds)
+RATE_LIMIT_RPM = float(os.environ.get("RATE_LIMIT_RPM", 0))
+RATE_LIMIT_TPM = float(os.environ.get("RATE_LIMIT_TPM", 0))
+
+
+def make_limiter():
+    if not (RATE_LIMIT_RPM or RATE_LIMIT_TPM):
+        return None
+    return RateLimiter(
+        RATE_LIMIT_RPM,
+        RATE_LIMIT_TPM,
+        burst_seconds=float(os.environ.get("RATE_LIMIT_BURST_SECONDS", 5)),
+        max_queue=int(os.environ.get("RATE_LIMIT_MAX_QUEUE", 100)),
+    )
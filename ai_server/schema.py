@@ -0,0 +1,293 @@
+import json
+import re
+import typing
+from typing import Annotated, List, Literal, Optional
+
+from pydantic import AfterValidator, BaseModel, BeforeValidator, Field, ValidationError, field_validator, model_validator
+
+# Mirrors unity/easyWorld/Assets/Scripts/WorldInfo.cs. Defaults are the C# field initializers,
+# ranges come from the prompt (widened where Unity needs it, e.g. densities are probabilities).
+
+HEIGHT_CURVES = ("linear", "constant", "easeIn", "easeOut", "sine", "bezier")
+TEXTURES = ("grass", "desert", "snow", "mud", "rock", "sand", "forestFloor", "mountainRock", "dirt", "deadGrass")
+WATER_TYPES = ("river", "lake", "ocean", "none")
+OBJECT_SET = {"Brick House", "Ferris Wheel", "Small House"}
+
+# Fields Unity fills in itself (and colour alpha), so the model isn't asked for them
+NOT_GENERATED = {"ShallowDepth", "heightMap", "a"}
+
+
+class WorldValidationError(ValueError):
+    pass
+
+
+def clamp(low, high):
+    return AfterValidator(lambda value: min(max(value, low), high))
+
+
+def round_float(value):
+    return round(value) if isinstance(value, float) else value
+
+
+# Model output is matched case-insensitively against the spelling Unity and the prompt use
+def canonical_case(options):
+    lookup = {option.lower(): option for option in options}
+    return BeforeValidator(lambda value: lookup.get(value.lower(), value) if isinstance(value, str) else value)
+
+
+def IntRange(low, high):
+    return Annotated[int, BeforeValidator(round_float), clamp(low, high)]
+
+
+def FloatRange(low, high):
+    return Annotated[float, clamp(low, high)]
+
+
+HeightCurve = Annotated[Literal[HEIGHT_CURVES], canonical_case(HEIGHT_CURVES)]
+Texture = Annotated[Literal[TEXTURES], canonical_case(TEXTURES)]
+WaterType = Annotated[Literal[WATER_TYPES], canonical_case(WATER_TYPES)]
+
+
+class Vector2(BaseModel):
+    x: float = 0
+    y: float = 0
+
+
+class Color(BaseModel):
+    r: FloatRange(0, 1) = 0.5
+    g: FloatRange(0, 1) = 0.5
+    b: FloatRange(0, 1) = 0.5
+    a: FloatRange(0, 1) = 1
+
+
+class TexturesGeneratorData(BaseModel):
+    texture: Texture = "grass"
+    heightCurve: HeightCurve = "constant"
+    tileSizeX: FloatRange(0, 50) = 10
+    tileSizeY: FloatRange(0, 50) = 10
+
+
+class HeightsGeneratorData(BaseModel):
+    width: IntRange(512, 1024) = 1024
+    height: IntRange(512, 1024) = 1024
+    depth: IntRange(0, 200) = 100
+    octaves: IntRange(1, 15) = 4
+    scale: FloatRange(1, 500) = 100
+    lacunarity: FloatRange(1, 5) = 2
+    persistence: FloatRange(0, 1) = 0.5
+    heightCurveOffset: float = 0.3
+    heightCurve: HeightCurve = "easeOut"
+    falloffDirection: FloatRange(0, 10) = 3
+    falloffRange: FloatRange(0, 10) = 3
+    useFalloffMap: bool = True
+    ShallowDepth: float = 1
+    randomize: bool = False
+    autoUpdate: bool = True
+
+
+class TreeGeneratorData(BaseModel):
+    octaves: IntRange(0, 10) = 3
+    scale: FloatRange(0, 100) = 1
+    lacunarity: FloatRange(0, 3) = 2
+    persistence: FloatRange(0, 1) = 0.5
+    offset: float = 0.2
+    minLevel: FloatRange(0, 100) = 0.1
+    maxLevel: FloatRange(0, 100) = 0.9
+    maxSteepness: FloatRange(0, 90) = 45
+    islandSize: FloatRange(-1, 1) = 1
+    # A probability per candidate point, so anything above 1 already places a tree everywhere
+    density: FloatRange(0, 1) = 0.5
+    randomize: bool = False
+    treePrototypes: IntRange(0, 10) = 3
+
+
+class GrassGeneratorData(BaseModel):
+    octaves: IntRange(0, 4) = 4
+    scale: FloatRange(0, 50) = 40
+    lacunarity: FloatRange(0, 3) = 2
+    persistence: FloatRange(0, 1) = 0.5
+    offset: float = 100
+    minLevel: FloatRange(-200, 200) = 0
+    maxLevel: FloatRange(-200, 200) = 100
+    maxSteepness: FloatRange(0, 90) = 70
+    islandSize: FloatRange(-1, 1) = 0
+    # Unity places grass where Random.Range(0, 1) < density
+    density: FloatRange(0, 1) = 0.5
+    randomize: bool = False
+    autoUpdate: bool = True
+    grassTextures: IntRange(0, 10) = 1
+
+
+class WaterGeneratorData(BaseModel):
+    waterType: WaterType = "none"
+    waterLevel: FloatRange(0, 200) = 20
+    riverWidthRange: Vector2 = Field(default_factory=lambda: Vector2(x=700, y=600))
+    randomize: bool = True
+    autoUpdate: bool = True
+
+    # Worlds generated before the prompt asked for a Vector2 carry riverWidthRangeX/Y
+    @model_validator(mode="before")
+    @classmethod
+    def fold_river_width(cls, data):
+        if isinstance(data, dict) and "riverWidthRange" not in data and "riverWidthRangeX" in data:
+            data = dict(data)
+            data["riverWidthRange"] = {"x": data.pop("riverWidthRangeX"), "y": data.pop("riverWidthRangeY", 600)}
+        return data
+
+
+class ObjectGeneratorData(BaseModel):
+    x: FloatRange(0, 1024) = 0
+    y: FloatRange(0, 1024) = 0
+    Rx: FloatRange(0, 360) = 0
+    Ry: FloatRange(0, 360) = 0
+    Rz: FloatRange(0, 360) = 0
+    name: Literal[tuple(sorted(OBJECT_SET))] = "Small House"
+    scale: FloatRange(0, 4) = 1
+
+
+class AtmosphereGeneratorData(BaseModel):
+    timeOfDay: FloatRange(0, 24) = 12
+    sunSize: FloatRange(0, 1) = 0.05
+    skyTint: Color = Field(default_factory=Color)
+    atmosphericThickness: FloatRange(0, 5) = 1
+    exposure: FloatRange(0, 8) = 1
+    fogIntensity: FloatRange(0, 0.5) = 0
+    fogColor: Color = Field(default_factory=Color)
+
+
+class CustomTerrainData(BaseModel):
+    heightsGeneratorData: HeightsGeneratorData = Field(default_factory=HeightsGeneratorData)
+    texturesGeneratorDataList: List[TexturesGeneratorData] = Field(default_factory=list)
+    treeGeneratorData: TreeGeneratorData = Field(default_factory=TreeGeneratorData)
+    grassGeneratorData: GrassGeneratorData = Field(default_factory=GrassGeneratorData)
+    waterGeneratorData: WaterGeneratorData = Field(default_factory=WaterGeneratorData)
+
+    # Unity logs an error per texture it can't load, so unknown ones are left out
+    @field_validator("texturesGeneratorDataList", mode="before")
+    @classmethod
+    def known_textures(cls, textures):
+        if isinstance(textures, list):
+            known = {texture.lower() for texture in TEXTURES}
+            return [t for t in textures if not isinstance(t, dict) or str(t.get("texture", "")).lower() in known]
+        return textures
+
+
+class WorldInfo(BaseModel):
+    terrainsData: List[CustomTerrainData] = Field(default_factory=lambda: [CustomTerrainData()])
+    heightMap: Optional[List[List[float]]] = None
+    objectList: List[ObjectGeneratorData] = Field(default_factory=list)
+    atmosphereGeneratorData: AtmosphereGeneratorData = Field(default_factory=AtmosphereGeneratorData)
+
+    # Objects Unity has no prefab for are skipped there anyway
+    @field_validator("objectList", mode="before")
+    @classmethod
+    def known_objects(cls, objects):
+        if isinstance(objects, list):
+            return [o for o in objects if not isinstance(o, dict) or o.get("name") in OBJECT_SET]
+        return objects
+
+    @field_validator("terrainsData")
+    @classmethod
+    def at_least_one_terrain(cls, terrains):
+        return terrains or [CustomTerrainData()]
+
+
+# Schema passed as response_schema so the model can only produce this shape; partial leaves
+# every field optional, for output that only gives the values that differ from a preset
+def response_schema(model=WorldInfo, partial=False):
+    properties = {}
+    for name, field in model.model_fields.items():
+        if name not in NOT_GENERATED:
+            properties[name] = type_schema(field.annotation, partial)
+    if partial:
+        return {"type": "object", "properties": properties}
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+def type_schema(annotation, partial=False):
+    origin = typing.get_origin(annotation)
+    if origin is Annotated:
+        return type_schema(typing.get_args(annotation)[0], partial)
+    if origin is Literal:
+        return {"type": "string", "enum": list(typing.get_args(annotation))}
+    if origin in (list, List):
+        return {"type": "array", "items": type_schema(typing.get_args(annotation)[0], partial)}
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return response_schema(annotation, partial)
+    return {"type": {bool: "boolean", int: "integer", float: "number", str: "string"}[annotation]}
+
+
+# The prompt's example JSON has no comma between terrainsData and objectList, which models copy
+MISSING_COMMA = re.compile(r'([}\]"])(\s*\n\s*)(")')
+
+
+def load_json(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return json.loads(MISSING_COMMA.sub(r"\1,\2\3", text))
+    except ValueError as e:
+        raise WorldValidationError(f"Model output is not JSON: {e}")
+
+
+# Validate, default and clamp model output in one pass. Fields that fail validation fall back to
+# their defaults instead of failing the whole world, so only unparseable output is an error.
+def validate(text, model=WorldInfo):
+    try:
+        return model.model_validate_json(text)
+    except ValidationError:
+        return validate_data(load_json(text), model)
+
+
+def validate_data(data, model=WorldInfo):
+    for attempt in range(10):
+        try:
+            return model.model_validate(data)
+        except ValidationError as e:
+            if not drop_invalid(data, e.errors()):
+                raise WorldValidationError(str(e))
+    raise WorldValidationError("Model output has too many invalid fields")
+
+
+def drop_invalid(data, errors):
+    removals = {}
+    for error in errors:
+        loc = error["loc"]
+        parent = data
+        for key in loc[:-1]:
+            try:
+                parent = parent[key]
+            except (KeyError, IndexError, TypeError):
+                parent = None
+                break
+        if parent is not None and loc:
+            removals[(id(parent), loc[-1])] = (parent, loc[-1])
+
+    dropped = False
+    # Highest list indices first so removing one doesn't shift the others
+    for parent, key in sorted(removals.values(), key=lambda removal: removal[1] if isinstance(removal[1], int) else -1, reverse=True):
+        try:
+            del parent[key]
+            dropped = True
+        except (KeyError, IndexError, TypeError):
+            pass
+    return dropped
+
+
+SECTION_MODELS = {"terrainsData": CustomTerrainData, "atmosphereGeneratorData": AtmosphereGeneratorData}
+
+
+# Validates one streamed top-level section, returning None for sections that aren't part of WorldInfo
+def validate_section(section, value):
+    if section == "objectList":
+        return [o.model_dump() for o in validate_data({"objectList": value}).objectList]
+    model = SECTION_MODELS.get(section)
+    if model is None:
+        return None
+    return validate_data(value, model).model_dump(exclude_none=True)
+
+
+def dump(world):
+    return world.model_dump_json(exclude_none=True)
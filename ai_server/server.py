@@ -1,19 +1,99 @@
-from flask import Flask, render_template, request, jsonify
-import google.generativeai as genai
-import os
-from dotenv import load_dotenv
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Load environment variables
-load_dotenv()
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
+from urllib.parse import quote
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from werkzeug.serving import make_server
 
-# Configure Google Generative AI with the API key
-genai.configure(api_key=os.environ.get("API_KEY"))
+import codec
+import generation
+import tracing
+from compression import COMPRESS_MIN_BYTES, compress, compress_stream, compressed_cache, compressible, encoded_etag, negotiate
+from cache import response_cache, world_cache
+from hedging import hedger
+from jobs import jobs
+from metrics import registry
+from preload import preloader
+from presets import fast_path
+from ratelimit import RateLimited
+from schema import WorldValidationError
+from similarity import similarity_cache
+from store import world_store
+from streaming import event_format, section_event
 
 app = Flask(__name__)
 
-# Initialize the Gemini model
-model = genai.GenerativeModel("gemini-1.5-flash")
+# Batch items from every request share one pool, so batches never hold more upstream calls than this
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 32))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 1000))
+
+# Longest a GET /jobs/<id>/result?wait= may hold the connection
+JOB_MAX_WAIT_SECONDS = float(os.environ.get("JOB_MAX_WAIT_SECONDS", 30))
+
+# How long a client waits for a world unless it sends X-Request-Timeout; Unity gives up after 10 seconds
+CLIENT_TIMEOUT_SECONDS = float(os.environ.get("CLIENT_TIMEOUT_SECONDS", 10))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY)
+
+# Generation requests are traced: every response gets a Server-Timing header with the time spent
+# in each stage, and a sample of them are exported when TRACE_FILE or OTLP_ENDPOINT is set
+TRACED_ENDPOINTS = {"parse_description", "parse_description_stream", "parse_descriptions"}
+
+@app.before_request
+def start_trace():
+    if request.endpoint in TRACED_ENDPOINTS:
+        g.trace, g.trace_token = tracing.start(request.path)
+
+@app.after_request
+def add_server_timing(response):
+    trace = g.get('trace')
+    if trace is not None:
+        # Streamed responses only include the stages done before the body started
+        response.headers['Server-Timing'] = trace.server_timing()
+        g.trace_attributes = {"status": response.status_code, "source": response.headers.get('X-Cache')}
+    return response
+
+@app.teardown_request
+def finish_trace(error):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        tracing.detach(g.pop('trace_token'))
+        # Streamed responses finish their trace when the body is done
+        if not g.get('trace_streamed'):
+            tracing.finish(trace, **g.pop('trace_attributes', {"status": 500}))
+
+# Wraps a streamed body so its stages are recorded in the request's trace
+def traced_body(body):
+    trace = g.get('trace')
+    if trace is None:
+        return body
+    g.trace_streamed = True
+    return tracing.traced_stream(trace, body, status=200)
+
+# Compresses responses for clients that accept it, streamed ones a chunk at a time
+@app.after_request
+def compress_response(response):
+    if response.direct_passthrough or 'Content-Encoding' in response.headers or not compressible(response.mimetype):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(compress(body, encoding, response.headers.get('ETag')))
+    response.headers['Content-Encoding'] = encoding
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = encoded_etag(response.headers['ETag'], encoding)
+    return response
 
 # Serve the HTML page with the WebGL game and the input form
 @app.route('/')
@@ -23,261 +103,284 @@ def index():
 @app.route('/parse_description', methods=['POST'])
 def parse_description():
 
-    description = request.json.get('description')
+    description = request_description()
 
-    if not description:
+    if not isinstance(description, str) or not description:
         return jsonify({"error": "Description is required."}), 400
-    
-    object_set = {"Brick House", "Ferris Wheel", "Small House"}
-
-    # Create the prompt for the AI
-    prompt = f"""
-    You are a terrain generation AI for a game. Based on the user's description, 
-    return a JSON object with parameters required for generating terrain. 
-    Make sure that the values for each parameter fall within reasonable ranges to avoid any out-of-bounds issues. 
-    If the description for the terrain does not need tree or grass like dessert(height 162, octaves 8, ) or snow unles the user specicly said, do not add( make the values zero's).
-    Make sure if the user say dont add <object> make sure to set the value to zero, for exampl if the user say dont add tree or grass or water(etc) make it zero.
-    Please use the following guidelines for each module:
-    If the description contains multiple types of terrain (e.g., 'mountain' and 'grass field flat'), 
-    generate separate terrainData objects for each.
-
-    Each terrain should have its own HeightsGenerator, TexturesGenerator, GrassGenerator, TreeGenerator, and WaterGenerator data.
-    Please use the following structure for each terrain:
-
-    HeightsGenerator:
-    Width: Determines the width of the terrain in units.
-    Height: Determines the height (or length) of the terrain in units.
-    Depth: Controls the maximum height variation of the terrain (vertical scaling).
-    Octaves: Specifies the number of noise layers used in terrain generation (more octaves add detail).
-    Scale: Adjusts the scale of the noise map, affecting the size of terrain features.
-    Lacunarity: Controls the increase in frequency for each octave, adding finer details.
-    Persistance: Determines how the amplitude decreases with each octave, affecting how details diminish.
-    HeightCurve: An animation curve that adjusts the terrain heights based on evaluated noise values.
-    Offset: A value to randomize or shift the noise pattern used in terrain generation.
-    FalloffDirection: Defines the direction of the falloff, influencing terrain shape towards edges.
-    FalloffRange: Defines how far the falloff effect reaches, influencing terrain smoothness.
-    UseFalloffMap: Toggles the use of a falloff map to control terrain generation near edges.
-    Randomize: Enables randomization of the noise offset to generate different terrains each time.
-    AutoUpdate: Automatically updates the terrain when changes are made in the inspector.
-
-    - width and height should be around 1024 (minimum 512, maximum 1024).
-    - depth represents the terrain height and should be between 65 and 200.
-    - octaves represent the levels of detail and should be between 1 and 15.
-    - scale determines the level of detail and should range between 70 and 500.
-    - lacunarity affects how much detail is added at each octave, typically between 1 and 5.
-    - persistence controls how each octave contributes to the overall shape, typically between 0 and 0.2.
-    - heightCurve: Choose from ["linear", "constant", "easeIn", "easeOut", "sine", "bezier"].  Rate of change of heights curve.
-    - heightCurveOffset is the vertical offset of the height curve, usually between 5000 and 12000.
-    - falloffDirection affects the direction of terrain slopes, usually between 1 and 4.
-    - falloffRange affects the slope of the terrain, usually between 1 and 4.
-    - useFalloffMap should be true or false. mostly true
-    - randomize and autoUpdate should be true or false.
-
-    TexturesGenerator:
-    - texture should be a list of textures (comma-separated) that can include any of the following it should be only for the terrain:
-    - Water is not part of terrain TexturesGenerator
-    ["grass", "desert", "snow", "mud", "rock", "sand", "forestFloor", "mountainRock", "dirt", "deadGrass"].
-    - The user may ask for multiple textures, so the model should include more than one texture if necessary. 
-    For example, "desert, deadGrass" for a desert with patches of dead grass, or "snow, rock" for snowy mountains.
-    - Each texture should have its own properties: 
-        -  make sire
-        - `heightCurve`: Choose from ["linear", "constant", "easeIn", "easeOut", "sine", "bezier"]. These represent the curve type for how the texture is applied based on terrain height.
-        - `tileSizeX`: float, between 0 and 50 (determines how the texture is tiled on the X axis).
-        - `tileSizeY`: float, between 0 and 50 (determines how the texture is tiled on the Y axis).
-        Ensure each texture has unique values for these properties. 
-
-
-    GrassGenerator:
-    Octaves: Controls the number of noise layers used in the Perlin noise generation (more octaves add detail).
-    Scale: Defines the scale of the Perlin noise; a higher value stretches the noise pattern, making features larger.
-    Lacunarity: Determines how much the frequency of each octave increases; higher values result in more noise details.
-    Persistance: Controls how the amplitude decreases with each octave; higher values retain more detail in higher octaves.
-    Offset: A shift applied to the Perlin noise generation, used to randomize the noise pattern.
-    MinLevel: Minimum terrain height where grass or trees can be placed.
-    MaxLevel: Maximum terrain height where grass or trees can be placed.
-    MaxSteepness: The steepest slope on which grass or trees can be placed (higher values allow steeper placement).
-    IslandsSize: Defines the size of areas where grass or trees are not placed; used to control the density of islands.
-    Density: Controls how densely the grass or trees are placed within the allowed areas.
-
-    - octaves should be between 0 and 4.
-    - scale should be between 0 and 25.
-    - lacunarity should be between 0 and 3.
-    - persistence should be between 0 and 1.
-    - offset should be between 1000 and 10000.
-    - minLevel should be between -200 and -90.
-    - maxLevel should be between 90 and 200.
-    - maxSteepness should be between 50 and 90.
-    - islandSize should be between 0.5 and 1.
-    - density should be between 700 and 1000.
-    - randomize and autoUpdate should be true or false.
-    - Grass Texture should be an integer representing the number of Grass Texture, typically between 4 and 10.
-
-    TreeGenerator:
-    Octaves: Determines the number of noise layers used for tree distribution (more octaves add finer details to the noise).
-    Scale: Adjusts the scale of the noise map, affecting how spread out or compact the tree distribution will be.
-    Lacunarity: Controls the increase in frequency for each noise octave, affecting the overall detail of tree distribution.
-    Persistance: Defines how the amplitude of each noise octave diminishes, influencing the terrain's fine details for tree placement.
-    Offset: A value used to shift the noise map, introducing randomness to the tree distribution.
-    MinLevel: The minimum height at which trees can be placed.
-    MaxLevel: The maximum height at which trees can be placed.
-    MaxSteepness: The steepest slope on which trees can grow; trees won't appear on slopes steeper than this value.
-    IslandsSize: Controls the areas where trees are placed based on noise values; lower values restrict trees to specific areas, while higher values spread trees across the terrain.
-    Density: Determines how densely trees are placed on the terrain; higher values result in more trees.
-    Randomize: If enabled, randomizes the noise offset to produce different tree layouts each time the map is generated.
-    AutoUpdate: Automatically regenerates the trees whenever any parameter is changed in the inspector.
-    for forest uslay its around Density 1, IslandsSize 1, MaxLevel 100.
-
-    - octaves should be between 1 and 10.
-    - scale should be between 0 and 100.
-    - lacunarity should be between 0 and 3.
-    - persistence should be between 0 and 1.0.
-    - offset should be between 2000 and 10000.
-    - minLevel should be between 0 and 100.
-    - maxLevel should be between 0 and 100.
-    - maxSteepness should be between 0 and 90.
-    - islandSize should be between -1 and 1.
-    - density should be between 0 and .3.
-    - randomize and autoUpdate should be true or false.
-    - treePrototypes should be an integer representing the number of tree prefabs, typically between 1 and 10.
-
-    WaterGenerator:
-    - waterType should be "river", "lake", "ocean", or "none".
-    - waterLevel represents the level of water height for lakes or oceans, should be between 50 and 0.
-    - river width range x and y, x should be between 100 and 100, y should be between 100 and 1000 
-    - randomize and autoUpdate should be true or false.
-    
-    ObjectData:
-    Multiplle copies of objects are allowed to be generated at a time.
-    - name: The name of the object. Must be in {object_set}
-    - x: The x position of the center of the object, 0<x<1024
-    - y: The y position of the center of the object, 0<y<1024
-    - Rx: The rotation of the object around the x axis, 0<Rx<360
-    - Ry: The rotation of the object around the y axis, 0<Ry<360
-    - Rz: The rotation of the object around the z axis, 0<Rz<360
-    - scale: The scale of the model size, as a multiple of the model, 0 < scale < 4, typically 1
-
-    AtmosphereGenerator:
-    - timeOfDay is a floating point value representing the time of day. Its value should be between 0 and 24 inclusive with 0 and 24 representing 12:00am, 12 representing 12:00pm and so on. 
-    - sunSize is a floating point value representing the size of the sun. Its value should range from 0 to 1 inclusive and the standard sun size is .05.
-    - skyTint is a color defined by RGB values each ranging from 0 to 1. Default sky color should be r=.5, g=.5, b=.5. anything refering to the color of the sky should affect this color value.
-    - atmosphericThickness is a float ranging from 0-5 inclusive. The standard value is 1.
-    - exposure is a float ranging from 0-8 inclusive. The standard value is 1.3 and this controls the overall light intensity coming from the sun in the skybox
-    - fogIntensity is a float ranging from 0-.5 inclusive. Fog values should have one of 5 different values 
-        (0 for no fog, .02 for light fog, .05 for medium fog, .1 for heavy fog, and .3 for very heavy fog)
-    - fogColor is a color defined by RGB values each ranging from 0 to 1. Default fog color should be r=.5, g=.5, b=.5
-    
-    Make sure you return the result in JSON format like this:   
-    {{
-        "terrainsData": [
-            {{
-                "heightsGeneratorData": {{
-                    "width": integer,
-                    "height": integer,
-                    "depth": integer,
-                    "octaves": integer,
-                    "scale": float,
-                    "lacunarity": float,
-                    "persistence": float,
-                    "heightCurve": string,
-                    "heightCurveOffset": float,
-                    "falloffDirection": float,
-                    "falloffRange": float,
-                    "useFalloffMap": boolean,
-                    "randomize": boolean,
-                    "autoUpdate": boolean
-                }},
-                "texturesGeneratorDataList": [
-                    {{
-                        "texture": string,
-                        "heightCurve": string,
-                        "tileSizeX": float,
-                        "tileSizeY": float
-                    }}
-                ],
-                "treeGeneratorData": {{
-                    "octaves": integer,
-                    "scale": float,
-                    "lacunarity": float,
-                    "persistence": float,
-                    "offset": float,
-                    "minLevel": float,
-                    "maxLevel": float,
-                    "maxSteepness": float,
-                    "islandSize": float,
-                    "density": float,
-                    "randomize": boolean,
-                    "treePrototypes": integer
-                }},
-                "grassGeneratorData": {{
-                    "octaves": integer,
-                    "scale": float,
-                    "lacunarity": float,
-                    "persistence": float,
-                    "offset": float,
-                    "minLevel": float,
-                    "maxLevel": float,
-                    "maxSteepness": float,
-                    "islandSize": float,
-                    "density": float,
-                    "randomize": boolean,
-                    "grassTextures": integer
-                }},
-                "waterGeneratorData": {{
-                    "waterType": string,
-                    "waterLevel": float,
-                    "riverWidthRangeX": float,  
-                    "riverWidthRangeY": float, 
-                    "randomize": boolean,
-                    "autoUpdate": boolean
-                }}
-            }},
-            ...
-        ]
-        "objectList": [
-        {{
-            "name": string,
-            "x": float,
-            "y": float,
-            "Rx": float,
-            "Ry": float,
-            "Rz": float,
-            "scale": float
-        }},
-        ...
-    ]
-    "atmosphereGeneratorData": {{
-            "timeOfDay": float,
-            "sunSize": float,
-            "skyTint":{{
-                "r": float,
-                "g": float,
-                "b": float
-            }},
-            "atmosphericThickness": float,
-            "exposure": float,
-            "fogIntensity": float,
-            "fogColor": {{
-                "r": float,
-                "g": float,
-                "b": float
-            }}
-        }}
-    }}
-
-
-    Use the following description to generate appropriate values:
-    "{description}"
-    """
-    # Call the Gemini API to generate the content
-    response = model.generate_content(prompt)
-
-    # Log the raw API response for debugging
-    print("API Response:", response.text)
-
-    # Clean the response by removing any triple backticks if present
-    return response.text.strip().strip('```json').strip('```')
+
+    deadline = request_deadline(request.headers.get('X-Request-Timeout'))
+    result = generation.generate(description, request.headers.get('Idempotency-Key'), deadline)
+
+    body, headers = world_body(result.text, result_headers(result), request.headers.get('Accept'))
+    return body, 200, headers
+
+# None unless the body is a JSON object with a description
+def request_description():
+    body = request.get_json(silent=True)
+    return body.get('description') if isinstance(body, dict) else None
+
+@app.errorhandler(WorldValidationError)
+def invalid_world(e):
+    print(f"Error validating terrain data: {e}")
+    return jsonify({"error": "Failed to generate valid terrain data."}), 500
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    print(f"Rate limited: {e}")
+    return rate_limited_body(e), 429, {"Retry-After": e.retry_after_header()}
+
+def rate_limited_body(e):
+    return {"error": "Too many requests, try again later.", "retryAfter": int(e.retry_after_header())}
+
+def request_deadline(timeout):
+    try:
+        seconds = float(timeout) if timeout else CLIENT_TIMEOUT_SECONDS
+    except ValueError:
+        seconds = CLIENT_TIMEOUT_SECONDS
+    return time.monotonic() + seconds
+
+# Streams each terrain, the object list and the atmosphere as separate events as soon as the model
+# has written them, as NDJSON or as server-sent events when the client accepts text/event-stream
+@app.route('/parse_description/stream', methods=['POST'])
+def parse_description_stream():
+
+    description = request_description()
+
+    if not isinstance(description, str) or not description:
+        return jsonify({"error": "Description is required."}), 400
+
+    mimetype, format_event = event_format(request.headers.get('Accept'))
+    deadline = request_deadline(request.headers.get('X-Request-Timeout'))
+
+    def events():
+        try:
+            for section in generation.stream_sections(description, deadline):
+                yield format_event(section_event(*section))
+        except RateLimited as e:
+            print(f"Rate limited: {e}")
+            yield format_event({"section": "error", **rate_limited_body(e)})
+            return
+        except Exception as e:
+            print(f"Error streaming terrain data: {e}")
+            yield format_event({"section": "error", "error": "Failed to generate valid terrain data."})
+            return
+        yield format_event({"section": "done"})
+
+    return Response(traced_body(stream_with_context(events())), mimetype=mimetype)
+
+# Runs every description through the same pipeline as /parse_description (cache, fast path,
+# coalescing) and streams one NDJSON line per item in the order they finish
+@app.route('/parse_descriptions', methods=['POST'])
+def parse_descriptions():
+
+    descriptions, error = batch_descriptions(request.get_json(silent=True))
+
+    if error:
+        return jsonify({"error": error}), 400
+
+    futures = {}
+    invalid = []
+    for index, description in enumerate(descriptions):
+        if isinstance(description, str) and description:
+            futures[batch_pool.submit(generation.generate, description)] = index
+        else:
+            invalid.append(index)
+
+    def lines():
+        for index in invalid:
+            yield batch_line(index, descriptions[index])
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                yield batch_line(index, descriptions[index], future.result())
+            except Exception as e:
+                yield batch_line(index, descriptions[index], error=e)
+
+    return Response(traced_body(stream_with_context(lines())), mimetype='application/x-ndjson')
+
+def batch_descriptions(body):
+    descriptions = body.get('descriptions') if isinstance(body, dict) else None
+    if not isinstance(descriptions, list) or not descriptions:
+        return None, "A list of descriptions is required."
+    if len(descriptions) > BATCH_MAX_ITEMS:
+        return None, f"At most {BATCH_MAX_ITEMS} descriptions per batch."
+    return descriptions, None
+
+# The world is spliced in as already serialized text rather than parsed and dumped again
+def batch_line(index, description, result=None, error=None):
+    item = {"index": index, "description": description}
+    if result is not None:
+        item.update(status=200, source=result.source)
+        return json.dumps(item)[:-1] + ', "data": ' + result.text + "}\n"
+    if error is None:
+        item.update(status=400, error="Description is required.")
+    elif isinstance(error, RateLimited):
+        item.update(status=429, **rate_limited_body(error))
+    else:
+        print(f"Error generating batch item {index}: {error}")
+        item.update(status=500, error="Failed to generate valid terrain data.")
+    return json.dumps(item) + "\n"
+
+# Submit a description and come back for the world, so generation time isn't bounded by the client's timeout
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+
+    description = request_description()
+
+    if not isinstance(description, str) or not description:
+        return jsonify({"error": "Description is required."}), 400
+
+    job, created = jobs.submit(description, request.headers.get('Idempotency-Key'))
+
+    return jsonify(job.summary()), 202 if created else 200, {"Location": f"/jobs/{job.id}"}
+
+@app.route('/jobs/stats')
+def job_stats():
+    return jsonify(jobs.stats())
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job.summary())
+
+# 200 with the world once the job is done, 202 with its status until then. ?wait=<seconds> holds
+# the request open until the job finishes or the wait is up, saving the client a round of polling.
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+
+    wait = min(request.args.get('wait', 0, type=float), JOB_MAX_WAIT_SECONDS)
+    if wait > 0:
+        job = jobs.wait(job, wait)
+
+    if job.status == "done":
+        body, headers = world_body(job.result.text, result_headers(job.result), request.headers.get('Accept'))
+        return body, 200, headers
+    if job.status == "failed":
+        if isinstance(job.error, RateLimited):
+            return rate_limited_body(job.error), 429, {"Retry-After": job.error.retry_after_header()}
+        return jsonify({"error": "Failed to generate valid terrain data."}), 500
+    return jsonify(job.summary()), 202, {"Retry-After": "1"}
+
+# Tell the client where the response came from, and which description answered a near match
+def result_headers(result):
+    headers = {"Content-Type": "application/json", "X-Cache": result.source}
+    if result.world_id is not None:
+        headers["Location"] = f"/worlds/{result.world_id}"
+        headers["ETag"] = f'"{result.world_id}"'
+    if result.match is not None:
+        headers["X-Similarity-Match"] = f"{quote(result.match)};score={result.score:.3f}"
+    if result.source not in ("cache", "store"):
+        found = result.fast_path
+        outcome = "hit" if result.source == "preset" else "miss"
+        headers["X-Fast-Path"] = f"{outcome};preset={found.preset};confidence={found.confidence:.2f}" if found else outcome
+    return headers
+
+# Worlds by content-addressed id. Unlike the POST endpoints these can be cached by browsers,
+# proxies and Unity, and since a world's id is its hash a client holding the ETag of a world
+# that exists is answered 304 without sending it again.
+@app.route('/worlds/<world_id>')
+def get_world(world_id):
+    headers = {"ETag": f'"{world_id}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    text = generation.find_world(world_id)
+    if text is None:
+        return jsonify({"error": "World not found."}), 404
+    if etag_matches(request.if_none_match, world_id):
+        headers = {**headers, "ETag": served_etag(text, headers, request.headers.get('Accept'),
+                                                  request.headers.get('Accept-Encoding'))}
+        return "", 304, headers
+    body, headers = world_body(text, {"Content-Type": "application/json", **headers}, request.headers.get('Accept'))
+    return body, 200, headers
+
+# The ETag a 200 for the world would carry, after the binary layout and compression, so a 304
+# matches the representation the client has stored
+def served_etag(text, headers, accept, accept_encoding):
+    body, headers = world_body(text, {"Content-Type": "application/json", **headers}, accept)
+    encoding = negotiate(accept_encoding)
+    size = len(body) if isinstance(body, bytes) else len(body.encode())
+    if encoding is None or not compressible(headers["Content-Type"]) or size < COMPRESS_MIN_BYTES:
+        return headers["ETag"]
+    return encoded_etag(headers["ETag"], encoding)
+
+# Worlds go out as JSON, or in the binary layout of codec.py to clients whose Accept prefers it.
+# Binary worlds are cached by ETag alongside the compressed ones.
+def world_body(text, headers, accept):
+    headers = {**headers, "Vary": "Accept"}
+    if parse_accept_header(accept, MIMEAccept).best_match(["application/json", codec.CONTENT_TYPE]) != codec.CONTENT_TYPE:
+        return text, headers
+
+    etag = headers.get("ETag")
+    body = compressed_cache.get((etag, codec.CONTENT_TYPE)) if etag else None
+    if body is None:
+        body = codec.encode_text(text)
+        if etag:
+            compressed_cache.put((etag, codec.CONTENT_TYPE), body)
+    headers["Content-Type"] = codec.CONTENT_TYPE
+    if etag:
+        headers["ETag"] = encoded_etag(etag, "bin")
+    return body, headers
+
+# Compressed responses have the encoding appended to their ETag, e.g. "<id>-gzip"
+def etag_matches(etags, world_id):
+    return etags.star_tag or any(etag.partition("-")[0] == world_id for etag in etags.as_set(include_weak=True))
+
+@app.route('/cache/stats')
+def cache_stats():
+    stats = response_cache.stats()
+    if similarity_cache is not None:
+        stats["similarity"] = similarity_cache.stats()
+    stats["fastPath"] = fast_path.stats()
+    stats["worlds"] = world_cache.stats()
+    stats["compressed"] = compressed_cache.stats()
+    stats["coalescing"] = generation.upstream_flights.stats()
+    stats["asyncCoalescing"] = generation.async_upstream_flights.stats()
+    if world_store is not None:
+        stats["store"] = world_store.stats()
+    stats["warmUp"] = preloader.stats()
+    return jsonify(stats)
+
+# Prometheus text format, summed over every worker process when METRICS_DIR is set
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Up as soon as the port is bound
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok"})
+
+# Ready once the Gemini client is loaded and has answered a call
+@app.route('/readyz')
+def readyz():
+    status = generation.readiness()
+    status["cacheWarmUp"] = preloader.status
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.route('/hedging/stats')
+def hedging_stats():
+    return jsonify(hedger.stats())
+
+# Quota per pool member, since each API key and model has its own
+@app.route('/ratelimit/stats')
+def ratelimit_stats():
+    return jsonify(generation.upstream_pool.limiter_stats())
+
+@app.route('/upstream/stats')
+def upstream_stats():
+    stats = generation.upstream_pool.stats()
+    stats["prompt"] = {"mode": generation.PROMPT_MODE, "instructionChars": len(generation.INSTRUCTIONS)}
+    return jsonify(stats)
 
 
 
 if __name__ == '__main__':
-    app.run(port=5000)
+    # Bind the port first and load the Gemini client in the background, so Unity can connect straight away
+    server = make_server('127.0.0.1', int(os.environ.get("PORT", 5000)), app, threaded=True)
+    generation.start_warm_up()
+    preloader.start()
+    print(f"Listening on http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
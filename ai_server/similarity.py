@@ -0,0 +1,161 @@
+import hashlib
+import os
+import random
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from cache import canonicalize
+
+NEGATIONS = {"no", "not", "dont", "without", "none", "zero"}
+# Words skipped between a negation and the thing being negated ("dont add any trees")
+NEGATION_FILLER = {"add", "any", "put", "have", "include", "want", "need", "use"}
+
+# 16 bands of 4 rows: pairs at 0.7 Jaccard share a bucket ~99% of the time, pairs at 0.3 ~12%
+BANDS = 16
+ROWS = 4
+PRIME = (1 << 61) - 1
+_rng = random.Random(1337)
+PERMUTATIONS = [(_rng.randrange(1, PRIME), _rng.randrange(0, PRIME)) for _ in range(BANDS * ROWS)]
+
+
+def tokenize(description):
+    tokens = set()
+    words = canonicalize(description).split()
+    i = 0
+    while i < len(words):
+        word = words[i]
+        if word in NEGATIONS:
+            i += 1
+            while i < len(words) and words[i] in NEGATION_FILLER:
+                i += 1
+            if i < len(words):
+                tokens.add("no_" + stem(words[i]))
+        else:
+            tokens.add(stem(word))
+        i += 1
+    return frozenset(tokens)
+
+
+# Crude plural folding so "mountains" and "mountain" are the same token
+def stem(word):
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+# The vocabulary of terrain descriptions is small, so each token's permuted hashes are computed once
+@lru_cache(maxsize=65536)
+def token_permutations(token):
+    h = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+    return tuple((a * h + b) % PRIME for a, b in PERMUTATIONS)
+
+
+def band_keys(tokens):
+    if not tokens:
+        return [(band, ()) for band in range(BANDS)]
+    signature = [min(column) for column in zip(*[token_permutations(token) for token in tokens])]
+    return [(band, tuple(signature[band * ROWS:(band + 1) * ROWS])) for band in range(BANDS)]
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def negations(tokens):
+    return frozenset(token for token in tokens if token.startswith("no_"))
+
+
+# Near-duplicate lookup over previously generated descriptions using MinHash LSH.
+# Candidates from matching buckets are verified with exact Jaccard on the token sets.
+class SimilarityCache:
+    def __init__(self, threshold, max_entries):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, description):
+        tokens = tokenize(description)
+        negated = negations(tokens)
+        keys = band_keys(tokens)
+        # Jaccard can't reach the threshold unless the sizes are within this ratio
+        min_size = len(tokens) * self.threshold
+        max_size = len(tokens) / self.threshold if self.threshold else float("inf")
+
+        with self.lock:
+            candidates = set()
+            for key in keys:
+                candidates.update(self.buckets.get(key, ()))
+
+            best, best_score = None, 0.0
+            for candidate in candidates:
+                other, other_negated, _, _ = self.entries[candidate]
+                if not min_size <= len(other) <= max_size:
+                    continue
+                # Never answer "no trees" with a world that has trees, however similar the rest is
+                if negated != other_negated:
+                    continue
+                score = jaccard(tokens, other)
+                if score > best_score:
+                    best, best_score = candidate, score
+
+            if best is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(best)
+            self.hits += 1
+            return best, best_score, self.entries[best][3]
+
+    def put(self, description, value):
+        key = canonicalize(description)
+        tokens = tokenize(description)
+        keys = band_keys(tokens)
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (tokens, negations(tokens), keys, value)
+            for band_key in keys:
+                self.buckets.setdefault(band_key, set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+
+    def _remove(self, key):
+        _, _, keys, _ = self.entries.pop(key)
+        for band_key in keys:
+            bucket = self.buckets[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[band_key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Off unless SIMILARITY_CACHE is set, since a near match is not always the world the user meant
+similarity_cache = None
+if os.environ.get("SIMILARITY_CACHE", "").lower() in ("1", "true", "yes"):
+    similarity_cache = SimilarityCache(
+        threshold=float(os.environ.get("SIMILARITY_THRESHOLD", 0.7)),
+        max_entries=int(os.environ.get("SIMILARITY_MAX_ENTRIES", 100000)),
+    )
@@ -0,0 +1,333 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS worlds (
+    key TEXT PRIMARY KEY,
+    description TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    model TEXT NOT NULL,
+    raw TEXT,
+    world TEXT NOT NULL,
+    created REAL NOT NULL,
+    upstream_seconds REAL,
+    prompt_tokens INTEGER,
+    output_tokens INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS worlds_by_version ON worlds (prompt_version, model, created);
+CREATE TABLE IF NOT EXISTS worlds_by_id (
+    id TEXT PRIMARY KEY,
+    world TEXT NOT NULL,
+    created REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    idempotency_key TEXT UNIQUE,
+    description TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    world_id TEXT,
+    source TEXT,
+    error TEXT,
+    retry_after REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_by_finished ON jobs (finished);
+CREATE TABLE IF NOT EXISTS usage (
+    key TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    used REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+INSERT = """
+INSERT OR REPLACE INTO worlds
+    (key, description, prompt_version, model, raw, world, created, upstream_seconds, prompt_tokens, output_tokens)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_BY_ID = "INSERT OR IGNORE INTO worlds_by_id (id, world, created) VALUES (?, ?, ?)"
+
+TOUCH = """
+INSERT INTO usage (key, hits, used) VALUES (?, 1, ?)
+ON CONFLICT (key) DO UPDATE SET hits = hits + 1, used = MAX(used, excluded.used)
+"""
+
+
+# Hash of the canonical description, prompt version and model, i.e. of generation.cache_key()
+def store_key(key):
+    return hashlib.sha256("\0".join(key).encode()).hexdigest()
+
+
+class StoredWorld:
+    def __init__(self, key, description, prompt_version, model, raw, world, created,
+                 upstream_seconds=None, prompt_tokens=None, output_tokens=None):
+        self.key = key
+        self.description = description
+        self.prompt_version = prompt_version
+        self.model = model
+        self.raw = raw
+        self.world = world
+        self.created = created
+        self.upstream_seconds = upstream_seconds
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+
+    def row(self):
+        return (self.key, self.description, self.prompt_version, self.model, self.raw, self.world, self.created,
+                self.upstream_seconds, self.prompt_tokens, self.output_tokens)
+
+
+# Every generated world, kept in SQLite so it outlives the process: by the description it was
+# generated for, and by its world id for /worlds/<id>. Writes are queued and committed in
+# batches by a background thread, so a request never waits on the disk; reads go straight to
+# the primary key index on a connection per thread, which WAL mode lets run while a batch is
+# being written.
+class WorldStore:
+    def __init__(self, path, flush_seconds=0.5, max_batch=500):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.max_batch = max_batch
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        connection = self.connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connection.close()
+        self.start()
+
+    # Also called in forked workers, which can't use the parent's connections or writer thread
+    def start(self):
+        self.local = threading.local()
+        self.pending = deque()
+        self.wake = threading.Event()
+        # A process that called the model flushes its world itself before releasing its lease, which
+        # mustn't return while the writer thread is still committing a batch that holds the world
+        self.flush_lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        # WAL only needs syncing at checkpoints; a crash loses at most the last batches, never corrupts
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    def get(self, key):
+        world = self.read("SELECT world FROM worlds WHERE key = ?", store_key(key))
+        if world is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return world
+
+    def read(self, query, key):
+        try:
+            row = self.connection().execute(query, (key,)).fetchone()
+        except sqlite3.Error as e:
+            # A broken store only costs the lookup
+            self.errors += 1
+            print(f"Error reading from {self.path}: {e}")
+            return None
+        return row[0] if row is not None else None
+
+    # key is generation.cache_key(); returns straight away, the write happens in the background
+    def put(self, key, world, raw=None, upstream_seconds=None, prompt_tokens=None, output_tokens=None):
+        description, prompt_version, model = key
+        self.queue(INSERT, StoredWorld(store_key(key), description, prompt_version, model, raw, world, time.time(),
+                                       upstream_seconds, prompt_tokens, output_tokens).row())
+
+    # Any world served, whatever answered it; the first write of an id wins since the world is the same
+    def put_by_id(self, world_id, world):
+        self.queue(INSERT_BY_ID, (world_id, world, time.time()))
+
+    def get_by_id(self, world_id):
+        return self.read("SELECT world FROM worlds_by_id WHERE id = ?", world_id)
+
+    # Counts a request answered with the world for key, for ranking worlds at warm-up
+    def touch(self, key):
+        self.queue(TOUCH, (store_key(key), time.time()))
+
+    # (hashed key, description, hits, last used) of every world for the prompt version and model.
+    # Worlds stored before usage was recorded count as asked for once, when they were made.
+    def usage(self, prompt_version, model):
+        return self.connection().execute(
+            "SELECT worlds.key, description, COALESCE(hits, 1), COALESCE(used, created) FROM worlds "
+            "LEFT JOIN usage ON usage.key = worlds.key WHERE prompt_version = ? AND model = ?",
+            (prompt_version, model)).fetchall()
+
+    # Like get(), by hashed key and without counting a lookup
+    def get_hashed(self, hashed):
+        return self.read("SELECT world FROM worlds WHERE key = ?", hashed)
+
+    def queue(self, statement, row):
+        self.pending.append((statement, row))
+        if len(self.pending) >= self.max_batch:
+            self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            self.write_pending()
+
+    def write_pending(self):
+        batch = {}
+        count = 0
+        while self.pending:
+            statement, row = self.pending.popleft()
+            batch.setdefault(statement, []).append(row)
+            count += 1
+        if not batch:
+            return
+        try:
+            connection = self.connection()
+            with connection:
+                for statement, rows in batch.items():
+                    connection.executemany(statement, rows)
+            self.written += count
+            self.batches += 1
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Error writing {count} worlds to {self.path}: {e}")
+
+    # Most recent first, for the given prompt version and model
+    def recent(self, prompt_version, model, limit):
+        rows = self.connection().execute(
+            "SELECT key, description, prompt_version, model, raw, world, created, upstream_seconds, prompt_tokens, "
+            "output_tokens FROM worlds WHERE prompt_version = ? AND model = ? ORDER BY created DESC LIMIT ?",
+            (prompt_version, model, limit)).fetchall()
+        return [StoredWorld(*row) for row in rows]
+
+    # Lets one of several processes sharing the store call the model for a key while the others
+    # wait. Returns a token for release(), or None if another process holds an unexpired lease.
+    def lease(self, key, seconds):
+        token = os.urandom(8).hex()
+        now = time.time()
+        try:
+            connection = self.connection()
+            with connection:
+                cursor = connection.execute(
+                    "INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?) ON CONFLICT (key) "
+                    "DO UPDATE SET owner = excluded.owner, expires = excluded.expires WHERE leases.expires < ?",
+                    (store_key(key), token, now + seconds, now))
+        except sqlite3.Error as e:
+            # Without the store there is nothing to wait on, so go ahead as if the lease was granted
+            self.errors += 1
+            print(f"Error taking a lease in {self.path}: {e}")
+            return token
+        return token if cursor.rowcount == 1 else None
+
+    def release(self, key, token):
+        try:
+            connection = self.connection()
+            with connection:
+                connection.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (store_key(key), token))
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Error releasing a lease in {self.path}: {e}")
+
+    # (world or None, whether a process still holds a lease on the key)
+    def poll(self, key):
+        hashed = store_key(key)
+        try:
+            world, expires = self.connection().execute(
+                "SELECT (SELECT world FROM worlds WHERE key = ?), (SELECT expires FROM leases WHERE key = ?)",
+                (hashed, hashed)).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Error reading from {self.path}: {e}")
+            return None, False
+        return world, expires is not None and expires > time.time()
+
+    # Jobs are written straight away rather than batched, since another worker may be asked
+    # about them next. Returns False when a job with the same idempotency key already exists.
+    def insert_job(self, row):
+        connection = self.connection()
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (id, idempotency_key, description, status, created) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT DO NOTHING", row)
+        return cursor.rowcount == 1
+
+    def update_job(self, job_id, status, started, finished=None, world_id=None, source=None, error=None,
+                   retry_after=None):
+        connection = self.connection()
+        with connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, started = ?, finished = ?, world_id = ?, source = ?, error = ?, "
+                "retry_after = ? WHERE id = ?",
+                (status, started, finished, world_id, source, error, retry_after, job_id))
+
+    # The job as a dict of its columns, by id or by idempotency key
+    def load_job(self, job_id=None, idempotency_key=None):
+        column, value = ("id", job_id) if job_id is not None else ("idempotency_key", idempotency_key)
+        cursor = self.connection().execute(f"SELECT * FROM jobs WHERE {column} = ?", (value,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def expire_jobs(self, before):
+        connection = self.connection()
+        with connection:
+            connection.execute("DELETE FROM jobs WHERE finished < ?", (before,))
+
+    def stats(self):
+        entries = self.connection().execute("SELECT COUNT(*) FROM worlds").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "entries": entries,
+            "pending": len(self.pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "written": self.written,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+# Set STORE_PATH to empty to keep nothing on disk. A relative path is taken from the working directory,
+# the default sits next to this file so the store is the same wherever the server was started from
+STORE_PATH = os.environ.get("STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "worlds.db"))
+# Set by gunicorn.conf.py: several worker processes use this store, so upstream calls are
+# coalesced and jobs kept through it rather than in each process
+SHARED_STATE = os.environ.get("SHARED_STATE", "0").lower() in ("1", "true", "yes")
+SHARED_LEASE_SECONDS = float(os.environ.get("SHARED_LEASE_SECONDS", 60))
+SHARED_POLL_SECONDS = float(os.environ.get("SHARED_POLL_SECONDS", 0.05))
+
+world_store = None
+if STORE_PATH:
+    world_store = WorldStore(
+        STORE_PATH,
+        flush_seconds=float(os.environ.get("STORE_FLUSH_SECONDS", 0.5)),
+        max_batch=int(os.environ.get("STORE_MAX_BATCH", 500)),
+    )
+    os.register_at_fork(after_in_child=world_store.start)
+    # Whatever is still queued when the server stops
+    atexit.register(world_store.flush)
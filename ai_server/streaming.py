@@ -0,0 +1,95 @@
+import json
+import re
+
+# The only characters that change parser state; everything else is skipped in one regex step
+SPECIAL = re.compile(r'[{}\[\]"\\]')
+STRING_SPECIAL = re.compile(r'["\\]')
+
+# Top-level arrays whose elements are emitted one by one as soon as each closes
+SPLIT_ARRAYS = {"terrainsData"}
+
+
+# Incremental parser for the model's WorldInfo output. Feed it chunks of text as they
+# arrive and it returns (section, index, value) for every top-level section that has
+# closed: each element of terrainsData, then objectList and atmosphereGeneratorData.
+# Sections are decoded on their own, so a missing comma between them (the prompt's
+# example has one) doesn't hold anything back.
+class SectionParser:
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.string_start = 0
+        self.last_key = None
+        self.section = None
+        self.section_start = 0
+        self.element_start = 0
+        self.element_index = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+        sections = []
+
+        while True:
+            pattern = STRING_SPECIAL if self.in_string else SPECIAL
+            match = pattern.search(self.text, self.pos)
+            if match is None:
+                self.pos = len(self.text)
+                return sections
+
+            char = match.group()
+            index = match.start()
+            self.pos = index + 1
+
+            if self.in_string:
+                if char == "\\":
+                    # Escaped character, which may not have arrived yet
+                    if self.pos >= len(self.text):
+                        self.pos = index
+                        return sections
+                    self.pos += 1
+                else:
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = self.text[self.string_start + 1:index]
+            elif char == '"':
+                self.in_string = True
+                self.string_start = index
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 2:
+                    self.section = self.last_key
+                    self.section_start = index
+                    self.element_index = 0
+                elif self.depth == 3 and self.section in SPLIT_ARRAYS:
+                    self.element_start = index
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 2 and self.section in SPLIT_ARRAYS:
+                    sections.append((self.section, self.element_index, json.loads(self.text[self.element_start:self.pos])))
+                    self.element_index += 1
+                elif self.depth == 1 and self.section not in SPLIT_ARRAYS:
+                    sections.append((self.section, None, json.loads(self.text[self.section_start:self.pos])))
+
+
+def section_event(section, index, value):
+    event = {"section": section, "data": value}
+    if index is not None:
+        event["index"] = index
+    return event
+
+
+def ndjson_event(event):
+    return json.dumps(event) + "\n"
+
+
+def sse_event(event):
+    return f"event: {event['section']}\ndata: {json.dumps(event)}\n\n"
+
+
+# Server-sent events if the client asks for them, newline delimited JSON otherwise
+def event_format(accept):
+    if accept and "text/event-stream" in accept:
+        return "text/event-stream", sse_event
+    return "application/x-ndjson", ndjson_event
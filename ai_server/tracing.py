@@ -0,0 +1,223 @@
+import contextvars
+from collections import deque
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+
+from metrics import stage_seconds
+
+# Spans are always collected for the Server-Timing header; this fraction of requests is also exported
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+# Export to a JSONL file, one span per line, and/or an OTLP/HTTP collector (e.g. http://localhost:4318/v1/traces)
+TRACE_FILE = os.environ.get("TRACE_FILE")
+OTLP_ENDPOINT = os.environ.get("OTLP_ENDPOINT")
+TRACE_FLUSH_SECONDS = float(os.environ.get("TRACE_FLUSH_SECONDS", 1))
+SERVICE_NAME = "ezworld-ai-server"
+
+current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self, name, sampled):
+        self.name = name
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.duration = None
+        # (name, start, duration) in perf_counter seconds
+        self.spans = []
+        self.attributes = {}
+        # Ids are only needed for export
+        self.trace_id = os.urandom(16).hex() if sampled else None
+
+    def add(self, name, start, duration):
+        self.spans.append((name, start, duration))
+
+    def end(self):
+        self.duration = time.perf_counter() - self.start
+
+    def server_timing(self):
+        total = self.duration if self.duration is not None else time.perf_counter() - self.start
+        timings = [f"{name};dur={duration * 1000:.1f}" for name, _, duration in self.spans]
+        timings.append(f"total;dur={total * 1000:.1f}")
+        if self.sampled:
+            timings.append(f'trace;desc="{self.trace_id}"')
+        return ", ".join(timings)
+
+
+# Times a block into the current request's trace, if there is one
+class Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current.get()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, self.start, time.perf_counter() - self.start)
+
+
+# A pipeline stage: recorded in ezworld_stage_seconds as well as in the trace
+class Stage(Span):
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        stage_seconds.add((self.name,), duration)
+        if self.trace is not None:
+            self.trace.add(self.name, self.start, duration)
+
+
+def span(name):
+    return Span(name)
+
+
+def stage(name):
+    return Stage(name)
+
+
+def start(name):
+    trace = Trace(name, exporter is not None and random.random() < TRACE_SAMPLE_RATE)
+    return trace, current.set(trace)
+
+
+def detach(token):
+    current.reset(token)
+
+
+def finish(trace, **attributes):
+    trace.end()
+    if trace.sampled:
+        trace.attributes.update({key: value for key, value in attributes.items() if value is not None})
+        exporter.export(trace)
+
+
+# A streamed body is generated after the request handler has returned, so it carries the trace
+# along and finishes it once the last event is sent
+def traced_stream(trace, events, **attributes):
+    token = current.set(trace)
+    try:
+        yield from events
+    finally:
+        try:
+            current.reset(token)
+        except ValueError:
+            # Closed from another context, e.g. by the garbage collector
+            pass
+        finish(trace, **attributes)
+
+
+def span_id():
+    return os.urandom(8).hex()
+
+
+# Flat span records shared by both exporters: the request itself, then a child per stage
+def span_records(trace):
+    root_id = span_id()
+    records = [{
+        "traceId": trace.trace_id,
+        "spanId": root_id,
+        "name": trace.name,
+        "start": trace.start_ns,
+        "end": trace.start_ns + int(trace.duration * 1e9),
+        "attributes": trace.attributes,
+    }]
+    for name, start, duration in trace.spans:
+        start_ns = trace.start_ns + int((start - trace.start) * 1e9)
+        records.append({
+            "traceId": trace.trace_id,
+            "spanId": span_id(),
+            "parentSpanId": root_id,
+            "name": name,
+            "start": start_ns,
+            "end": start_ns + int(duration * 1e9),
+        })
+    return records
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_payload(records):
+    spans = []
+    for record in records:
+        otlp_span = {
+            "traceId": record["traceId"],
+            "spanId": record["spanId"],
+            "name": record["name"],
+            # SERVER for the request, INTERNAL for its stages
+            "kind": 1 if "parentSpanId" in record else 2,
+            "startTimeUnixNano": str(record["start"]),
+            "endTimeUnixNano": str(record["end"]),
+            "attributes": [{"key": k, "value": otlp_value(v)} for k, v in record.get("attributes", {}).items()],
+        }
+        if "parentSpanId" in record:
+            otlp_span["parentSpanId"] = record["parentSpanId"]
+        spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "ezworld"}, "spans": spans}],
+    }]}
+
+
+# Finished traces are queued and written in batches by a background thread, so exporting never
+# slows a request down (appending to a deque needs no lock). If the exporter falls behind, traces
+# are dropped rather than queued forever.
+class Exporter:
+    def __init__(self, path=None, endpoint=None, max_queue=10000):
+        self.path = path
+        self.endpoint = endpoint
+        self.max_queue = max_queue
+        self.exported = 0
+        self.dropped = 0
+        self.start()
+
+    # Also called in forked workers, which don't inherit the thread
+    def start(self):
+        self.pending = deque()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def export(self, trace):
+        if len(self.pending) < self.max_queue:
+            self.pending.append(trace)
+        else:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            time.sleep(TRACE_FLUSH_SECONDS)
+            traces = []
+            while self.pending:
+                traces.append(self.pending.popleft())
+            if not traces:
+                continue
+            records = [record for trace in traces for record in span_records(trace)]
+            try:
+                self.write(records)
+                self.exported += len(traces)
+            except (OSError, ValueError) as e:
+                print(f"Error exporting traces: {e}")
+
+    def write(self, records):
+        if self.path:
+            with open(self.path, "a") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+        if self.endpoint:
+            request = urllib.request.Request(self.endpoint, json.dumps(otlp_payload(records)).encode(),
+                                             {"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout=5).close()
+
+
+exporter = Exporter(TRACE_FILE, OTLP_ENDPOINT) if TRACE_FILE or OTLP_ENDPOINT else None
+if exporter is not None:
+    os.register_at_fork(after_in_child=exporter.start)
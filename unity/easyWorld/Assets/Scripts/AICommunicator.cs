@@ -10,6 +10,19 @@ public class AICommunicator : MonoBehaviour
     [Header("Server")]
     public string SERVER_URL = "http://localhost:5000/parse_description";
     public int SERVER_TIMEOUT_SECONDS = 10;
+    public string READY_URL = "http://localhost:5000/readyz";
+    public int SERVER_START_TIMEOUT_SECONDS = 30;
+    // Submit a job and poll for the world, so a slow generation isn't cut off by SERVER_TIMEOUT_SECONDS
+    public bool useJobApi = true;
+    public string JOBS_URL = "http://localhost:5000/jobs";
+    public int JOB_TIMEOUT_SECONDS = 120;
+    public int JOB_POLL_WAIT_SECONDS = 5;
+    // Ask for the binary WorldInfo, which is smaller and much quicker to read than the JSON
+    public bool useBinaryWorlds = true;
+
+    private bool serverReady = false;
+    // When the wait for /readyz gives up, set by the first request so later ones don't wait again
+    private float readyDeadline = -1;
 
     public ServerHandler serverHandler;
 
@@ -49,10 +62,23 @@ public class AICommunicator : MonoBehaviour
             Debug.Log("Server is not active, request will fail unless running server externally");
         }
 
+        yield return WaitForServerReady();
+
+        if (!serverReady)
+        {
+            Debug.Log("Server is not ready yet, sending request anyway");
+        }
+
         string jsonData = $"{{\"description\": \"{description}\"}}";
 
         byte[] bodyRaw = Encoding.UTF8.GetBytes(jsonData);
 
+        if (useJobApi)
+        {
+            yield return GetAIOutputFromJob(bodyRaw);
+            yield break;
+        }
+
         using UnityWebRequest request = new UnityWebRequest(SERVER_URL, "POST")
         {
             uploadHandler = new UploadHandlerRaw(bodyRaw),
@@ -61,6 +87,9 @@ public class AICommunicator : MonoBehaviour
         };
 
         request.SetRequestHeader("Content-Type", "application/json");
+        SetAcceptHeader(request);
+        // Lets the server turn the request away straight away if it can't answer in time
+        request.SetRequestHeader("X-Request-Timeout", SERVER_TIMEOUT_SECONDS.ToString());
 
         Debug.Log("Waiting for AI Response");
 
@@ -69,11 +98,110 @@ public class AICommunicator : MonoBehaviour
         HandleWebRequestResult(request);
     }
 
+    IEnumerator GetAIOutputFromJob(byte[] bodyRaw)
+    {
+        using UnityWebRequest submitRequest = new UnityWebRequest(JOBS_URL, "POST")
+        {
+            uploadHandler = new UploadHandlerRaw(bodyRaw),
+            downloadHandler = new DownloadHandlerBuffer(),
+            timeout = SERVER_TIMEOUT_SECONDS
+        };
+
+        submitRequest.SetRequestHeader("Content-Type", "application/json");
+
+        yield return submitRequest.SendWebRequest();
+
+        if (submitRequest.result != UnityWebRequest.Result.Success)
+        {
+            HandleWebRequestResult(submitRequest);
+            yield break;
+        }
+
+        JobStatus job = JsonConvert.DeserializeObject<JobStatus>(submitRequest.downloadHandler.text, serializerSettings);
+        string resultUrl = $"{JOBS_URL}/{job.id}/result?wait={JOB_POLL_WAIT_SECONDS}";
+        float deadline = Time.realtimeSinceStartup + JOB_TIMEOUT_SECONDS;
+
+        Debug.Log($"Waiting for AI Response (job {job.id})");
+
+        while (Time.realtimeSinceStartup < deadline)
+        {
+            // The server holds each poll for up to JOB_POLL_WAIT_SECONDS and answers 202 while the job is still running
+            using UnityWebRequest resultRequest = UnityWebRequest.Get(resultUrl);
+            resultRequest.timeout = JOB_POLL_WAIT_SECONDS + SERVER_TIMEOUT_SECONDS;
+            SetAcceptHeader(resultRequest);
+
+            yield return resultRequest.SendWebRequest();
+
+            if (resultRequest.responseCode != 202)
+            {
+                HandleWebRequestResult(resultRequest);
+                yield break;
+            }
+        }
+
+        Debug.Log($"Gave up waiting for job {job.id} after {JOB_TIMEOUT_SECONDS}s");
+    }
+
+    private class JobStatus
+    {
+        public string id;
+        public string status;
+    }
+
+    // The server binds its port before the Gemini client has loaded, so wait for /readyz before the first request.
+    // The wait is only SERVER_START_TIMEOUT_SECONDS in all: if warm-up is slow or fails, requests after it go straight ahead.
+    IEnumerator WaitForServerReady()
+    {
+        if (readyDeadline < 0)
+        {
+            readyDeadline = Time.realtimeSinceStartup + SERVER_START_TIMEOUT_SECONDS;
+        }
+
+        while (!serverReady && Time.realtimeSinceStartup < readyDeadline)
+        {
+            using UnityWebRequest readyRequest = UnityWebRequest.Get(READY_URL);
+            readyRequest.timeout = 1;
+
+            yield return readyRequest.SendWebRequest();
+
+            serverReady = readyRequest.result == UnityWebRequest.Result.Success;
+
+            if (!serverReady)
+            {
+                yield return new WaitForSecondsRealtime(0.5f);
+            }
+        }
+    }
+
+    void SetAcceptHeader(UnityWebRequest request)
+    {
+        request.SetRequestHeader("Accept", useBinaryWorlds ? WorldInfoReader.CONTENT_TYPE + ", application/json;q=0.5" : "application/json");
+    }
+
+    WorldInfo ReadWorldInfo(UnityWebRequest request)
+    {
+        string contentType = request.GetResponseHeader("Content-Type");
+
+        if (contentType != null && contentType.StartsWith(WorldInfoReader.CONTENT_TYPE))
+        {
+            return WorldInfoReader.Read(request.downloadHandler.data);
+        }
+
+        return JsonConvert.DeserializeObject<WorldInfo>(request.downloadHandler.text, serializerSettings);
+    }
+
     void HandleWebRequestResult(UnityWebRequest request)
     {
+        string serverTiming = request.GetResponseHeader("Server-Timing");
+
+        if (!string.IsNullOrEmpty(serverTiming))
+        {
+            Debug.Log("Server timing: " + serverTiming);
+        }
+
         if (request.result == UnityWebRequest.Result.Success)
         {
-            WorldInfo worldInfo = JsonConvert.DeserializeObject<WorldInfo>(request.downloadHandler.text, serializerSettings);
+            WorldInfo worldInfo = ReadWorldInfo(request);
 
             if (worldInfo == null)
             {
@@ -83,6 +211,10 @@ public class AICommunicator : MonoBehaviour
 
             worldGenerator.GenerateNewWorld(worldInfo);
         }
+        else if (request.responseCode == 429)
+        {
+            Debug.Log("Server is busy, try again in " + request.GetResponseHeader("Retry-After") + " seconds");
+        }
         else
         {
             Debug.Log("Failed to get AI Output");
@@ -64,7 +64,9 @@ public class TreeGeneratorData
     public float maxLevel = .9f;
     public float maxSteepness = 45;
     public float islandSize = 1;
-    public float density = 5;
+    // The chance of a tree at each candidate point, as TreeGenerator.Density
+    [Range(0, 1)]
+    public float density = 0.5f;
     public bool randomize = false;
     public int treePrototypes = 3;
 }
@@ -0,0 +1,212 @@
+using System;
+using System.Collections.Generic;
+using System.IO;
+using System.Text;
+using UnityEngine;
+
+// Reads the binary WorldInfo the server sends for Accept: application/vnd.ezworld.worldinfo.
+// The layout is described in ai_server/codec.py; fields are read in the order of the models in
+// ai_server/schema.py. Run `python codec.py` for the layout id after changing the schema.
+public static class WorldInfoReader
+{
+    public const string CONTENT_TYPE = "application/vnd.ezworld.worldinfo";
+    const uint LAYOUT_ID = 0xbb289e80;
+
+    static readonly string[] HEIGHT_CURVES = { "linear", "constant", "easeIn", "easeOut", "sine", "bezier" };
+    static readonly string[] TEXTURES = { "grass", "desert", "snow", "mud", "rock", "sand", "forestFloor", "mountainRock", "dirt", "deadGrass" };
+    static readonly string[] WATER_TYPES = { "river", "lake", "ocean", "none" };
+    static readonly string[] OBJECT_NAMES = { "Brick House", "Ferris Wheel", "Small House" };
+
+    public static WorldInfo Read(byte[] data)
+    {
+        using BinaryReader reader = new BinaryReader(new MemoryStream(data), Encoding.ASCII);
+
+        if (Encoding.ASCII.GetString(reader.ReadBytes(4)) != "EZWI")
+        {
+            throw new InvalidDataException("Not a binary WorldInfo");
+        }
+
+        ushort version = reader.ReadUInt16();
+        reader.ReadUInt16();
+        uint layoutId = reader.ReadUInt32();
+
+        if (layoutId != LAYOUT_ID)
+        {
+            throw new InvalidDataException($"WorldInfo layout {layoutId:x8} (version {version}) is not the one this build reads ({LAYOUT_ID:x8})");
+        }
+
+        return new WorldInfo
+        {
+            terrainsData = ReadList(reader, ReadTerrain),
+            heightMap = ReadMatrix(reader, data),
+            objectList = ReadList(reader, ReadObject),
+            atmosphereGeneratorData = ReadAtmosphere(reader)
+        };
+    }
+
+    static List<T> ReadList<T>(BinaryReader reader, Func<BinaryReader, T> readItem)
+    {
+        int count = (int)reader.ReadUInt32();
+        List<T> items = new List<T>(count);
+
+        for (int i = 0; i < count; i++)
+        {
+            items.Add(readItem(reader));
+        }
+
+        return items;
+    }
+
+    // A raw block of little-endian floats, copied into the array in one go
+    static float[,] ReadMatrix(BinaryReader reader, byte[] data)
+    {
+        int rows = (int)reader.ReadUInt32();
+        int columns = (int)reader.ReadUInt32();
+        reader.BaseStream.Position += (4 - reader.BaseStream.Position % 4) % 4;
+
+        if (rows == 0 || columns == 0)
+        {
+            return null;
+        }
+
+        float[,] matrix = new float[rows, columns];
+        int size = rows * columns * sizeof(float);
+        Buffer.BlockCopy(data, (int)reader.BaseStream.Position, matrix, 0, size);
+        reader.BaseStream.Position += size;
+        return matrix;
+    }
+
+    static string ReadOption(BinaryReader reader, string[] options)
+    {
+        return options[reader.ReadByte()];
+    }
+
+    static CustomTerrainData ReadTerrain(BinaryReader reader)
+    {
+        return new CustomTerrainData
+        {
+            heightsGeneratorData = ReadHeights(reader),
+            texturesGeneratorDataList = ReadList(reader, ReadTexture),
+            treeGeneratorData = ReadTrees(reader),
+            grassGeneratorData = ReadGrass(reader),
+            waterGeneratorData = ReadWater(reader)
+        };
+    }
+
+    static HeightsGeneratorData ReadHeights(BinaryReader reader)
+    {
+        return new HeightsGeneratorData
+        {
+            width = reader.ReadInt32(),
+            height = reader.ReadInt32(),
+            depth = reader.ReadInt32(),
+            octaves = reader.ReadInt32(),
+            scale = reader.ReadSingle(),
+            lacunarity = reader.ReadSingle(),
+            persistence = reader.ReadSingle(),
+            heightCurveOffset = reader.ReadSingle(),
+            heightCurve = ReadOption(reader, HEIGHT_CURVES),
+            falloffDirection = reader.ReadSingle(),
+            falloffRange = reader.ReadSingle(),
+            useFalloffMap = reader.ReadBoolean(),
+            ShallowDepth = reader.ReadSingle(),
+            randomize = reader.ReadBoolean(),
+            autoUpdate = reader.ReadBoolean()
+        };
+    }
+
+    static TexturesGeneratorData ReadTexture(BinaryReader reader)
+    {
+        return new TexturesGeneratorData
+        {
+            texture = ReadOption(reader, TEXTURES),
+            heightCurve = ReadOption(reader, HEIGHT_CURVES),
+            tileSizeX = reader.ReadSingle(),
+            tileSizeY = reader.ReadSingle()
+        };
+    }
+
+    static TreeGeneratorData ReadTrees(BinaryReader reader)
+    {
+        return new TreeGeneratorData
+        {
+            octaves = reader.ReadInt32(),
+            scale = reader.ReadSingle(),
+            lacunarity = reader.ReadSingle(),
+            persistence = reader.ReadSingle(),
+            offset = reader.ReadSingle(),
+            minLevel = reader.ReadSingle(),
+            maxLevel = reader.ReadSingle(),
+            maxSteepness = reader.ReadSingle(),
+            islandSize = reader.ReadSingle(),
+            density = reader.ReadSingle(),
+            randomize = reader.ReadBoolean(),
+            treePrototypes = reader.ReadInt32()
+        };
+    }
+
+    static GrassGeneratorData ReadGrass(BinaryReader reader)
+    {
+        return new GrassGeneratorData
+        {
+            octaves = reader.ReadInt32(),
+            scale = reader.ReadSingle(),
+            lacunarity = reader.ReadSingle(),
+            persistence = reader.ReadSingle(),
+            offset = reader.ReadSingle(),
+            minLevel = reader.ReadSingle(),
+            maxLevel = reader.ReadSingle(),
+            maxSteepness = reader.ReadSingle(),
+            islandSize = reader.ReadSingle(),
+            density = reader.ReadSingle(),
+            randomize = reader.ReadBoolean(),
+            autoUpdate = reader.ReadBoolean(),
+            grassTextures = reader.ReadInt32()
+        };
+    }
+
+    static WaterGeneratorData ReadWater(BinaryReader reader)
+    {
+        return new WaterGeneratorData
+        {
+            waterType = ReadOption(reader, WATER_TYPES),
+            waterLevel = reader.ReadSingle(),
+            riverWidthRange = new Vector2(reader.ReadSingle(), reader.ReadSingle()),
+            randomize = reader.ReadBoolean(),
+            autoUpdate = reader.ReadBoolean()
+        };
+    }
+
+    static ObjectGeneratorData ReadObject(BinaryReader reader)
+    {
+        return new ObjectGeneratorData
+        {
+            x = reader.ReadSingle(),
+            y = reader.ReadSingle(),
+            Rx = reader.ReadSingle(),
+            Ry = reader.ReadSingle(),
+            Rz = reader.ReadSingle(),
+            name = ReadOption(reader, OBJECT_NAMES),
+            scale = reader.ReadSingle()
+        };
+    }
+
+    static AtmosphereGeneratorData ReadAtmosphere(BinaryReader reader)
+    {
+        return new AtmosphereGeneratorData
+        {
+            timeOfDay = reader.ReadSingle(),
+            sunSize = reader.ReadSingle(),
+            skyTint = ReadColor(reader),
+            atmosphericThickness = reader.ReadSingle(),
+            exposure = reader.ReadSingle(),
+            fogIntensity = reader.ReadSingle(),
+            fogColor = ReadColor(reader)
+        };
+    }
+
+    static Color ReadColor(BinaryReader reader)
+    {
+        return new Color(reader.ReadSingle(), reader.ReadSingle(), reader.ReadSingle(), reader.ReadSingle());
+    }
+}